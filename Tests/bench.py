@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+#
+# Micro-benchmarks for the host-side message handling hot paths.
+#
+# Each benchmark processes a pre-built batch of frames and is timed as
+# best-of-N over repeated passes, giving frames/second. Memory traffic is
+# measured separately with tracemalloc, one frame at a time, as the peak
+# bytes allocated while handling a frame; python offers no portable
+# allocation counter, so this stands in for allocations per frame.
+#
+# view/ benchmarks build a MessageView and read its first public field,
+# for comparison with the full unpack/.
+#
+# Results are appended to a JSON history (bench_history.json next to this
+# file by default) tagged with the current git commit, and compared with
+# the previous entry so that regressions show up.
+#
+# For scale: a fully loaded 500 kbps bus carries roughly 4000 8-byte
+# standard frames per second.
+#
+
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+
+import can
+import messages
+from messages import MessageFormat
+from console import Console
+from egs import EGS
+from interface import Expectations, Masked
+from isotp import ISOTP
+from simbus import SimBus
+from status import Status
+
+HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_history.json')
+BUS_FRAME_RATE = 4000
+
+# message() arguments for every format
+SAMPLES = {
+    'MSG_DDE_torque_brake': dict(brake_state=True),
+    'MSG_DDE_rpm_tps': dict(tps=0, rpm=832 * 4),
+    'MSG_DDE_coolant': dict(coolant_temp=27 + 48),
+    'MSG_EGS_gear': dict(selected_gear=0x0c),
+    'MSG_lights': dict(brake_light=True, tail_light=True, rain_light=False),
+    'MSG_ack': dict(reason_code=0, module_id=0x12345678, status_code=0, sw_version=0x0100),
+    'MSG_status_system': dict(t15_voltage=12000, temperature=25, fuel_level=50,
+                              output_request=0x03, function_request=0x01),
+    'MSG_status_voltage_current': dict(output_voltage=b'\x78\x78\x00\x78', output_current=b'\x10\x10\x00\x20'),
+    'MSG_status_faults': dict(output_faults=b'\x00\x11\x00\x00', system_faults=0x01),
+    'MSG_module_state': dict(fuel_level=50, display_gear=3),
+    'MSG_module_dde_status': dict(hfm_air_temp=0x0001, charge_air_temp=0x1011,
+                                  exhaust_temp=0x2021, boost_pressure=0x3031),
+    'MSG_module_dde_gear': dict(current_gear=3, trans_oil_temp=0x50, oil_pressure_status=0, _0=bytes(5)),
+    'MSG_DDE_PID_request': dict(pid_id=b'\x07\x72'),
+    'MSG_DDE_PID_response': dict(pid_id=b'\x07\x72', pid_value=b'\x12\x34'),
+    'MSG_EGS_PID_request': dict(pid_id=0x0a),
+    'MSG_EGS_PID_response': dict(pid_id=0x0a, pid_value=b'\x12'),
+    'MSG_ISO_TP_single': dict(sender=0xf1, recipient=0x12, data=b'\x2c\x10'),
+    'MSG_ISO_TP_initial': dict(sender=0xf1, recipient=0x12, data=bytes(range(16))),
+    'MSG_ISO_TP_consecutive': dict(sender=0xf1, recipient=0x12, sequence=1, data=bytes(range(6))),
+    'MSG_ISO_TP_flow_continue': dict(sender=0x12, recipient=0xf1),
+}
+
+
+def _formats():
+    """every concrete MSG_* format, in definition order"""
+    return [value for name, value in vars(messages).items()
+            if name.startswith('MSG_') and isinstance(value, type) and issubclass(value, MessageFormat)]
+
+
+class Benchmark(object):
+    """a named operation over a batch of frames"""
+    def __init__(self, name, frames, operation):
+        self.name = name
+        self.frames = frames
+        self.operation = operation
+
+    def _pass(self):
+        operation = self.operation
+        for frame in self.frames:
+            operation(frame)
+
+    def rate(self, repeat=5, min_time=0.1):
+        """frames per second, best of repeat runs of at least min_time each"""
+        best = None
+        for _ in range(repeat):
+            passes = 0
+            started = time.perf_counter()
+            while True:
+                self._pass()
+                passes += 1
+                elapsed = time.perf_counter() - started
+                if elapsed >= min_time:
+                    break
+            rate = passes * len(self.frames) / elapsed
+            if best is None or rate > best:
+                best = rate
+        return best
+
+    def allocation(self):
+        """mean peak bytes allocated while handling one frame"""
+        operation = self.operation
+        total = 0
+        tracemalloc.start()
+        try:
+            for frame in self.frames:
+                tracemalloc.reset_peak()
+                before, _ = tracemalloc.get_traced_memory()
+                operation(frame)
+                _, peak = tracemalloc.get_traced_memory()
+                total += peak - before
+        finally:
+            tracemalloc.stop()
+        return total / len(self.frames)
+
+
+def _message_benchmarks(errors):
+    benchmarks = list()
+    for msg_class in _formats():
+        name = msg_class.__name__
+        kwargs = SAMPLES.get(name)
+        if kwargs is None:
+            errors[name] = 'no sample arguments'
+            continue
+        try:
+            message = msg_class.message(**kwargs)
+        except Exception as err:
+            errors[f'message/{name}'] = f'{type(err).__name__}: {err}'
+            continue
+        benchmarks.append(Benchmark(f'message/{name}', [kwargs] * 100,
+                                    lambda kwargs, cls=msg_class: cls.message(**kwargs)))
+        try:
+            msg_class.unpack(message)
+        except Exception as err:
+            errors[f'unpack/{name}'] = f'{type(err).__name__}: {err}'
+            continue
+        benchmarks.append(Benchmark(f'unpack/{name}', [message] * 100, msg_class.unpack))
+        # a view, reading one field
+        public = [key for key in msg_class._fields if not key.startswith('_')]
+        benchmarks.append(Benchmark(f'view/{name}', [message] * 100,
+                                    lambda message, cls=msg_class, key=public[0]: getattr(cls.view(message), key)))
+    return benchmarks
+
+
+def _tp_segments(sender, recipient, data):
+    """the first and consecutive frames carrying a multi-frame ISO-TP message"""
+    frames = [messages.MSG_ISO_TP_initial.message(sender=sender, recipient=recipient, data=data)]
+    for sequence, offset in enumerate(range(5, len(data), 6), 1):
+        frames.append(messages.MSG_ISO_TP_consecutive.message(sender=sender, recipient=recipient,
+                                                              sequence=sequence & 0xf,
+                                                              data=data[offset:offset + 6]))
+    return frames
+
+
+def _tp_frames():
+    """a setup request and its response as the bus would carry them"""
+    frames = list()
+    for sender, recipient, data in ((0xf1, 0x12, b'\x2c\x10\x07\x72\x07\x6f\x04\x34\x07\x6d\x0e\xa6\x06\x07\x0a\x8d'),
+                                    (0x12, 0xf1, b'\x6c\x10\x00\x01\x10\x11\x20\x21\x30\x31\x40\x50\x60')):
+        segments = _tp_segments(sender, recipient, data)
+        frames.append(segments[0])
+        frames.append(messages.MSG_ISO_TP_flow_continue.message(sender=recipient, recipient=sender))
+        frames.extend(segments[1:])
+    frames.append(messages.MSG_ISO_TP_single.message(sender=0xf1, recipient=0x12, data=b'\x2c\x10'))
+    return frames * 10
+
+
+def _console_frames():
+    frames = list()
+    for line in ('E36 tail module\n', 'CAN OVERFLOW\n', 'brake on after 4012ms, animation\n'):
+        text = (line + '\0').encode()
+        for offset in range(0, len(text), 8):
+            chunk = text[offset:offset + 8]
+            frames.append(can.Message(arbitration_id=0x1ffffffe, is_extended_id=True, dlc=len(chunk), data=chunk))
+    return frames * 10
+
+
+def _status_messages():
+    return [cls.message(**SAMPLES[cls.__name__]) for cls in Status._formats if cls.__name__ in SAMPLES] * 25
+
+
+def benchmarks():
+    """build every benchmark; returns (benchmarks, errors) where errors maps skipped names to reasons"""
+    errors = dict()
+    result = _message_benchmarks(errors)
+
+    # both ends' addresses, so that requests and responses are both reassembled
+    isotp = ISOTP(SimBus().interface(), (0x12, 0xf1), lambda sender, recipient, data, timestamp: None)
+    result.append(Benchmark('ISOTP.on_message_received', _tp_frames(), isotp.on_message_received))
+
+    # one operation per 13-byte response, which is three frames
+    tx_bus = SimBus()
+    tx_isotp = ISOTP(tx_bus.interface(), (0x12,), lambda sender, recipient, data, timestamp: None)
+    flow = messages.MSG_ISO_TP_flow_continue.message(sender=0xf1, recipient=0x12, st_min=0)
+
+    def isotp_send(data):
+        tx_isotp.send(0x12, 0xf1, data)
+        tx_isotp.on_message_received(flow)
+        # release the consecutive frames, which the scheduler sends
+        tx_bus.run(0)
+
+    response = b'\x6c\x10\x00\x01\x10\x11\x20\x21\x30\x31\x40\x50\x60'
+    result.append(Benchmark('ISOTP.send', [response] * 100, isotp_send))
+
+    interface = SimBus().interface()
+    console = Console(interface, emit=lambda line: None)
+    result.append(Benchmark('Console.on_message_received', _console_frames(), console.on_message_received))
+
+    status = Status(interface)
+    status_messages = _status_messages()
+    result.append(Benchmark('Status.update',
+                            [MessageFormat.decode(message)[1] for message in status_messages],
+                            status.update))
+    result.append(Benchmark('Status.on_message_received', status_messages, status.on_message_received))
+
+    egs = EGS(SimBus().interface(), selected_gear=EGS.GEAR_D)
+    egs_requests = [messages.MSG_EGS_PID_request.message(pid_id=pid_id) for pid_id in egs.pids] * 20
+    result.append(Benchmark('EGS.on_message_received', egs_requests, egs.on_message_received))
+
+    # dozens of outstanding expect() waiters, none of them for the frames going past
+    expectations = Expectations()
+    for arbid in range(0x100, 0x140):
+        expectations.add(Masked(arbid, b'\x01', b'\xff'), lambda message: None)
+    result.append(Benchmark('Expectations.on_message_received', status_messages, expectations.on_message_received))
+    return result, errors
+
+
+# operations that handle more than one bus frame each
+FRAMES_PER_OPERATION = {
+    'ISOTP.send': 3,
+}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return list()
+
+
+def save_history(path, history):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(history, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def run(selected=None, repeat=5, min_time=0.1, measure_allocation=True):
+    """run benchmarks whose names contain selected; returns a history entry"""
+    entry = {
+        'commit': _git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'results': dict(),
+        'errors': dict(),
+    }
+    all_benchmarks, entry['errors'] = benchmarks()
+    for benchmark in all_benchmarks:
+        if selected is not None and selected not in benchmark.name:
+            continue
+        scale = FRAMES_PER_OPERATION.get(benchmark.name, 1)
+        result = {'frames_per_second': benchmark.rate(repeat, min_time) * scale}
+        if measure_allocation:
+            result['alloc_bytes_per_frame'] = benchmark.allocation() / scale
+        entry['results'][benchmark.name] = result
+    return entry
+
+
+def report(entry, previous=None):
+    lines = list()
+    width = max([len(name) for name in entry['results']] + [0])
+    for name, result in entry['results'].items():
+        line = f'{name:<{width}}  {result["frames_per_second"]:>12,.0f} frames/s'
+        if 'alloc_bytes_per_frame' in result:
+            line += f'  {result["alloc_bytes_per_frame"]:>8,.0f} B/frame'
+        if previous is not None and name in previous['results']:
+            change = result['frames_per_second'] / previous['results'][name]['frames_per_second'] - 1
+            line += f'  {change * 100:+6.1f}%'
+        if result['frames_per_second'] < BUS_FRAME_RATE:
+            line += '  SLOWER THAN BUS'
+        lines.append(line)
+    for name, error in entry['errors'].items():
+        lines.append(f'{name:<{width}}  skipped: {error}')
+    if previous is not None:
+        lines.append(f'(change relative to {previous["commit"]} at {previous["time"]})')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='E36 tail module host tooling benchmarks')
+    parser.add_argument('--filter',
+                        type=str,
+                        metavar='SUBSTRING',
+                        help='only run benchmarks whose names contain SUBSTRING')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=5,
+                        metavar='COUNT',
+                        help='timed runs per benchmark; the best is kept')
+    parser.add_argument('--min-time',
+                        type=float,
+                        default=0.1,
+                        metavar='SECONDS',
+                        help='minimum duration of each timed run')
+    parser.add_argument('--no-allocation',
+                        action='store_true',
+                        help='skip the tracemalloc measurement')
+    parser.add_argument('--history',
+                        type=str,
+                        default=HISTORY,
+                        metavar='PATH',
+                        help='JSON results history')
+    parser.add_argument('--no-save',
+                        action='store_true',
+                        help='do not append the results to the history')
+
+    args = parser.parse_args()
+    history = load_history(args.history)
+    entry = run(args.filter, args.repeat, args.min_time, not args.no_allocation)
+    print(report(entry, history[-1] if history else None))
+    if not args.no_save:
+        history.append(entry)
+        save_history(args.history, history)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+#
+# Run scenario tests on several benches at once.
+#
+# Each bench is one Interface channel with a module wired the usual way
+# (digital output 1 switching module power). Every bench gets a thread
+# that runs its share of the test matrix on its own Interface and writes
+# its own log, and the results are merged into one report. By default
+# every scenario runs on every bench, so a firmware build is tested on
+# all of them in the time one bench takes; with --spread the scenarios
+# are shared out between the benches instead.
+#
+# --virtual N runs against N virtual benches, each a 'virtual' channel
+# with the firmware model behind it, so no hardware is needed.
+#
+# Scenarios marked requires_model are skipped, as they need direct
+# access to the simulated loads.
+#
+
+import argparse
+import json
+import os
+import queue
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from interface import Interface
+from logger import Logger
+from scenarios import SCENARIOS, Bench, run_scenario
+
+# time the module is left unpowered between scenarios
+POWER_OFF_TIME = 0.5
+
+
+def _log_name(channel):
+    return re.sub(r'[^\w.-]', '_', channel) + '.log'
+
+
+def _bench_args(args, channel):
+    bench_args = argparse.Namespace(**vars(args))
+    bench_args.interface_channel = channel
+    return bench_args
+
+
+def run_bench(args, channel, scenarios, log_dir):
+    """
+    Run scenarios on one bench until the scenarios queue is empty; returns
+    the results. Each bench logs to its own file in log_dir.
+    """
+    results = list()
+    with open(os.path.join(log_dir, _log_name(channel)), 'w') as stream:
+        logger = Logger(None, args, stream=stream)
+        interface = Interface(_bench_args(args, channel))
+        logger.log(f'bench {channel}')
+        while True:
+            try:
+                name = scenarios.get_nowait()
+            except queue.Empty:
+                break
+            logger.log(f'{name} start')
+            bench = Bench(interface, name=channel)
+            result = run_scenario(name, bench)
+            for line in bench.console_lines():
+                logger.log(f'console: {line}')
+            logger.log(f'{result}')
+            results.append(result)
+            interface.sleep(POWER_OFF_TIME)
+        interface.set_power_off()
+    return results
+
+
+def run_matrix(args, channels, names, spread=False, log_dir='.'):
+    """run scenarios across the benches concurrently; returns the results in bench order"""
+    if spread:
+        shared = queue.Queue()
+        for name in names:
+            shared.put(name)
+        queues = [shared] * len(channels)
+    else:
+        queues = list()
+        for _ in channels:
+            own = queue.Queue()
+            for name in names:
+                own.put(name)
+            queues.append(own)
+    with ThreadPoolExecutor(max_workers=len(channels)) as pool:
+        futures = [pool.submit(run_bench, args, channel, scenarios, log_dir)
+                   for channel, scenarios in zip(channels, queues)]
+        return [result for future in futures for result in future.result()]
+
+
+def report(results, names, channels, wall_time):
+    width = max(len(name) for name in names)
+    lines = [f'{"":<{width}}  ' + '  '.join(channels)]
+    for name in names:
+        cells = list()
+        for channel in channels:
+            outcome = [result for result in results if result.name == name and result.bench == channel]
+            cell = '-' if not outcome else ('PASS' if outcome[0].passed else 'FAIL')
+            cells.append(f'{cell:<{len(channel)}}')
+        lines.append(f'{name:<{width}}  ' + '  '.join(cells))
+    for result in results:
+        if not result.passed:
+            lines.append(f'{result.bench} {result.name}: {result.error}')
+    failed = len([result for result in results if not result.passed])
+    lines.append(f'{len(results) - failed}/{len(results)} passed on {len(channels)} benches in {wall_time:.1f}s '
+                 f'({sum(result.wall_time for result in results):.1f}s of scenarios)')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import sys
+
+    parser = argparse.ArgumentParser(description='E36 tail module multi-bench scenario tests')
+    parser.add_argument('--interface-channel',
+                        type=str,
+                        action='append',
+                        metavar='CHANNEL',
+                        help='interface channel name of a bench (e.g. for Anagate units, hostname:portname); '
+                             'may be repeated')
+    parser.add_argument('--bitrate',
+                        type=int,
+                        default=500,
+                        metavar='BITRATE_KBPS',
+                        help='CAN bitrate (kBps')
+    parser.add_argument('--interface',
+                        type=str,
+                        choices=Interface.BACKENDS,
+                        default='anagate',
+                        help='CAN interface backend')
+    parser.add_argument('--time-scale',
+                        type=float,
+                        default=1.0,
+                        metavar='FACTOR',
+                        help='run periodic traffic and delays FACTOR times faster than real time')
+    parser.add_argument('--virtual',
+                        type=int,
+                        metavar='COUNT',
+                        help='run on COUNT virtual benches with the firmware model instead of hardware')
+    parser.add_argument('--spread',
+                        action='store_true',
+                        help='share the scenarios out between the benches rather than running all of them on each')
+    parser.add_argument('--log-dir',
+                        type=str,
+                        default='.',
+                        metavar='DIR',
+                        help='directory for the per-bench logs')
+    parser.add_argument('--results',
+                        type=str,
+                        metavar='PATH',
+                        help='also write the merged results as JSON')
+    parser.add_argument('scenarios',
+                        type=str,
+                        nargs='*',
+                        metavar='SCENARIO',
+                        help='scenarios to run (default all that can run on hardware)')
+
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f'unknown scenario {name}')
+        if SCENARIOS[name].requires_model:
+            parser.error(f'scenario {name} can only run against the firmware model, see scenarios.py')
+    names = args.scenarios or [name for name, entry in SCENARIOS.items() if not entry.requires_model]
+
+    modules = list()
+    if args.virtual:
+        from virtual_bench import VirtualModule
+
+        args.interface = 'virtual'
+        channels = [f'bench{index}' for index in range(args.virtual)]
+        modules = [VirtualModule(channel, args.bitrate, args.time_scale) for channel in channels]
+    elif args.interface_channel:
+        channels = args.interface_channel
+    else:
+        parser.error('--interface-channel or --virtual is required')
+    if len(set(channels)) != len(channels):
+        parser.error('each bench must have its own channel')
+    os.makedirs(args.log_dir, exist_ok=True)
+
+    started = time.perf_counter()
+    try:
+        results = run_matrix(args, channels, names, spread=args.spread, log_dir=args.log_dir)
+    finally:
+        for module in modules:
+            module.stop()
+    print(report(results, names, channels, time.perf_counter() - started))
+    if args.results is not None:
+        with open(args.results, 'w') as f:
+            json.dump([dict(result._asdict(), passed=result.passed) for result in results], f, indent=1)
+    sys.exit(0 if all(result.passed for result in results) else 1)
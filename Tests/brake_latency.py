@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+#
+# Brake light latency harness.
+#
+# Toggles the DDE brake state at randomised times and measures how long
+# the module takes to react. For each toggle a MSG_DDE_torque_brake frame
+# with the new state is sent immediately (the DDE's periodic frame is
+# updated to match), and the latency is the time from that send to the
+# first MSG_status_system frame whose brake output_request / brake
+# function_request bits differ from the last report before the toggle.
+#
+# Status frames are only sent every CAN_REPORT_INTERVAL_DIAGS, so every
+# toggle is held for at least that long and the bus-observed latency
+# includes the wait for the next report. When run against the firmware
+# model, the time to the first brake output pin change is measured as
+# well.
+#
+# Toggles are classified by path:
+#
+#   on          brake on after less than BRAKE_RESET_DELAY off
+#   on-reset    brake on after more than BRAKE_RESET_DELAY off; the module
+#               plays the brake-on animation
+#   off         brake off
+#
+
+import random
+import threading
+
+import can
+import firmware
+from interface import id_filters
+from messages import MSG_DDE_torque_brake, MSG_status_system
+
+BRAKE_OUTPUTS = 0x03
+BRAKE_FUNCTION = 0x01
+REPORT_INTERVAL = firmware.CONFIG['CAN_REPORT_INTERVAL_DIAGS'] / 1000
+# a literal in lights.c rather than a config.h define, so taken from the model
+BRAKE_RESET_DELAY = firmware.BRAKE_RESET_DELAY / 1000
+PATHS = ('on', 'on-reset', 'off')
+
+
+def percentile(samples, fraction):
+    """nearest-rank percentile of a sorted list"""
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+class Histogram(object):
+    """latency samples for one path, in seconds"""
+    BUCKETS = (0.001, 0.002, 0.005, 0.010, 0.020, 0.050, 0.100, 0.200, 0.500, 1.0, 2.0)
+
+    def __init__(self):
+        self.samples = list()
+        self.missed = 0
+
+    def record(self, latency):
+        self.samples.append(latency)
+
+    def __str__(self):
+        if not self.samples:
+            return f'no samples, {self.missed} missed'
+        samples = sorted(self.samples)
+        counts = [0] * (len(self.BUCKETS) + 1)
+        for sample in samples:
+            for index, limit in enumerate(self.BUCKETS):
+                if sample < limit:
+                    counts[index] += 1
+                    break
+            else:
+                counts[-1] += 1
+        buckets = ' '.join(f'<{limit * 1000:g}ms:{count}'
+                           for limit, count in zip(self.BUCKETS, counts) if count)
+        if counts[-1]:
+            buckets += f' >={self.BUCKETS[-1] * 1000:g}ms:{counts[-1]}'
+        return (f'{len(samples)} toggles, {self.missed} missed, '
+                f'p50 {percentile(samples, 0.5) * 1000:.1f}ms, '
+                f'p99 {percentile(samples, 0.99) * 1000:.1f}ms, '
+                f'max {samples[-1] * 1000:.1f}ms\n'
+                f'    {buckets}')
+
+
+class BrakeLatency(can.Listener):
+    """
+    Latency harness.
+
+    interface   Interface or SimInterface to drive
+    dde         DDE emulator whose periodic brake frame should track the toggles
+    module      optional firmware model, for output pin latency
+    clock       time source comparable with received message timestamps
+    """
+    def __init__(self, interface, dde=None, module=None, clock=None, seed=None):
+        self._interface = interface
+        self._dde = dde
+        self._clock = clock
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._reports = list()
+        self._outputs = list()
+        self.status = {path: Histogram() for path in PATHS}
+        self.output = {path: Histogram() for path in PATHS} if module is not None else None
+        if module is not None:
+            module.output_observers.append(self._output_changed)
+        interface.add_listener(self, filters=id_filters(MSG_status_system))
+
+    def on_message_received(self, message):
+        fields = MSG_status_system._match(message)
+        if fields is not None:
+            with self._lock:
+                self._reports.append((message.timestamp,
+                                      fields['output_request'] & BRAKE_OUTPUTS,
+                                      fields['function_request'] & BRAKE_FUNCTION))
+
+    def _output_changed(self, output, on):
+        if (1 << output) & BRAKE_OUTPUTS:
+            self._outputs.append(self._clock())
+
+    def _toggle(self, state):
+        self._interface.send(MSG_DDE_torque_brake.message(state))
+        when = self._clock()
+        if self._dde is not None:
+            if state:
+                self._dde.brake_on()
+            else:
+                self._dde.brake_off()
+        return when
+
+    def _measure(self, path, when):
+        with self._lock:
+            before = [report for report in self._reports if report[0] <= when]
+            after = [report for report in self._reports if report[0] > when]
+            self._reports = self._reports[-1:]
+        if before:
+            baseline = before[-1][1:]
+            for timestamp, outputs, function in after:
+                if (outputs, function) != baseline:
+                    self.status[path].record(timestamp - when)
+                    break
+            else:
+                self.status[path].missed += 1
+        if self.output is not None:
+            changes = [timestamp for timestamp in self._outputs if timestamp >= when]
+            if changes:
+                self.output[path].record(changes[0] - when)
+            else:
+                self.output[path].missed += 1
+            self._outputs = list()
+
+    def run(self, count, settle=3.0, hold=REPORT_INTERVAL * 1.2):
+        """
+        Perform count toggles. Each state is held for hold seconds plus a
+        random fraction of the report interval; about half of the off
+        periods are stretched past BRAKE_RESET_DELAY to exercise the
+        animation path.
+        """
+        self._toggle(False)
+        self._interface.sleep(settle)
+        state = False
+        previous_hold = settle
+        for _ in range(count):
+            state = not state
+            if state:
+                path = 'on-reset' if previous_hold > BRAKE_RESET_DELAY else 'on'
+            else:
+                path = 'off'
+            when = self._toggle(state)
+
+            previous_hold = hold + self._random.uniform(0, REPORT_INTERVAL)
+            if not state and self._random.random() < 0.5:
+                previous_hold += BRAKE_RESET_DELAY
+            self._interface.sleep(previous_hold)
+            self._measure(path, when)
+
+    def report(self):
+        lines = list()
+        for name, histograms in (('status', self.status), ('output', self.output)):
+            if histograms is None:
+                continue
+            for path in PATHS:
+                lines.append(f'{name} {path}: {histograms[path]}')
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    from interface import Interface
+    from dde import DDE
+
+    parser = argparse.ArgumentParser(description='E36 tail module brake light latency')
+    parser.add_argument('--interface-channel',
+                        type=str,
+                        metavar='CHANNEL',
+                        help='interface channel name (e.g. for Anagate units, hostname:portname')
+    parser.add_argument('--bitrate',
+                        type=int,
+                        default=500,
+                        metavar='BITRATE_KBPS',
+                        help='CAN bitrate (kBps')
+    parser.add_argument('--interface',
+                        type=str,
+                        choices=Interface.BACKENDS,
+                        default='anagate',
+                        help='CAN interface backend')
+    parser.add_argument('--firmware',
+                        action='store_true',
+                        help='measure the firmware model on a simulated bus instead of an interface')
+    parser.add_argument('--count',
+                        type=int,
+                        default=1000,
+                        metavar='TOGGLES',
+                        help='number of brake state changes')
+    parser.add_argument('--seed',
+                        type=int,
+                        metavar='SEED',
+                        help='random seed for toggle timing')
+
+    args = parser.parse_args()
+    args.no_periodic = False
+    module = None
+    if args.firmware:
+        from firmware import simulated
+
+        interface, module, clock = simulated()
+    else:
+        if args.interface_channel is None:
+            parser.error('--interface-channel is required unless --firmware is given')
+        interface = Interface(args)
+        clock = time.time
+
+    dde = DDE(interface, args)
+    harness = BrakeLatency(interface, dde=dde, module=module, clock=clock, seed=args.seed)
+    interface.set_power_on()
+    try:
+        harness.run(args.count)
+    except KeyboardInterrupt:
+        pass
+    interface.set_power_off()
+    print(harness.report())
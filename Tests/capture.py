@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+#
+# Bus traffic capture.
+#
+# Frames are stored as fixed-size records in a pre-allocated, memory-mapped
+# ring file, so recording does no per-frame file I/O and never grows the
+# file. A sidecar index (<capture>.idx, JSON) records, for each arbitration
+# ID and time bucket, the first and last record sequence numbers and the
+# frame count, so a reader can go straight to the records for one ID over
+# a time window. Standard and extended IDs are indexed separately; the
+# index keys extended IDs with an 'x' suffix (e.g. '0x18fef100x'). The
+# index also records how many records it covers; records written after
+# the last flush are found by scanning them.
+#
+# File layout:
+#
+#   header  (64 bytes)  magic, version, record size, capacity,
+#                       records written (sequence of the next record)
+#   records (capacity * 24 bytes)
+#                       timestamp (double), arbitration ID, flags, DLC,
+#                       8 data bytes, 2 bytes padding
+#
+# Record n lives in slot n % capacity; once the ring has wrapped, only the
+# most recent 'capacity' records are available.
+#
+
+import can
+import json
+import mmap
+import os
+import struct
+import threading
+
+MAGIC = b'E36CAPT\0'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQQ32x')
+RECORD = struct.Struct('<dIBB8s2x')
+COUNT_OFFSET = 24
+
+FLAG_EXTENDED = 0x01
+FLAG_REMOTE = 0x02
+FLAG_ERROR = 0x04
+
+DEFAULT_CAPACITY = 1 << 20
+DEFAULT_BUCKET = 1.0
+
+
+class CaptureError(Exception):
+    pass
+
+
+def index_path(path):
+    return path + '.idx'
+
+
+def _index_key(arbid, extended):
+    return f'{arbid:#x}x' if extended else f'{arbid:#x}'
+
+
+def _parse_index_key(key):
+    if key.endswith('x'):
+        return int(key[:-1], 16), True
+    return int(key, 16), False
+
+
+class Recorder(can.Listener):
+    """
+    Record every frame seen on an interface to a capture file.
+
+    The index is written by flush() and close(); flush periodically during
+    long sessions so that a crash loses little of it. flush() may be called
+    from any thread. close() detaches from the interface, and frames still
+    being delivered after it are dropped.
+    """
+    def __init__(self, interface, path, capacity=DEFAULT_CAPACITY, bucket=DEFAULT_BUCKET):
+        self._interface = interface
+        self._path = path
+        self._capacity = capacity
+        self._bucket = bucket
+        self._count = 0
+        self._index = dict()
+        self._lock = threading.Lock()
+
+        size = HEADER.size + capacity * RECORD.size
+        with open(path, 'wb') as f:
+            f.truncate(size)
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), size)
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, RECORD.size, capacity, 0)
+        if interface is not None:
+            interface.add_listener(self)
+
+    @property
+    def count(self):
+        return self._count
+
+    def on_message_received(self, msg):
+        flags = ((FLAG_EXTENDED if msg.is_extended_id else 0) |
+                 (FLAG_REMOTE if msg.is_remote_frame else 0) |
+                 (FLAG_ERROR if msg.is_error_frame else 0))
+        key = (msg.arbitration_id, msg.is_extended_id)
+        bucket = int(msg.timestamp // self._bucket)
+        with self._lock:
+            if self._map.closed:
+                return
+            sequence = self._count
+            RECORD.pack_into(self._map,
+                             HEADER.size + (sequence % self._capacity) * RECORD.size,
+                             msg.timestamp,
+                             msg.arbitration_id,
+                             flags,
+                             msg.dlc,
+                             bytes(msg.data))
+            self._count = sequence + 1
+            struct.pack_into('<Q', self._map, COUNT_OFFSET, self._count)
+
+            buckets = self._index.get(key)
+            if buckets is None:
+                buckets = self._index[key] = dict()
+            entry = buckets.get(bucket)
+            if entry is None:
+                buckets[bucket] = [sequence, sequence, 1]
+            else:
+                entry[1] = sequence
+                entry[2] += 1
+
+    def flush(self):
+        """write the index and push the mapped records to disk"""
+        # prune and copy the index with the listener held off, then write the copy without holding it up
+        with self._lock:
+            count = self._count
+            oldest = max(0, count - self._capacity)
+            index = dict()
+            for (arbid, extended), buckets in self._index.items():
+                for bucket in [bucket for bucket, entry in buckets.items() if entry[1] < oldest]:
+                    del buckets[bucket]
+                if buckets:
+                    index[_index_key(arbid, extended)] = {str(bucket): list(entry)
+                                                          for bucket, entry in buckets.items()}
+        with open(index_path(self._path) + '.tmp', 'w') as f:
+            json.dump({'bucket': self._bucket, 'count': count, 'index': index}, f)
+        os.replace(index_path(self._path) + '.tmp', index_path(self._path))
+        self._map.flush()
+
+    def close(self):
+        if self._interface is not None:
+            self._interface.remove_listener(self)
+            self._interface = None
+        self.flush()
+        with self._lock:
+            self._map.close()
+        self._file.close()
+
+    def stop(self):
+        self.close()
+
+
+class Capture(object):
+    """read-only access to a capture file and its index"""
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, self.capacity, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            raise CaptureError(f'{path} is not a version {VERSION} capture file')
+        self.oldest = max(0, self.count - self.capacity)
+        try:
+            with open(index_path(path)) as f:
+                index = json.load(f)
+            self.bucket = index['bucket']
+            self._indexed = index['count']
+            self._index = {_parse_index_key(key): {int(bucket): entry for bucket, entry in buckets.items()}
+                           for key, buckets in index['index'].items()}
+        except FileNotFoundError:
+            self.bucket = None
+            self._indexed = 0
+            self._index = None
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def _record(self, sequence):
+        return RECORD.unpack_from(self._map, HEADER.size + (sequence % self.capacity) * RECORD.size)
+
+    def _ranges(self, arbid, extended, start, end):
+        """sequence ranges that may hold matching records, in order and not overlapping"""
+        if arbid is None or self._index is None:
+            return [(self.oldest, self.count - 1)]
+        ranges = list()
+        for key in ((arbid, False), (arbid, True)):
+            if extended is not None and key[1] != extended:
+                continue
+            for bucket, (first, last, _) in self._index.get(key, {}).items():
+                if start is not None and (bucket + 1) * self.bucket <= start:
+                    continue
+                if end is not None and bucket * self.bucket > end:
+                    continue
+                ranges.append((max(first, self.oldest), last))
+        # records written since the index was last flushed
+        if self._indexed < self.count:
+            ranges.append((max(self._indexed, self.oldest), self.count - 1))
+        merged = list()
+        for first, last in sorted(ranges):
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+            else:
+                merged.append((first, last))
+        return merged
+
+    def records(self, arbid=None, start=None, end=None, extended=None):
+        """
+        yield (timestamp, arbitration_id, flags, dlc, data) for records matching
+        the optional ID and [start, end] time window; extended selects standard
+        (False) or extended (True) IDs, default both
+        """
+        for first, last in self._ranges(arbid, extended, start, end):
+            for sequence in range(first, last + 1):
+                record = self._record(sequence)
+                if arbid is not None and record[1] != arbid:
+                    continue
+                if extended is not None and bool(record[2] & FLAG_EXTENDED) != extended:
+                    continue
+                if start is not None and record[0] < start:
+                    continue
+                if end is not None and record[0] > end:
+                    continue
+                yield record
+
+    def messages(self, arbid=None, start=None, end=None, extended=None):
+        """as records(), but yielding can.Message objects"""
+        for timestamp, arbitration_id, flags, dlc, data in self.records(arbid, start, end, extended):
+            yield can.Message(timestamp=timestamp,
+                              arbitration_id=arbitration_id,
+                              is_extended_id=bool(flags & FLAG_EXTENDED),
+                              is_remote_frame=bool(flags & FLAG_REMOTE),
+                              is_error_frame=bool(flags & FLAG_ERROR),
+                              dlc=dlc,
+                              data=data[:dlc])
+
+    def arrays(self):
+        """
+        Return (arbids, timestamps, data_matrix, dlcs, extended) numpy arrays
+        for every available record in sequence order, ready for
+        MessageFormat.unpack_many().
+        """
+        import numpy as np
+
+        dtype = np.dtype([('timestamp', '<f8'), ('arbid', '<u4'), ('flags', 'u1'), ('dlc', 'u1'),
+                          ('data', 'u1', (8,)), ('_pad', 'V2')])
+        records = np.frombuffer(self._map, dtype=dtype, count=self.capacity, offset=HEADER.size)
+        if self.count > self.capacity:
+            records = np.roll(records, -(self.count % self.capacity))
+        else:
+            records = records[:self.count]
+        return (records['arbid'], records['timestamp'], records['data'], records['dlc'],
+                (records['flags'] & FLAG_EXTENDED) != 0)
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    from interface import Interface
+
+    parser = argparse.ArgumentParser(description='E36 tail module bus capture')
+    parser.add_argument('--interface-channel',
+                        type=str,
+                        metavar='CHANNEL',
+                        help='interface channel name (e.g. for Anagate units, hostname:portname')
+    parser.add_argument('--bitrate',
+                        type=int,
+                        default=500,
+                        metavar='BITRATE_KBPS',
+                        help='CAN bitrate (kBps')
+    parser.add_argument('--interface',
+                        type=str,
+                        choices=Interface.BACKENDS,
+                        default='anagate',
+                        help='CAN interface backend')
+    parser.add_argument('--capacity',
+                        type=int,
+                        default=DEFAULT_CAPACITY,
+                        metavar='FRAMES',
+                        help='ring size in frames')
+    parser.add_argument('--dump',
+                        action='store_true',
+                        help='print frames from an existing capture rather than recording')
+    parser.add_argument('--id',
+                        type=lambda x: int(x, 0),
+                        metavar='ARBID',
+                        help='with --dump, only print frames with this ID')
+    parser.add_argument('--start',
+                        type=float,
+                        metavar='TIMESTAMP',
+                        help='with --dump, only print frames at or after this time')
+    parser.add_argument('--end',
+                        type=float,
+                        metavar='TIMESTAMP',
+                        help='with --dump, only print frames at or before this time')
+    parser.add_argument('path',
+                        type=str,
+                        metavar='CAPTURE',
+                        help='capture file')
+
+    args = parser.parse_args()
+    if args.dump:
+        capture = Capture(args.path)
+        for msg in capture.messages(args.id, args.start, args.end):
+            print(msg)
+    else:
+        if args.interface_channel is None:
+            parser.error('--interface-channel is required when recording')
+        recorder = Recorder(Interface(args), args.path, capacity=args.capacity)
+        print(f'Capture @ {args.interface_channel} -> {args.path}')
+        try:
+            while True:
+                time.sleep(10.0)
+                recorder.flush()
+        except KeyboardInterrupt:
+            recorder.close()
+            print(f'{recorder.count} frames')
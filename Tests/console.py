@@ -3,21 +3,102 @@
 # Console monitor
 #
 
+import queue
+import threading
+from collections import namedtuple
+
 import can
 
+CONSOLE_ID = 0x1ffffffe
+
+
+class ConsoleLine(namedtuple('ConsoleLine', ('text', 'first_timestamp', 'last_timestamp'))):
+    """a console line and the timestamps of its first and last frames"""
+    __slots__ = ()
+
+    def __str__(self):
+        return self.text
+
 
 class Console(can.Listener):
-    def __init__(self, interface, emit=print):
-        self._line = ''
-        interface.add_listener(self)
+    """
+    Reassemble console output from the module.
+
+    Lines are NUL-terminated and sent in frames of up to 8 bytes. Completed
+    lines are handed off in batches (one per frame) through a bounded queue,
+    so the notifier thread never waits on output; if the queue is full the
+    batch is dropped and counted in dropped_lines.
+
+    If emit is supplied it is called with each ConsoleLine from a separate
+    thread, otherwise batches are collected with get().
+    """
+    QUEUE_DEPTH = 256
+
+    def __init__(self, interface, emit=print, queue_depth=QUEUE_DEPTH):
+        self._buffer = bytearray()
+        self._first_timestamp = None
+        self._queue = queue.Queue(maxsize=queue_depth)
         self._emit = emit
+        self.dropped_lines = 0
+        if emit is not None:
+            self._thread = threading.Thread(target=self._emit_thread, name='console', daemon=True)
+            self._thread.start()
+        else:
+            self._thread = None
+        interface.add_listener(self, filters=[{'can_id': CONSOLE_ID, 'can_mask': 0x1fffffff, 'extended': True}])
 
     def on_message_received(self, message):
-        if message.is_extended_id and message.arbitration_id == 0x1ffffffe:
-            self._line += bytes(message.data).decode()
-            if self._line.endswith('\0'):
-                self._emit(self._line)
-                self._line = ''
+        if not message.is_extended_id or message.arbitration_id != CONSOLE_ID:
+            return
+        data = message.data
+        timestamp = message.timestamp
+        if self._first_timestamp is None:
+            self._first_timestamp = timestamp
+
+        batch = None
+        start = 0
+        end = data.find(0)
+        while end >= 0:
+            self._buffer += data[start:end]
+            line = ConsoleLine(self._buffer.decode(errors='replace'), self._first_timestamp, timestamp)
+            self._buffer.clear()
+            if batch is None:
+                batch = [line]
+            else:
+                batch.append(line)
+            start = end + 1
+            self._first_timestamp = timestamp if start < len(data) else None
+            end = data.find(0, start)
+        if start < len(data):
+            self._buffer += data[start:]
+
+        if batch is not None:
+            try:
+                self._queue.put_nowait(batch)
+            except queue.Full:
+                self.dropped_lines += len(batch)
+
+    def get(self, timeout=None):
+        """return the next batch of ConsoleLines, or None on timeout"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _emit_thread(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            for line in batch:
+                self._emit(line)
+
+    def stop(self):
+        """deliver everything queued so far and stop the output thread"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
 
 
 if __name__ == '__main__':
@@ -36,6 +117,16 @@ if __name__ == '__main__':
                         default=500,
                         metavar='BITRATE_KBPS',
                         help='CAN bitrate (kBps')
+    parser.add_argument('--interface',
+                        type=str,
+                        choices=Interface.BACKENDS,
+                        default='anagate',
+                        help='CAN interface backend')
+    parser.add_argument('--time-scale',
+                        type=float,
+                        default=1.0,
+                        metavar='FACTOR',
+                        help='run periodic traffic and delays FACTOR times faster than real time')
 
     args = parser.parse_args()
     try:
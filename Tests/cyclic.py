@@ -0,0 +1,190 @@
+#
+# Cyclic transmit scheduler.
+#
+# Owns a table of periodic messages, each with a period and a phase
+# offset on a common tick, and sends whatever is due from a single
+# scheduler callback (the interface's call_later), so a whole emulated
+# network costs one timer rather than one thread per message.
+#
+# A payload is either a can.Message or a callable returning one (or None
+# to skip that slot); replacing a payload is atomic with respect to
+# sending. Achieved period and jitter are kept for each ID, measured
+# from when each frame was handed to the interface.
+#
+
+import math
+import threading
+
+
+class CyclicStats(object):
+    """achieved transmit period for one ID, in nominal seconds"""
+    def __init__(self):
+        self.count = 0
+        self.last = None
+        self.intervals = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, when):
+        self.count += 1
+        if self.last is not None:
+            interval = when - self.last
+            self.intervals += 1
+            delta = interval - self.mean
+            self.mean += delta / self.intervals
+            self._m2 += delta * (interval - self.mean)
+            if self.min is None or interval < self.min:
+                self.min = interval
+            if self.max is None or interval > self.max:
+                self.max = interval
+        self.last = when
+
+    @property
+    def jitter(self):
+        """standard deviation of the period"""
+        return math.sqrt(self._m2 / self.intervals) if self.intervals else 0.0
+
+    def __str__(self):
+        if not self.intervals:
+            return f'{self.count} sent'
+        return (f'{self.count} sent, period mean {self.mean * 1000:.3f}ms '
+                f'min {self.min * 1000:.3f}ms max {self.max * 1000:.3f}ms '
+                f'jitter {self.jitter * 1000:.3f}ms')
+
+
+class CyclicEntry(object):
+    __slots__ = ('arbid', 'period', 'phase', 'payload', 'period_ticks', 'next_tick', 'stats')
+
+    def __init__(self, arbid, period, phase, payload, period_ticks, next_tick):
+        self.arbid = arbid
+        self.period = period
+        self.phase = phase
+        self.payload = payload
+        self.period_ticks = period_ticks
+        self.next_tick = next_tick
+        self.stats = CyclicStats()
+
+
+class CyclicScheduler(object):
+    """
+    Periodic message table for one interface.
+
+    Periods and phases are rounded to a multiple of tick seconds; an entry
+    with phase p and period t is sent at p, p + t, p + 2t ... after start().
+    Entries may be added, changed and removed while running; an entry added
+    while running starts at its first in-phase slot after the next wakeup,
+    which is never more than MAX_IDLE_TICKS away.
+    """
+    MAX_IDLE_TICKS = 10
+
+    def __init__(self, interface, tick=0.005):
+        self._interface = interface
+        self._tick = tick
+        self._entries = dict()
+        self._lock = threading.RLock()
+        self._timer = None
+        self._timer_tick = 0
+        self._timer_behind = 0.0
+        self._tick_count = 0
+        self._started = False
+
+    def _ticks(self, seconds):
+        return max(0, int(round(seconds / self._tick)))
+
+    def _first_tick(self, period_ticks, phase):
+        """the first in-phase slot not before the next wakeup"""
+        next_tick = self._ticks(phase) % period_ticks
+        if self._started and next_tick < self._timer_tick:
+            next_tick += -(-(self._timer_tick - next_tick) // period_ticks) * period_ticks
+        return next_tick
+
+    def add(self, arbid, period, payload, phase=0.0):
+        """add or replace the entry for arbid"""
+        with self._lock:
+            period_ticks = max(1, self._ticks(period))
+            entry = CyclicEntry(arbid, period, phase, payload, period_ticks, self._first_tick(period_ticks, phase))
+            self._entries[arbid] = entry
+            return entry
+
+    def set_payload(self, arbid, payload):
+        """replace the payload for arbid; takes effect from its next slot"""
+        with self._lock:
+            self._entries[arbid].payload = payload
+
+    def set_period(self, arbid, period, phase=None):
+        """change the period, and optionally the phase, of the entry for arbid, keeping its payload and stats"""
+        with self._lock:
+            entry = self._entries[arbid]
+            entry.period = period
+            if phase is not None:
+                entry.phase = phase
+            entry.period_ticks = max(1, self._ticks(period))
+            entry.next_tick = self._first_tick(entry.period_ticks, entry.phase)
+            return entry
+
+    def remove(self, arbid):
+        with self._lock:
+            self._entries.pop(arbid, None)
+
+    def stats(self, arbid):
+        return self._entries[arbid].stats
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            self._tick_count = 0
+            for entry in self._entries.values():
+                entry.next_tick = self._ticks(entry.phase) % entry.period_ticks
+                entry.stats.last = None
+            self._arm(0.0)
+
+    def stop(self):
+        with self._lock:
+            self._started = False
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    @property
+    def running(self):
+        return self._started
+
+    def _arm(self, now):
+        """schedule the next wakeup, now being the current nominal time since start()"""
+        limit = self._tick_count + self.MAX_IDLE_TICKS
+        self._timer_tick = min([entry.next_tick for entry in self._entries.values()] + [limit])
+        delay = self._timer_tick * self._tick - now
+        # if already overdue the timer fires at once, and its lateness no longer counts from the tick
+        self._timer_behind = max(0.0, -delay)
+        self._timer = self._interface.call_later(max(0.0, delay), self._run)
+
+    def _run(self):
+        started = self._interface.clock()
+        with self._lock:
+            if self._timer is None or not self._started:
+                return
+            self._tick_count = self._timer_tick
+            # position on the nominal timeline when this callback ran
+            now = (self._tick_count * self._tick + self._timer_behind +
+                   (getattr(self._timer, 'lateness', None) or 0.0) * self._interface.time_scale)
+            due = [entry for entry in self._entries.values() if entry.next_tick <= self._tick_count]
+            for entry in due:
+                entry.next_tick += entry.period_ticks
+            # arm before sending, so that time spent sending does not delay the timeline
+            self._arm(now)
+            for entry in due:
+                message = entry.payload() if callable(entry.payload) else entry.payload
+                if message is None:
+                    continue
+                self._interface.send(message)
+                # when this frame actually went out, after the payloads and sends before it
+                entry.stats.record(now + self._interface.clock() - started)
+
+    def report(self):
+        with self._lock:
+            return '\n'.join(f'{arbid:#05x} every {entry.period * 1000:g}ms: {entry.stats}'
+                             for arbid, entry in sorted(self._entries.items()))
@@ -3,9 +3,9 @@
 # DDE emulator
 #
 
-import time
-import can
 from messages import *
+from cyclic import CyclicScheduler
+from isotp import ISOTP
 
 
 # class PID(object):
@@ -65,182 +65,39 @@ from messages import *
 # DDE_EXHAUST_TEMP = PID((0x04, 0x1b), 2)
 # DDE_AMBIENT_PRESSURE = PID((0x0c, 0x1c), 2)
 
-TYPE_SINGLE = 0x0
-TYPE_FIRST = 0x1
-TYPE_CONSECUTIVE = 0x2
-TYPE_FLOW = 0x3
 
-FLOW_CONTINUE = 0x0
-FLOW_WAIT = 0x1
-FLOW_ABORT = 0x2
+class DDE(object):
+    # (message, period, phase) for the periodic DDE broadcasts
+    PERIODIC = (
+        (MSG_DDE_rpm_tps.message(tps=0, rpm=(832 * 4)), 0.1, 0.0),
+        (MSG_DDE_coolant.message(coolant_temp=27 + 48), 0.1, 0.01),
+        (MSG_DDE_torque_brake.message(False), 0.1, 0.02),
+    )
 
+    # reply to the module's setup / repeat request when there is no drive cycle
+    FIXED_REPLY = b'\x6c\x10\x00\x01\x10\x11\x20\x21\x30\x31\x40\x50\x60'
 
-class TPFramer(object):
-    class RXFrame(object):
-        def __init__(self, msg):
-            if (msg.arbitration_id & 0xf00) != 0x600:
-                raise MessageError('not in the expected ID range')
-            self.sender = msg.arbitration_id & 0xff
-            self.recipient = msg.data[0]
-            self.type = msg.data[1] >> 4
-            self.length = None
-            self.data = None
-            self.sequence = None
-            if self.type == TYPE_SINGLE:
-                self.length = msg.data[1] & 0xf
-                self.data = msg.data[2:]
-            elif self.type == TYPE_FIRST:
-                self.length = ((msg.data[1] & 0xf) << 8) + msg.data[2]
-                self.data = msg.data[3:]
-            elif self.type == TYPE_CONSECUTIVE:
-                self.sequence = msg.data[1] & 0xf
-                self.data = msg.data[2:]
-            elif self.type == TYPE_FLOW:
-                pass
-            else:
-                raise MessageError('not an expected TP frame')
-
-    class TXFrame(object):
-        def __init__(self, sender, recipient, data):
-            self.type = TYPE_SINGLE if len(data) <= 6 else TYPE_FIRST
-            self.sender = sender
-            self.recipient = recipient
-            self.data = data
-
-        def next_message(self):
-            if self.type == TYPE_SINGLE:
-                msg = MSG_ISO_TP_single.message(sender=self.sender,
-                                                recipient=self.recipient,
-                                                data=self.data)
-                self.type = None
-                return msg
-
-            if self.type == TYPE_FIRST:
-                msg = MSG_ISO_TP_initial.message(sender=self.sender,
-                                                 recipient=self.recipient,
-                                                 data=self.data)
-                self.data = self.data[5:]
-                self.type = TYPE_CONSECUTIVE
-                self.sequence = 1
-                return msg
-
-            if self.type == TYPE_CONSECUTIVE:
-                msg = MSG_ISO_TP_consecutive.message(sender=self.sender,
-                                                     recipient=self.recipient,
-                                                     sequence=self.sequence,
-                                                     data=self.data[:6])
-                self.data = self.data[6:]
-                self.sequence += 1
-                if len(self.data) == 0:
-                    self.type = None
-                return msg
-
-            return None
-
-    def __init__(self, interface, module_id):
-        self._interface = interface
-        self._module_id = module_id
-        self._inbound_data = None
-        self._inbound_sender = None
-        self._inbound_sequence = 0
-        self._inbound_outstanding = 0
-        self._outbound_frame = None
-
-    def message_received(self, msg):
-        try:
-            frame = self.RXFrame(msg)
-        except MessageError:
-            return
-        if frame.recipient != self._module_id:
-            # not for us, ignore
-            return
-
-        # Got a single frame?
-        if frame.type == TYPE_SINGLE:
-            print('single')
-            self._inbound_sender = frame.sender
-            self._inbound_data = bytearray(frame.data[:frame.length])
-            self._inbound_outstanding = 0
-
-        # Got an initial frame?
-        elif frame.type == TYPE_FIRST:
-            print('first')
-            self._inbound_sender = frame.sender
-            if frame.length > len(frame.data):
-                self._inbound_outstanding = frame.length - len(frame.data)
-            else:
-                self._inbound_outstanding = 0
-            self._inbound_data = frame.data[0:frame.length]
-            self._inbound_sequence = 1
-
-            # send a flow control request for more
-            self._interface.send(MSG_ISO_TP_flow_continue.message(sender=self._module_id,
-                                                                  recipient=self._inbound_sender))
-
-        # Got a continuation frame?
-        elif ((self._inbound_data is not None) and
-              (self._inbound_outstanding > 0) and
-              (frame.type == TYPE_CONSECUTIVE) and
-              (frame.sender == self._inbound_sender) and
-              (frame.sequence == self._inbound_sequence)):
-            print('cont')
-            self._inbound_data += bytearray(frame.data[:self._inbound_outstanding])
-            if self._inbound_outstanding <= len(frame.data):
-                self._inbound_outstanding = 0
-            else:
-                self._inbound_outstanding -= len(frame.data)
-            self._inbound_sequence = (self._inbound_sequence + 1) & 0xf
-
-        # Got a flow-control frame
-        # XXX should check the sender and respect more fields in this message
-        elif ((frame.type == TYPE_FLOW) and
-              (self._outbound_frame is not None)):
-            # mostly disregard what the flow frame says and just spam the responses at 1ms intervals
-            while True:
-                msg = self._outbound_frame.next_message()
-                if msg is None:
-                    break
-                self._interface.send(msg)
-                time.sleep(0.001)
-            self._outbound_frame = None
-
-    def recv_frame(self):
-        if ((self._inbound_data is None) or
-            (self._inbound_outstanding != 0)):
-            raise MessageError('no message')
-
-        data = self._inbound_data
-        self._inbound_data = None
-        return self._inbound_sender, data
+    def __init__(self, interface, args, cyclic=None, drive_cycle=None):
+        """
+        Periodic messages are added to cyclic if supplied (the caller starts
+        it), otherwise to a scheduler of our own.
 
-    def send_frame(self, recipient, data):
-        self._outbound_frame = self.TXFrame(self._module_id, recipient, data)
-        self._interface.send(self._outbound_frame.next_message())
-
-
-class DDE(can.Listener):
-    def __init__(self, interface, args):
+        If drive_cycle (a drive_cycle.DriveCycle) is supplied, requests are
+        answered with its values at the time of the request.
+        """
         self._interface = interface
-        self._tp_framer = TPFramer(interface, 0x12)
+        self._drive_cycle = drive_cycle
+        self._isotp = ISOTP(interface, (0x12,), self._request_received)
         self._setup = False
-        if not args.no_periodic:
-            self._dde_rpm_task = interface.send_periodic(MSG_DDE_rpm_tps.message(tps=0, rpm=(832 * 4)), 0.1)
-            self._dde_coolant_task = interface.send_periodic(MSG_DDE_coolant.message(coolant_temp=27 + 48), 0.1)
-            self._dde_brake_task = interface.send_periodic(MSG_DDE_torque_brake.message(False), 0.1)
-        else:
-            self._dde_rpm_task = None
-            self._dde_coolant_task = None
-            self._dde_brake_task = None
-        self._interface.add_listener(self)
-
-    def on_message_received(self, message):
-        self._tp_framer.message_received(message)
-
-        try:
-            sender, data = self._tp_framer.recv_frame()
-        except MessageError:
-            return
-
+        self._cyclic = None
+        if not getattr(args, 'no_periodic', False):
+            self._cyclic = cyclic if cyclic is not None else CyclicScheduler(interface)
+            for message, period, phase in self.PERIODIC:
+                self._cyclic.add(message.arbitration_id, period, message, phase=phase)
+            if cyclic is None:
+                self._cyclic.start()
+
+    def _request_received(self, sender, recipient, data, timestamp):
         # compare payload with expected
         if sender != 0xf1:
             print(f'bad sender {sender:#x}')
@@ -253,16 +110,29 @@ class DDE(can.Listener):
             else:
                 self._setup = True
 
-        # send dummy reply
-        self._tp_framer.send_frame(sender, b'\x6c\x10\x00\x01\x10\x11\x20\x21\x30\x31\x40\x50\x60')
+        if self._drive_cycle is not None:
+            # the values current when the request started, as the echo check expects
+            reply = self._drive_cycle.reply(timestamp)
+        else:
+            reply = self.FIXED_REPLY
+        self._isotp.send(recipient, sender, reply)
+
+    @property
+    def tx_lateness(self):
+        """how late consecutive frames were released relative to the requested STmin"""
+        return self._isotp.tx_lateness
+
+    @property
+    def cyclic(self):
+        return self._cyclic
 
     def brake_on(self):
-        if self._dde_brake_task is not None:
-            self._dde_brake_task.modify_data(MSG_DDE_torque_brake.message(True))
+        if self._cyclic is not None:
+            self._cyclic.set_payload(MSG_DDE_torque_brake._arbid, MSG_DDE_torque_brake.message(True))
 
     def brake_off(self):
-        if self._dde_brake_task is not None:
-            self._dde_brake_task.modify_data(MSG_DDE_torque_brake.message(False))
+        if self._cyclic is not None:
+            self._cyclic.set_payload(MSG_DDE_torque_brake._arbid, MSG_DDE_torque_brake.message(False))
 
 
 if __name__ == '__main__':
@@ -281,19 +151,32 @@ if __name__ == '__main__':
                         default=500,
                         metavar='BITRATE_KBPS',
                         help='CAN bitrate (kBps')
+    parser.add_argument('--interface',
+                        type=str,
+                        choices=Interface.BACKENDS,
+                        default='anagate',
+                        help='CAN interface backend')
+    parser.add_argument('--time-scale',
+                        type=float,
+                        default=1.0,
+                        metavar='FACTOR',
+                        help='run periodic traffic and delays FACTOR times faster than real time')
     parser.add_argument('--no-periodic',
                         action='store_true',
                         help='disable periodic DDE message emulation')
 
     args = parser.parse_args()
     try:
-        dde = DDE(Interface(args), args)
+        interface = Interface(args)
+        dde = DDE(interface, args)
 
         print(f'DDE @ {args.interface_channel}')
         while True:
-            time.sleep(1.0)
+            interface.sleep(1.0)
             dde.brake_on()
-            time.sleep(1.0)
+            interface.sleep(1.0)
             dde.brake_off()
     except KeyboardInterrupt:
-        pass
+        print(f'consecutive frame lateness: {dde.tx_lateness}')
+        if dde.cyclic is not None:
+            print(dde.cyclic.report())
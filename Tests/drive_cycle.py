@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+#
+# Drive-cycle values for the DDE PIDs read by the module.
+#
+# bmw_scanner.c asks the DDE for the PIDs in dde_setup_req every
+# CAN_BMW_INTERVAL and re-broadcasts the reply literally as 0x700 / 0x701.
+# A DriveCycle pre-generates a value for every PID at every step of a
+# session from a set of signal profiles, and pre-encodes the matching
+# DDE reply, so the emulator only has to index an array to answer. Values
+# are raw PID counts, as they appear on the bus.
+#
+# EchoChecker watches the module's requests and echoes and compares each
+# echoed value with the one that was current when the request went out.
+# If the module asked more than once since the previous echo (it gives up
+# on a slow reply and asks again), the echo may answer any of those
+# requests.
+# For every echo it also reports how stale the value is: zero if it is
+# still current when echoed, otherwise how long ago it stopped being
+# current.
+#
+# The cycle repeats if the session outlasts it.
+#
+
+import threading
+import time
+
+import numpy as np
+
+import can
+from messages import MSG_module_dde_status, MSG_module_dde_gear
+
+# (PID, echo field name, reply size) in dde_setup_req order
+SETUP_PIDS = (
+    (b'\x07\x72', 'hfm_air_temp', 2),
+    (b'\x07\x6f', 'charge_air_temp', 2),
+    (b'\x04\x34', 'exhaust_temp', 2),
+    (b'\x07\x6d', 'boost_pressure', 2),
+    (b'\x0e\xa6', 'current_gear', 1),
+    (b'\x06\x07', 'trans_oil_temp', 1),
+    (b'\x0a\x8d', 'oil_pressure_status', 1),
+)
+REPLY_HEADER = b'\x6c\x10'
+
+
+class Profile(object):
+    """a signal over time"""
+    def values(self, times, rng):
+        """values at each of times (seconds from the start of the cycle), as a float array"""
+        raise NotImplementedError
+
+    def __add__(self, other):
+        return Sum(self, other)
+
+
+class Constant(Profile):
+    def __init__(self, value):
+        self.value = value
+
+    def values(self, times, rng):
+        return np.full(len(times), float(self.value))
+
+
+class Ramp(Profile):
+    """start until begin, then linear to end over duration seconds, then end"""
+    def __init__(self, start, end, duration, begin=0.0):
+        self.start = start
+        self.end = end
+        self.duration = duration
+        self.begin = begin
+
+    def values(self, times, rng):
+        progress = np.clip((times - self.begin) / self.duration, 0.0, 1.0)
+        return self.start + (self.end - self.start) * progress
+
+
+class Steps(Profile):
+    """piecewise constant; steps is a sequence of (time, value), the first value also applies before its time"""
+    def __init__(self, steps):
+        self.times = np.array([when for when, _ in steps], dtype=float)
+        self.levels = np.array([value for _, value in steps], dtype=float)
+
+    def values(self, times, rng):
+        index = np.searchsorted(self.times, times, side='right') - 1
+        return self.levels[np.clip(index, 0, len(self.levels) - 1)]
+
+
+class Noise(Profile):
+    """gaussian noise with the given standard deviation, redrawn every sample"""
+    def __init__(self, sigma):
+        self.sigma = sigma
+
+    def values(self, times, rng):
+        return rng.normal(0.0, self.sigma, len(times))
+
+
+class Trace(Profile):
+    """a recorded trace, linearly interpolated and held at its ends"""
+    def __init__(self, times, values):
+        self.times = np.asarray(times, dtype=float)
+        self.levels = np.asarray(values, dtype=float)
+
+    @classmethod
+    def load(cls, path):
+        """read a two-column time,value CSV file; lines starting with # are ignored"""
+        data = np.loadtxt(path, delimiter=',', ndmin=2)
+        return cls(data[:, 0], data[:, 1])
+
+    def values(self, times, rng):
+        return np.interp(times, self.times, self.levels)
+
+
+class Sum(Profile):
+    def __init__(self, *profiles):
+        self.profiles = profiles
+
+    def values(self, times, rng):
+        return sum(profile.values(times, rng) for profile in self.profiles)
+
+
+# ten minutes of warm-up, a couple of pulls through the gears and a cruise
+DEFAULT_PROFILES = {
+    'hfm_air_temp': Ramp(0x1a3c, 0x2400, 600.0) + Noise(8),
+    'charge_air_temp': Ramp(0x2c34, 0x3800, 600.0) + Steps(((0, 0), (120, 0x400), (150, 0), (400, 0x600), (430, 0)))
+    + Noise(8),
+    'exhaust_temp': Ramp(0x0799, 0x2000, 300.0) + Steps(((0, 0), (120, 0x1800), (150, 0), (400, 0x2000), (430, 0)))
+    + Noise(40),
+    'boost_pressure': Constant(0x2a11) + Steps(((0, 0), (120, 0x3000), (150, 0x800), (400, 0x3800), (430, 0x800),
+                                                (500, 0))) + Noise(20),
+    'current_gear': Steps(((0, 0), (60, 1), (90, 2), (120, 3), (135, 4), (150, 5), (300, 4), (400, 3), (415, 4),
+                           (430, 5), (500, 3), (540, 1), (570, 0))),
+    'trans_oil_temp': Ramp(0x28, 0x78, 600.0),
+    'oil_pressure_status': Steps(((0, 1), (2, 0), (590, 1))),
+}
+
+
+class DriveCycle(object):
+    """
+    Pre-generated PID values.
+
+    profiles    dict of echo field name to Profile, overriding DEFAULT_PROFILES
+    duration    length of the cycle in seconds
+    step        seconds between value changes
+    clock       time source comparable with received message timestamps
+    """
+    def __init__(self, profiles=None, duration=600.0, step=0.05, seed=None, clock=time.time):
+        profiles = dict(DEFAULT_PROFILES, **(profiles or {}))
+        rng = np.random.default_rng(seed)
+        self.step = step
+        self.clock = clock
+        self.origin = None
+        self.times = np.arange(0.0, duration, step)
+        self.values = dict()
+        for _, name, size in SETUP_PIDS:
+            raw = np.rint(profiles[name].values(self.times, rng))
+            self.values[name] = np.clip(raw, 0, (1 << (8 * size)) - 1).astype('>u2' if size == 2 else 'u1')
+
+        # every reply, encoded once
+        replies = np.zeros(len(self.times), dtype=[('header', 'S2')] +
+                           [(name, '>u2' if size == 2 else 'u1') for _, name, size in SETUP_PIDS])
+        replies['header'] = REPLY_HEADER
+        for _, name, _ in SETUP_PIDS:
+            replies[name] = self.values[name]
+        self._replies = replies.view(np.uint8).reshape(len(self.times), replies.dtype.itemsize)
+
+    def __len__(self):
+        return len(self.times)
+
+    def start(self, origin=None):
+        """begin the cycle at origin, or now"""
+        self.origin = self.clock() if origin is None else origin
+
+    def sample(self, timestamp):
+        """number of the sample current at timestamp, counting from the start and not wrapped"""
+        return max(0, int((timestamp - self.origin) // self.step))
+
+    def sample_end(self, sample):
+        """time at which sample stops being current"""
+        return self.origin + (sample + 1) * self.step
+
+    def value(self, name, sample):
+        return int(self.values[name][sample % len(self)])
+
+    def reply(self, timestamp=None):
+        """the DDE reply to dde_setup_req or dde_repeat_req at timestamp, or now"""
+        if timestamp is None:
+            timestamp = self.clock()
+        return self._replies[self.sample(timestamp) % len(self)].tobytes()
+
+    def last_sample_with(self, name, value, sample, lookback):
+        """the most recent sample at or before sample, within lookback samples, with value; or None"""
+        first = max(0, sample - lookback)
+        candidates = np.arange(first, sample + 1)
+        found = np.flatnonzero(self.values[name][candidates % len(self)] == value)
+        return int(candidates[found[-1]]) if len(found) else None
+
+
+class EchoStats(object):
+    """echo checks for one PID"""
+    def __init__(self):
+        self.checked = 0
+        self.mismatched = 0
+        self.unexplained = 0
+        self.staleness = list()
+
+    def __str__(self):
+        text = f'{self.checked} echoes, {self.mismatched} not as requested, {self.unexplained} unexplained'
+        if self.staleness:
+            p50, p99, worst = np.percentile(self.staleness, (50, 99, 100), method='inverted_cdf') * 1000
+            text += f', stale p50 {p50:.1f}ms p99 {p99:.1f}ms max {worst:.1f}ms'
+        return text
+
+
+class EchoChecker(can.Listener):
+    """
+    Streaming check of the module's 0x700 / 0x701 echo against a DriveCycle.
+
+    Must see the module's requests to the DDE as well as the echo. An echoed
+    value that matches none of the values current in the lookback seconds
+    before the echo is counted as unexplained.
+    """
+    REQUEST_ID = 0x6f1
+    DDE_ID = 0x12
+
+    def __init__(self, interface, drive_cycle, lookback=2.0):
+        self._drive_cycle = drive_cycle
+        self._lookback = max(1, int(round(lookback / drive_cycle.step)))
+        self._lock = threading.Lock()
+        self._requests = list()
+        self._first_half = None
+        self.stats = {name: EchoStats() for _, name, _ in SETUP_PIDS}
+        self.echoes = 0
+        self.unanswered = 0
+        self.unrequested = 0
+        interface.add_listener(self)
+
+    def on_message_received(self, message):
+        arbid = message.arbitration_id
+        if arbid == self.REQUEST_ID:
+            # single or first frame of a request to the DDE
+            if message.dlc >= 2 and message.data[0] == self.DDE_ID and (message.data[1] >> 4) in (0, 1):
+                with self._lock:
+                    self._requests.append(message.timestamp)
+        elif arbid == MSG_module_dde_status._arbid:
+            self._first_half = MSG_module_dde_status._match(message)
+        elif arbid == MSG_module_dde_gear._arbid:
+            second_half = MSG_module_dde_gear._match(message)
+            if self._first_half is not None and second_half is not None:
+                self._check(message.timestamp, dict(self._first_half, **second_half))
+            self._first_half = None
+
+    def _check(self, timestamp, fields):
+        with self._lock:
+            requests = [when for when in self._requests if when <= timestamp]
+            self._requests = self._requests[len(requests):]
+            self.echoes += 1
+            if not requests:
+                self.unrequested += 1
+                return
+            self.unanswered += len(requests) - 1
+            cycle = self._drive_cycle
+            requested = [cycle.sample(when) for when in requests]
+            echoed = cycle.sample(timestamp)
+            for _, name, _ in SETUP_PIDS:
+                stats = self.stats[name]
+                value = fields[name]
+                stats.checked += 1
+                if all(value != cycle.value(name, sample) for sample in requested):
+                    stats.mismatched += 1
+                sample = cycle.last_sample_with(name, value, echoed, self._lookback)
+                if sample is None:
+                    stats.unexplained += 1
+                elif sample == echoed:
+                    stats.staleness.append(0.0)
+                else:
+                    stats.staleness.append(timestamp - cycle.sample_end(sample))
+
+    def report(self):
+        lines = [f'{self.echoes} echoes, {self.unanswered} requests not echoed, '
+                 f'{self.unrequested} echoes without a request']
+        for _, name, _ in SETUP_PIDS:
+            lines.append(f'  {name}: {self.stats[name]}')
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+    from interface import Interface
+    from dde import DDE
+
+    def profile_arg(text):
+        name, _, path = text.partition('=')
+        return name, Trace.load(path)
+
+    parser = argparse.ArgumentParser(description='E36 tail module DDE drive cycle and echo check')
+    parser.add_argument('--interface-channel',
+                        type=str,
+                        metavar='CHANNEL',
+                        help='interface channel name (e.g. for Anagate units, hostname:portname')
+    parser.add_argument('--bitrate',
+                        type=int,
+                        default=500,
+                        metavar='BITRATE_KBPS',
+                        help='CAN bitrate (kBps')
+    parser.add_argument('--interface',
+                        type=str,
+                        choices=Interface.BACKENDS,
+                        default='anagate',
+                        help='CAN interface backend')
+    parser.add_argument('--firmware',
+                        action='store_true',
+                        help='check the firmware model on a simulated bus instead of an interface')
+    parser.add_argument('--duration',
+                        type=float,
+                        default=600.0,
+                        metavar='SECONDS',
+                        help='length of the session')
+    parser.add_argument('--step',
+                        type=float,
+                        default=0.05,
+                        metavar='SECONDS',
+                        help='time between value changes')
+    parser.add_argument('--seed',
+                        type=int,
+                        metavar='SEED',
+                        help='random seed for noise')
+    parser.add_argument('--trace',
+                        type=profile_arg,
+                        action='append',
+                        default=list(),
+                        metavar='NAME=CSV',
+                        help='replace the profile for a value with a recorded time,value trace (may be repeated)')
+
+    args = parser.parse_args()
+    args.no_periodic = False
+    unknown = [name for name, _ in args.trace if name not in DEFAULT_PROFILES]
+    if unknown:
+        parser.error(f'unknown value {unknown[0]}, expected one of {", ".join(DEFAULT_PROFILES)}')
+    if args.firmware:
+        from firmware import simulated
+
+        interface, _, clock = simulated()
+    else:
+        if args.interface_channel is None:
+            parser.error('--interface-channel is required unless --firmware is given')
+        interface = Interface(args)
+        clock = time.time
+
+    drive_cycle = DriveCycle(dict(args.trace), duration=args.duration, step=args.step, seed=args.seed, clock=clock)
+    checker = EchoChecker(interface, drive_cycle)
+    dde = DDE(interface, args, drive_cycle=drive_cycle)
+    drive_cycle.start()
+    interface.set_power_on()
+    try:
+        interface.sleep(args.duration)
+    except KeyboardInterrupt:
+        pass
+    interface.set_power_off()
+    print(checker.report())
@@ -3,60 +3,129 @@
 # EGS emulator
 #
 
+import os
+import re
+
 import can
-from messages import MessageError, MSG_EGS_PID_request, MSG_EGS_PID_response
+from cyclic import CyclicScheduler
+from interface import id_filters
+from messages import MSG_EGS_gear, MSG_EGS_PID_request, MSG_EGS_PID_response
+
+README = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'README.md')
+
+# values reported until changed
+DEFAULT_VALUES = {
+    0x01: 0x43,         # oil temperature, ambient
+    0x0c: 0xae,         # ~14V
+    0x18: 0x01,         # P
+}
+
+
+def load_pids(path=README):
+    """parse (pid_id, response length, description) from the EGS PIDs table in the README"""
+    pids = list()
+    in_table = False
+    with open(path) as f:
+        for line in f:
+            if line.startswith('#'):
+                in_table = line.strip() == '### EGS PIDs'
+                continue
+            match = re.match(r'\s*(0x[0-9a-fA-F]+)\s*\|\s*([A-Z][A-Z ]*?)\s*\|\s*(.*)', line) if in_table else None
+            if match is not None:
+                pids.append((int(match.group(1), 16), len(match.group(2).split()), match.group(3).strip()))
+    return pids
 
 
 class PID(object):
+    """an EGS parameter and its encoded response frame, built when first needed"""
+    __slots__ = ('pid_id', 'length', 'description', '_value', '_response')
 
-    pids = dict()
-
-    def __init__(self, pid_id, reply_len, initial_value=0):
-        self._pid_id = pid_id
-        self._reply_len = reply_len
-        self._value = initial_value
-        self.pids[pid_id] = self
+    def __init__(self, pid_id, length=1, description='', value=0):
+        self.pid_id = pid_id
+        self.length = length
+        self.description = description
+        self._value = value
+        self._response = None
 
     @property
     def value(self):
-        val = bytearray(2)
-        if self._reply_len == 1:
-            pack_into('>B', val, 0, self._value)
-        elif self._reply_len == 2:
-            pack_into('>H', val, 0, self._value)
-        return val
-
-    @classmethod
-    def matching(cls, pid_id):
-        try:
-            return cls.pids[pid_id]
-        except KeyError:
-            return None
+        return self._value
 
+    @value.setter
+    def value(self, value):
+        if value != self._value:
+            self._value = value
+            self._response = None
 
-EGS_ACTUAL_GEAR = PID(0x0a, 1)
-EGS_SELECTED_GEAR = PID(0x18, 1)
-EGS_SUPPLY_VOLTAGE = PID(0x0c, 1)
-EGS_OIL_TEMPERATURE = PID(0x01, 1)
+    @property
+    def response(self):
+        if self._response is None:
+            self._response = MSG_EGS_PID_response.message(pid_id=self.pid_id, pid_value=self._value)
+        return self._response
 
 
 class EGS(can.Listener):
-    def __init__(self, interface):
+    # selected gear codes as sent in 0x1d2
+    GEAR_D = 120
+    GEAR_N = 180
+    GEAR_R = 210
+    GEAR_P = 225
+
+    GEAR_PERIOD = 0.1
+
+    # selected gear PID (0x18) values for each 0x1d2 gear code
+    SELECTED_GEAR_PID = {GEAR_P: 0x01, GEAR_R: 0x02, GEAR_N: 0x04, GEAR_D: 0x08}
+
+    def __init__(self, interface, cyclic=None, selected_gear=GEAR_P, pids=None):
+        """
+        The selected gear is broadcast from cyclic if supplied (the caller
+        starts it), otherwise from a scheduler of our own.
+
+        pids is a list of PID objects to answer for, by default those in
+        the README.
+        """
         self._interface = interface
-        self._interface.add_listener(self)
+        if pids is None:
+            pids = [PID(pid_id, length, description, DEFAULT_VALUES.get(pid_id, 0))
+                    for pid_id, length, description in load_pids()]
+        self.pids = {pid.pid_id: pid for pid in pids}
+        self.requests = 0
+        self.unknown_requests = 0
+        self._cyclic = cyclic if cyclic is not None else CyclicScheduler(interface)
+        self._cyclic.add(MSG_EGS_gear._arbid, self.GEAR_PERIOD,
+                         MSG_EGS_gear.message(selected_gear=selected_gear), phase=0.03)
+        if cyclic is None:
+            self._cyclic.start()
+        self._interface.add_listener(self, filters=id_filters(MSG_EGS_PID_request))
+
+    def select_gear(self, selected_gear):
+        self._cyclic.set_payload(MSG_EGS_gear._arbid, MSG_EGS_gear.message(selected_gear=selected_gear))
+        if selected_gear in self.SELECTED_GEAR_PID and 0x18 in self.pids:
+            self.pids[0x18].value = self.SELECTED_GEAR_PID[selected_gear]
+
+    def set_value(self, pid_id, value):
+        """set a PID value, adding the PID if it is not in the table"""
+        pid = self.pids.get(pid_id)
+        if pid is None:
+            self.pids[pid_id] = PID(pid_id, value=value)
+        else:
+            pid.value = value
 
     def on_message_received(self, message):
-        try:
-            fields = MSG_EGS_PID_request.unpack(message)
-        except MessageError:
+        # match MSG_EGS_PID_request by hand; this is the hot path
+        data = message.data
+        if (message.arbitration_id != MSG_EGS_PID_request._arbid or
+                message.dlc < 4 or
+                data[0] != 0x18 or
+                data[1] != 0x02 or
+                data[2] != 0x21):
             return
-        # one we know?
-        pid = PID.matching(fields['pid_id'])
+        self.requests += 1
+        pid = self.pids.get(data[3])
         if pid is None:
+            self.unknown_requests += 1
             return
-        # construct reply & send
-        rsp = MSG_EGS_PID_response.with_fields(pid_id=fields['pid_id'], pid_value=pid.value)
-        self._interface.send(rsp)
+        self._interface.send(pid.response)
 
 
 if __name__ == '__main__':
@@ -75,13 +144,34 @@ if __name__ == '__main__':
                         default=500,
                         metavar='BITRATE_KBPS',
                         help='CAN bitrate (kBps')
+    parser.add_argument('--interface',
+                        type=str,
+                        choices=Interface.BACKENDS,
+                        default='anagate',
+                        help='CAN interface backend')
+    parser.add_argument('--time-scale',
+                        type=float,
+                        default=1.0,
+                        metavar='FACTOR',
+                        help='run periodic traffic and delays FACTOR times faster than real time')
+
+    parser.add_argument('--pid',
+                        type=lambda x: [int(v, 0) for v in x.split('=')],
+                        action='append',
+                        default=[],
+                        metavar='PID=VALUE',
+                        help='set (or add) a PID value (may be repeated)')
 
     args = parser.parse_args()
     try:
         egs = EGS(Interface(args))
+        for pid_id, value in args.pid:
+            egs.set_value(pid_id, value)
 
         print(f'EGS @ {args.interface_channel}')
+        for pid in egs.pids.values():
+            print(f'  {pid.pid_id:#04x} = {pid.value:#04x}  {pid.description}')
         while True:
             time.sleep(1.0)
     except KeyboardInterrupt:
-        pass
+        print(f'{egs.requests} requests, {egs.unknown_requests} for unknown PIDs')
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+#
+# Fault transition log.
+#
+# MSG_status_faults repeats the module's whole fault state every
+# CAN_REPORT_INTERVAL_DIAGS: a byte per output and a system byte, each
+# with the current faults in the low nibble and the latched faults in
+# the high nibble, as the monitor's Fault widget decodes them. A
+# FaultTracker compares each report with the previous one and only
+# produces an event when a bit changes, so an overnight soak leaves a
+# few kilobytes of fault history rather than every repeated frame.
+#
+# Events are appended to the log as one line each:
+#
+#   <timestamp> <source> <fault> <current|latched> <set|clear>
+#
+# where source is the output number (1-4, as on the monitor) or SYS.
+# The state before the first report is taken to be fault-free, so the
+# first report logs whatever is already set. Summary counters are
+# appended as comment lines when the log is closed.
+#
+
+import time
+from collections import Counter, namedtuple
+
+import can
+from interface import id_filters
+from messages import MSG_status_faults
+
+OUTPUT_FAULTS = ('OPEN', 'STUCK', 'OVERLOAD')
+SYSTEM_FAULTS = ('T15', 'CAN', 'TEMP')
+SYSTEM = 'SYS'
+
+# byte offsets in MSG_status_faults
+OUTPUT_OFFSETS = (0, 1, 2, 3)
+SYSTEM_OFFSET = 7
+
+
+class FaultEvent(namedtuple('FaultEvent', ('timestamp', 'source', 'fault', 'kind', 'edge'))):
+    """one fault bit changing state"""
+    __slots__ = ()
+
+    def __str__(self):
+        return f'{self.timestamp:.3f} {self.source} {self.fault} {self.kind} {self.edge}'
+
+    @classmethod
+    def parse(cls, line):
+        timestamp, source, fault, kind, edge = line.split()
+        return cls(float(timestamp), source, fault, kind, edge)
+
+
+def _fault_name(names, bit):
+    return names[bit] if bit < len(names) else f'FAULT{bit}'
+
+
+class FaultTracker(can.Listener):
+    """
+    Turn fault status reports into FaultEvents.
+
+    Each event is passed to emit as it is found. Reports that repeat the
+    previous one are dismissed with a single comparison.
+    """
+    def __init__(self, interface, emit):
+        self._emit = emit
+        self._last = bytes(8)
+        self.reports = 0
+        interface.add_listener(self, filters=id_filters(MSG_status_faults))
+
+    def on_message_received(self, message):
+        data = message.data
+        if message.arbitration_id != MSG_status_faults._arbid or message.dlc != 8 or message.is_extended_id:
+            return
+        self.reports += 1
+        if data == self._last:
+            return
+        last = self._last
+        self._last = bytes(data)
+        for offset, source, names in ([(offset, str(index + 1), OUTPUT_FAULTS)
+                                       for index, offset in enumerate(OUTPUT_OFFSETS)] +
+                                      [(SYSTEM_OFFSET, SYSTEM, SYSTEM_FAULTS)]):
+            changed = data[offset] ^ last[offset]
+            bit = 0
+            while changed:
+                if changed & 1:
+                    self._emit(FaultEvent(message.timestamp,
+                                          source,
+                                          _fault_name(names, bit % 4),
+                                          'current' if bit < 4 else 'latched',
+                                          'set' if data[offset] & (1 << bit) else 'clear'))
+                changed >>= 1
+                bit += 1
+
+
+class FaultLog(object):
+    """
+    Append-only fault event log with summary counters.
+
+    path may be None to only count. counts is keyed by (source, fault,
+    kind, edge).
+    """
+    def __init__(self, path=None, echo=None):
+        self._file = open(path, 'a') if path is not None else None
+        self._echo = echo
+        self.counts = Counter()
+        self.events = 0
+        self.first = None
+        self.last = None
+        if self._file is not None:
+            self._file.write(f'# opened {time.strftime("%Y-%m-%dT%H:%M:%S")}\n')
+            self._file.flush()
+
+    def __call__(self, event):
+        self.events += 1
+        self.counts[event[1:]] += 1
+        if self.first is None:
+            self.first = event.timestamp
+        self.last = event.timestamp
+        if self._file is not None:
+            self._file.write(f'{event}\n')
+            # events are rare, so every one is made durable
+            self._file.flush()
+        if self._echo is not None:
+            self._echo(event)
+
+    @classmethod
+    def load(cls, path):
+        """re-count the events in an existing log"""
+        log = cls()
+        with open(path) as f:
+            for line in f:
+                if line.strip() and not line.startswith('#'):
+                    log(FaultEvent.parse(line))
+        return log
+
+    def summary(self):
+        """one line per fault that changed, with how often it was set and cleared"""
+        lines = [f'{self.events} fault events']
+        faults = sorted({(source, fault, kind) for source, fault, kind, _ in self.counts})
+        for source, fault, kind in faults:
+            lines.append(f'  {source:<3} {fault:<8} {kind:<7} '
+                         f'set {self.counts[(source, fault, kind, "set")]} '
+                         f'clear {self.counts[(source, fault, kind, "clear")]}')
+        return '\n'.join(lines)
+
+    def close(self, reports=None):
+        """append the summary counters as comments and close the log"""
+        if self._file is None:
+            return
+        summary = self.summary()
+        if reports is not None:
+            summary += f'\n{reports} status reports'
+        self._file.write(''.join(f'# {line}\n' for line in summary.split('\n')))
+        self._file.close()
+        self._file = None
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    from interface import Interface
+
+    parser = argparse.ArgumentParser(description='E36 tail module fault transition log')
+    parser.add_argument('--interface-channel',
+                        type=str,
+                        metavar='CHANNEL',
+                        help='interface channel name (e.g. for Anagate units, hostname:portname')
+    parser.add_argument('--bitrate',
+                        type=int,
+                        default=500,
+                        metavar='BITRATE_KBPS',
+                        help='CAN bitrate (kBps')
+    parser.add_argument('--interface',
+                        type=str,
+                        choices=Interface.BACKENDS,
+                        default='anagate',
+                        help='CAN interface backend')
+    parser.add_argument('--log',
+                        type=str,
+                        metavar='PATH',
+                        help='append fault events to PATH')
+    parser.add_argument('--power',
+                        action='store_true',
+                        help='power the module on for the session')
+    parser.add_argument('--duration',
+                        type=float,
+                        metavar='SECONDS',
+                        help='stop after this long (default until interrupted)')
+    parser.add_argument('--summarize',
+                        type=str,
+                        metavar='PATH',
+                        help='print the summary of an existing log and exit')
+
+    args = parser.parse_args()
+    if args.summarize is not None:
+        print(FaultLog.load(args.summarize).summary())
+        sys.exit(0)
+    if args.interface_channel is None:
+        parser.error('--interface-channel is required')
+
+    interface = Interface(args)
+    log = FaultLog(args.log, echo=print)
+    tracker = FaultTracker(interface, log)
+    if args.power:
+        interface.set_power_on()
+    try:
+        if args.duration is not None:
+            interface.sleep(args.duration)
+        else:
+            while True:
+                interface.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+    if args.power:
+        interface.set_power_off()
+    log.close(tracker.reports)
+    print(log.summary())
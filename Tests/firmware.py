@@ -0,0 +1,774 @@
+#!/usr/bin/env python3
+#
+# Behavioural model of the tail module firmware.
+#
+# Mirrors the protothread main loop in Sources/tail-module.c on a
+# SimBus, with each protothread written as a generator: a bare
+# 'yield' is pt_yield, waiting on a condition is pt_wait, and
+# resetting / stopping the Protothread wrapper is pt_reset / pt_stop.
+# Intervals are read from Sources/config.h so the model follows the
+# firmware configuration.
+#
+# The model runs one main loop pass per simulated millisecond by
+# default (see passes_per_ms), and timers tick once per millisecond
+# as they do on the module. Analog inputs are not sampled and
+# averaged; monitor values are derived directly from the simulated
+# loads. Received frames pass through the model of the MSCAN acceptance
+# filter programmed in can.c (see mscan.py).
+#
+
+import can
+import os
+import re
+from collections import deque
+
+from mscan import AcceptanceFilter
+from simbus import SimBus
+
+CONFIG_H = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Sources', 'config.h')
+
+
+def load_config(path=CONFIG_H):
+    """parse the integer #defines from config.h"""
+    config = dict()
+    with open(path) as f:
+        for line in f:
+            match = re.match(r'\s*#define\s+(\w+)\s+(0x[0-9a-fA-F]+|\d+)\b', line)
+            if match is not None:
+                config[match.group(1)] = int(match.group(2), 0)
+    return config
+
+
+CONFIG = load_config()
+
+# receive acceptance filter as programmed by can_reinit()
+ACCEPTANCE_FILTER = AcceptanceFilter.load()
+
+# light_state_t
+LIGHT_OFF = 0
+LIGHT_ON = 1
+LIGHT_ALT = 2
+
+# output_id_t
+OUTPUT_BRAKE_L = 0
+OUTPUT_BRAKE_R = 1
+OUTPUT_TAILS = 2
+OUTPUT_RAINS = 3
+OUTPUT_COUNT = 4
+
+# output_fault_t
+OUT_FAULT_OPEN = 0
+OUT_FAULT_STUCK = 1
+OUT_FAULT_OVERLOAD = 2
+
+# system_fault_t
+SYS_FAULT_T15_PLAUSIBILITY = 0
+SYS_FAULT_CAN_TIMEOUT = 1
+SYS_FAULT_OVER_TEMPERATURE = 2
+
+# iso-tp.c
+ISO_TP_SUCCESS = 0
+ISO_TP_BUSY = 1
+ISO_TP_TIMEOUT = 2
+
+TP_SINGLE_FRAME = 0
+TP_FIRST_FRAME = 1
+TP_CONSECUTIVE_FRAME = 2
+TP_FLOW_CONTROL_FRAME = 3
+TP_FLOW_CONTINUE = 0
+
+# can.c
+CAN_BUF_COUNT = 8
+CAN_ID_CONSOLE = 0x1ffffffe
+
+# bmw_scanner.c
+ISO_DDE_ID = 0x12
+ISO_TIMEOUT = 100
+DDE_SETUP_REQUEST = bytes([0x2c, 0x10,
+                           0x07, 0x72, 0x07, 0x6f, 0x04, 0x34, 0x07, 0x6d,
+                           0x0e, 0xa6, 0x06, 0x07, 0x0a, 0x8d])
+DDE_REPEAT_REQUEST = bytes([0x2c, 0x10])
+DDE_RESPONSE_SIZE = 13
+
+# lights.c
+BRAKE_RESET_DELAY = 4000
+
+
+class Timer(object):
+    """firmware one-shot millisecond timer"""
+    __slots__ = ('delay_ms',)
+
+    def __init__(self):
+        self.delay_ms = 0
+
+    def reset(self, delay_ms):
+        self.delay_ms = delay_ms
+
+    @property
+    def expired(self):
+        return self.delay_ms == 0
+
+
+class Protothread(object):
+    """a protothread whose body is a generator function"""
+    def __init__(self, body, *args):
+        self._body = body
+        self._args = args
+        self.reset()
+
+    def reset(self):
+        self._thread = None
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def __call__(self):
+        if self._thread is None:
+            if not self.running:
+                return
+            self._thread = self._body(*self._args)
+        thread = self._thread
+        try:
+            next(thread)
+        except StopIteration:
+            # pt_abort resets the thread before returning, leaving it runnable
+            if self._thread is thread:
+                self._thread = None
+                self.running = False
+
+
+class OutputLoad(object):
+    """simulated load on a high-side output"""
+    def __init__(self, current_ma=1000):
+        self.current_ma = current_ma
+        self.open = False
+        self.stuck = False
+        self.overload = False
+
+    def voltage(self, pin_on, supply_mv):
+        return supply_mv if (pin_on or self.stuck) else 0
+
+    def current(self, pin_on):
+        if not (pin_on or self.stuck) or self.open:
+            return 0
+        if self.overload:
+            return 2 * CONFIG['SENSE_OVERLOAD_CURRENT']
+        return self.current_ma
+
+
+class TailModule(can.Listener):
+    """
+    Firmware model attached to a SimBus node.
+
+    The module runs while the bus power supply is on, and restarts from
+    a clean state each time power is applied.
+    """
+    def __init__(self, interface, passes_per_ms=1, config=CONFIG):
+        self._interface = interface
+        self._bus = interface.bus
+        self._config = config
+        self.passes_per_ms = passes_per_ms
+        self.accept_filter = ACCEPTANCE_FILTER
+
+        # simulated inputs
+        self.supply_mv = 12000
+        self.t15_mv = 12000
+        self.fuel_level_mv = 2500
+        self.loads = [OutputLoad() for _ in range(OUTPUT_COUNT)]
+
+        self.console = list()
+        self.output_observers = list()
+        self.main_loop_passes = 0
+        self.can_overflows = 0
+        self._events = list()
+        self._reset()
+
+        interface.add_listener(self)
+        self._bus.power.observers.append(self._power_changed)
+        if self._bus.power.is_on:
+            self._power_changed(True)
+
+    def _reset(self):
+        self._timers = list()
+        self._can_buf = deque()
+        self._can_buf_overflow = False
+        self._putchar_buf = bytearray()
+
+        self.fault_output = [0] * OUTPUT_COUNT
+        self.fault_system = 0
+        self.output_pin_state = 0
+        self.output_state = [0] * OUTPUT_COUNT
+        self.brake_light_requested = LIGHT_OFF
+        self.tail_light_requested = LIGHT_OFF
+        self.rain_light_requested = LIGHT_OFF
+        self.selected_gear = 0
+        self.bmw_display_gear = 0
+        self.dde_rx_buffer = bytearray(18)
+
+        self._tp_tx = dict(recipient=0, resid=0, sequence=0, timeout=self._timer(), buf=b'', pos=0,
+                           window_resid=0, interval_ms=0, interval=self._timer())
+        self._tp_rx = dict(sender=0, resid=0, buf=None, pos=0, timeout=self._timer(), sequence=0)
+
+        self.pt_can_listener = Protothread(self._can_listen)
+        self.pt_iso_tp = Protothread(self._iso_tp_sender)
+        self.pt_bmw_scanner = Protothread(self._bmw_scanner)
+        self.pt_can_report_state = Protothread(self._can_report_state)
+        self.pt_can_report_diags = Protothread(self._can_report_diags)
+        self.pt_brakes = Protothread(self._brake_thread)
+        self.pt_tails = Protothread(self._tails_thread)
+        self.pt_rains = Protothread(self._rains_thread)
+        self.pt_outputs = [Protothread(self._output_thread, output) for output in range(OUTPUT_COUNT)]
+        self._output_timers = [self._timer() for _ in range(OUTPUT_COUNT)]
+
+        self._can_idle_timer = self._timer()
+        self._can_report_state_timer = self._timer()
+        self._can_report_diags_timer = self._timer()
+        self._bmw_timeout = self._timer()
+        self._brake_timer = self._timer()
+        self._brake_reset_timer = self._timer()
+        self._tails_timer = self._timer()
+        self._rains_timer = self._timer()
+
+    def _timer(self):
+        timer = Timer()
+        self._timers.append(timer)
+        return timer
+
+    #
+    # Power, clock and main loop
+    #
+
+    def _power_changed(self, on):
+        for event in self._events:
+            event.cancel()
+        self._events = list()
+        if on:
+            self._reset()
+            self.print('E36 tail module')
+            self._events.append(self._bus.call_every(0.001, self._tick))
+            for index in range(1, self.passes_per_ms):
+                self._events.append(self._bus.call_every(0.001, self._main_loop,
+                                                         delay=(1 + index / self.passes_per_ms) / 1000))
+
+    @property
+    def powered(self):
+        return len(self._events) > 0
+
+    def _tick(self):
+        """TickTimer_OnInterrupt followed by the first main loop pass of the millisecond"""
+        for timer in self._timers:
+            if timer.delay_ms > 0:
+                timer.delay_ms -= 1
+        self._main_loop()
+
+    def _main_loop(self):
+        self.main_loop_passes += 1
+        self.pt_can_listener()
+        self.pt_iso_tp()
+        if self.pt_bmw_scanner.running:
+            self.pt_bmw_scanner()
+        self.pt_can_report_state()
+        self.pt_can_report_diags()
+        self.pt_brakes()
+        self.pt_tails()
+        self.pt_rains()
+        for pt_output in self.pt_outputs:
+            pt_output()
+
+    #
+    # CAN
+    #
+
+    def on_message_received(self, message):
+        """CAN1_OnFullRxBuffer / can_rx_message"""
+        if not self.powered:
+            return
+        if self.accept_filter is not None and not self.accept_filter(message):
+            return
+        if len(self._can_buf) >= CAN_BUF_COUNT:
+            self._can_buf_overflow = True
+            self.can_overflows += 1
+            return
+        if not message.is_remote_frame and not message.is_extended_id:
+            self._can_buf.append(message)
+
+    def can_send_blocking(self, arbid, data, extended=False):
+        self._interface.send(can.Message(arbitration_id=arbid,
+                                          is_extended_id=extended,
+                                          dlc=len(data),
+                                          data=bytes(data)))
+
+    def can_putchar(self, ch):
+        if ch == '\n':
+            ch = '\0'
+        self._putchar_buf.append(ord(ch))
+        if len(self._putchar_buf) == 8 or ch == '\0':
+            self.can_send_blocking(CAN_ID_CONSOLE, self._putchar_buf, extended=True)
+            self._putchar_buf = bytearray()
+
+    def print(self, text):
+        self.console.append(text)
+        for ch in text:
+            self.can_putchar(ch)
+        self.can_putchar('\n')
+
+    def _can_listen(self):
+        idle = self._can_idle_timer
+        idle.reset(self._config['CAN_IDLE_TIMEOUT'])
+
+        while True:
+            while self._can_buf:
+                message = self._can_buf[0]
+                data = message.data
+
+                idle.reset(self._config['CAN_IDLE_TIMEOUT'])
+                self.fault_clear_system(SYS_FAULT_CAN_TIMEOUT)
+
+                if self._can_buf_overflow:
+                    self._can_buf_overflow = False
+                    self.print('CAN OVERFLOW')
+
+                if message.arbitration_id == 0xa8 and message.dlc == 8:
+                    self.brake_light_request(LIGHT_ON if (data[7] & 0x20) else LIGHT_OFF)
+                elif message.arbitration_id == 0x21a and message.dlc == 3:
+                    self.tail_light_request(LIGHT_ON if (data[0] & 0x04) else LIGHT_OFF)
+                    self.rain_light_request(LIGHT_ON if (data[0] & 0x40) else LIGHT_OFF)
+                elif message.arbitration_id == 0x1d2:
+                    self.selected_gear = data[0]
+                elif message.arbitration_id == 0x6f1:
+                    self.pt_bmw_scanner.stop()
+                elif 0x600 <= message.arbitration_id < 0x6f0:
+                    self.iso_tp_can_rx(message.arbitration_id & 0xff, bytes(data).ljust(8, b'\0'))
+
+                self._can_buf.popleft()
+                yield
+
+            if idle.expired:
+                self.fault_set_system(SYS_FAULT_CAN_TIMEOUT)
+                self.brake_light_request(LIGHT_ALT)
+            yield
+
+    def _can_report_state(self):
+        timer = self._can_report_state_timer
+        while True:
+            timer.reset(self._config['CAN_REPORT_INTERVAL_STATE'])
+            while not timer.expired:
+                yield
+
+            fuel = self.fuel_level_mv
+            if fuel < 500:
+                fuel_pct = 0
+            elif fuel > 4500:
+                fuel_pct = 100
+            else:
+                fuel_pct = (fuel - 500) // 40
+            self.can_send_blocking(self._config['CAN_ID_STATE'],
+                                   bytes([fuel_pct, self.bmw_display_gear, 0, 0, 0, 0, 0, 0]))
+
+    def _can_report_diags(self):
+        timer = self._can_report_diags_timer
+        base = self._config['CAN_ID_DIAGS']
+        while True:
+            timer.reset(self._config['CAN_REPORT_INTERVAL_DIAGS'])
+            while not timer.expired:
+                yield
+
+            t15 = min(self.t15_mv, 0xffff)
+            self.can_send_blocking(base + 0,
+                                   bytes([0, 0, t15 >> 8, t15 & 0xff, 0,
+                                          (self.fuel_level_mv // 50) & 0xff,
+                                          self.output_pin_state,
+                                          ((1 if self.brake_light_requested else 0) |
+                                           (2 if self.tail_light_requested else 0) |
+                                           (4 if self.rain_light_requested else 0))]))
+            yield
+
+            voltages = [(self.output_voltage(output) // 100) & 0xff for output in range(OUTPUT_COUNT)]
+            currents = [(self.output_current(output) // 10) & 0xff for output in range(OUTPUT_COUNT)]
+            self.can_send_blocking(base + 1, bytes(voltages + currents))
+            yield
+
+            self.can_send_blocking(base + 2, bytes(self.fault_output + [0x11, 0x22, 0x33, self.fault_system]))
+
+    #
+    # ISO-TP
+    #
+
+    def iso_tp_send(self, recipient, timeout_ms, buf):
+        tx = self._tp_tx
+        if self.iso_tp_send_done() == ISO_TP_BUSY:
+            return ISO_TP_BUSY
+
+        if len(buf) <= 6:
+            frame = bytes([recipient, (TP_SINGLE_FRAME << 4) | len(buf)]) + bytes(buf).ljust(6, b'\0')
+            tx['resid'] = 0
+            tx['sequence'] = 0
+            tx['timeout'].reset(0)
+            tx['buf'] = b''
+        else:
+            frame = bytes([recipient, TP_FIRST_FRAME << 4, len(buf)]) + bytes(buf[:5])
+            tx['recipient'] = recipient
+            tx['resid'] = len(buf) - 5
+            tx['sequence'] = 1
+            tx['timeout'].reset(timeout_ms)
+            tx['buf'] = bytes(buf)
+            tx['pos'] = 5
+            tx['window_resid'] = 0
+            tx['interval_ms'] = 0
+
+        self.can_send_blocking(0x600 + self._config['ISO_TP_NODE_ID'], frame)
+        return ISO_TP_SUCCESS
+
+    def _iso_tp_tx_send_next(self):
+        tx = self._tp_tx
+        if ((self.iso_tp_send_done() == ISO_TP_BUSY) and
+                tx['interval'].expired and
+                (tx['window_resid'] > 0)):
+            frame = bytearray([tx['recipient'], (TP_CONSECUTIVE_FRAME << 4) | tx['sequence']])
+            tx['sequence'] = (tx['sequence'] + 1) & 0x0f
+            for _ in range(6):
+                if tx['resid'] > 0:
+                    frame.append(tx['buf'][tx['pos']])
+                    tx['pos'] += 1
+                    tx['resid'] -= 1
+                else:
+                    frame.append(0xff)
+            self.can_send_blocking(0x600 + self._config['ISO_TP_NODE_ID'], frame)
+            tx['window_resid'] -= 1
+            tx['interval'].reset(tx['interval_ms'])
+
+    def iso_tp_send_done(self):
+        tx = self._tp_tx
+        if tx['resid'] == 0:
+            return ISO_TP_SUCCESS
+        if not tx['timeout'].expired:
+            return ISO_TP_BUSY
+        tx['resid'] = 0
+        return ISO_TP_TIMEOUT
+
+    def iso_tp_recv(self, length, sender, timeout_ms, buf):
+        rx = self._tp_rx
+        ret = self.iso_tp_recv_done()
+        if ret == ISO_TP_BUSY:
+            return ret
+        rx['sender'] = sender
+        rx['resid'] = length
+        rx['buf'] = buf
+        rx['pos'] = 0
+        rx['timeout'].reset(timeout_ms)
+
+    def iso_tp_recv_done(self):
+        rx = self._tp_rx
+        if rx['resid'] == 0:
+            return ISO_TP_SUCCESS
+        if not rx['timeout'].expired:
+            return ISO_TP_BUSY
+        # as the firmware does, clears the transmit residual rather than the receive one
+        self._tp_tx['resid'] = 0
+        return ISO_TP_TIMEOUT
+
+    def _iso_tp_rx_store(self, data):
+        rx = self._tp_rx
+        for value in data:
+            if rx['resid'] == 0:
+                break
+            rx['buf'][rx['pos']] = value
+            rx['pos'] += 1
+            rx['resid'] -= 1
+
+    def iso_tp_can_rx(self, sender, data):
+        rx = self._tp_rx
+        tx = self._tp_tx
+        if data[0] != self._config['ISO_TP_NODE_ID']:
+            return
+        frame_type = data[1] >> 4
+
+        if frame_type == TP_FLOW_CONTROL_FRAME:
+            if ((self.iso_tp_send_done() == ISO_TP_BUSY) and
+                    (sender == tx['recipient']) and
+                    (tx['window_resid'] == 0) and
+                    ((data[1] & 0xf) == TP_FLOW_CONTINUE)):
+                tx['window_resid'] = data[2] if data[2] else 0xff
+                tx['interval_ms'] = data[3]
+                tx['interval'].reset(0)
+                self._iso_tp_tx_send_next()
+
+        elif frame_type == TP_SINGLE_FRAME:
+            if ((self.iso_tp_recv_done() == ISO_TP_BUSY) and
+                    (sender == rx['sender']) and
+                    ((data[1] & 0xf) == rx['resid'])):
+                self._iso_tp_rx_store(data[2:8])
+
+        elif frame_type == TP_FIRST_FRAME:
+            if ((self.iso_tp_recv_done() == ISO_TP_BUSY) and
+                    (sender == rx['sender']) and
+                    ((data[1] & 0xf) == 0) and
+                    (data[2] == rx['resid'])):
+                self._iso_tp_rx_store(data[3:8])
+                rx['sequence'] = 1
+                self.can_send_blocking(0x600 + self._config['ISO_TP_NODE_ID'],
+                                       bytes([rx['sender'], (TP_FLOW_CONTROL_FRAME << 4) | TP_FLOW_CONTINUE,
+                                              0x00, 1, 0, 0, 0, 0]))
+
+        elif frame_type == TP_CONSECUTIVE_FRAME:
+            if ((self.iso_tp_recv_done() == ISO_TP_BUSY) and
+                    (sender == rx['sender']) and
+                    ((data[1] & 0xf) == rx['sequence'])):
+                self._iso_tp_rx_store(data[2:8])
+                rx['sequence'] = (rx['sequence'] + 1) & 0x0f
+
+    def _iso_tp_sender(self):
+        self._tp_rx['resid'] = 1
+        while True:
+            if self.iso_tp_send_done() == ISO_TP_BUSY:
+                self._iso_tp_tx_send_next()
+            yield
+
+    #
+    # BMW scanner
+    #
+
+    def _bmw_scanner(self):
+        timeout = self._bmw_timeout
+        setup_sent = False
+
+        while True:
+            while not timeout.expired:
+                yield
+            timeout.reset(self._config['CAN_BMW_INTERVAL'])
+
+            self.iso_tp_recv(DDE_RESPONSE_SIZE, ISO_DDE_ID, ISO_TIMEOUT, self.dde_rx_buffer)
+            self.iso_tp_send(ISO_DDE_ID, ISO_TIMEOUT,
+                             DDE_REPEAT_REQUEST if setup_sent else DDE_SETUP_REQUEST)
+
+            while True:
+                yield
+                ret = self.iso_tp_recv_done()
+                if ret == ISO_TP_SUCCESS:
+                    break
+                if ret != ISO_TP_BUSY:
+                    # pt_abort
+                    self.pt_bmw_scanner.reset()
+                    return
+
+            arbid = self._config['CAN_ID_BMW']
+            for sent in range(2, DDE_RESPONSE_SIZE, 8):
+                self.can_send_blocking(arbid, self.dde_rx_buffer[sent:sent + 8])
+                arbid += 1
+                yield
+
+            if self.selected_gear == 120:
+                self.bmw_display_gear = self.dde_rx_buffer[10]
+            else:
+                self.bmw_display_gear = self.selected_gear
+
+            setup_sent = True
+
+    #
+    # Lights
+    #
+
+    def brake_light_request(self, state):
+        if state != self.brake_light_requested:
+            self.brake_light_requested = state
+            self.pt_brakes.reset()
+
+    def tail_light_request(self, state):
+        if state != self.tail_light_requested:
+            self.tail_light_requested = state
+            self.pt_tails.reset()
+
+    def rain_light_request(self, state):
+        if state != self.rain_light_requested:
+            self.rain_light_requested = state
+            self.pt_rains.reset()
+
+    def _delay(self, timer, ms):
+        """pt_delay"""
+        timer.reset(ms)
+        while not timer.expired:
+            yield
+
+    def _brake_thread(self):
+        timer = self._brake_timer
+
+        if self.brake_light_requested == LIGHT_OFF:
+            self.output_request(OUTPUT_BRAKE_L, False)
+            self.output_request(OUTPUT_BRAKE_R, False)
+            self._brake_reset_timer.reset(BRAKE_RESET_DELAY)
+
+        elif self.brake_light_requested == LIGHT_ON:
+            if self._brake_reset_timer.expired:
+                for left, right, ms in ((True, True, 200),
+                                        (False, True, 100),
+                                        (True, False, 100),
+                                        (False, True, 100),
+                                        (True, False, 100)):
+                    self.output_request(OUTPUT_BRAKE_L, left)
+                    self.output_request(OUTPUT_BRAKE_R, right)
+                    yield from self._delay(timer, ms)
+
+            self.output_request(OUTPUT_BRAKE_L, True)
+            self.output_request(OUTPUT_BRAKE_R, True)
+
+        elif self.brake_light_requested == LIGHT_ALT:
+            while True:
+                self.output_request(OUTPUT_BRAKE_L, False)
+                self.output_request(OUTPUT_BRAKE_R, True)
+                yield from self._delay(timer, 400)
+                self.output_request(OUTPUT_BRAKE_L, True)
+                self.output_request(OUTPUT_BRAKE_R, False)
+                yield from self._delay(timer, 400)
+
+    def _tails_thread(self):
+        timer = self._tails_timer
+        while self.tail_light_requested == LIGHT_ALT:
+            self.output_request(OUTPUT_TAILS, True)
+            yield from self._delay(timer, 150)
+            self.output_request(OUTPUT_TAILS, False)
+            yield from self._delay(timer, 150)
+            self.output_request(OUTPUT_TAILS, True)
+            yield from self._delay(timer, 150)
+            self.output_request(OUTPUT_TAILS, False)
+            yield from self._delay(timer, 2550)
+
+        self.output_request(OUTPUT_TAILS, self.tail_light_requested == LIGHT_ON)
+
+    def _rains_thread(self):
+        timer = self._rains_timer
+        self.output_request(OUTPUT_RAINS, False)
+        while self.rain_light_requested == LIGHT_ON:
+            self.output_request(OUTPUT_RAINS, True)
+            yield from self._delay(timer, 125)
+            self.output_request(OUTPUT_RAINS, False)
+            yield from self._delay(timer, 125)
+
+    #
+    # Outputs and faults
+    #
+
+    def output_voltage(self, output):
+        return self.loads[output].voltage(self.output_pin_state & (1 << output), self.supply_mv)
+
+    def output_current(self, output):
+        return self.loads[output].current(self.output_pin_state & (1 << output))
+
+    def output_control(self, output, on):
+        previous = self.output_pin_state
+        if on:
+            self.output_pin_state |= (1 << output)
+        else:
+            self.output_pin_state &= ~(1 << output)
+        if self.output_pin_state != previous:
+            for observer in self.output_observers:
+                observer(output, bool(on))
+
+    def output_request(self, output, on):
+        if self.output_state[output] != on:
+            self.output_state[output] = on
+            self.pt_outputs[output].reset()
+
+    def _output_thread(self, output):
+        config = self._config
+        timer = self._output_timers[output]
+
+        if not self.output_state[output]:
+            self.output_control(output, False)
+            self.fault_clear_output(output, OUT_FAULT_OPEN)
+            yield from self._delay(timer, config['SENSE_SETTLE_DELAY'])
+
+            while True:
+                yield
+                if self.output_voltage(output) < config['SENSE_STUCK_VOLTAGE']:
+                    self.fault_clear_output(output, OUT_FAULT_STUCK)
+                else:
+                    self.fault_set_output(output, OUT_FAULT_STUCK)
+                if self.output_current(output) < config['SENSE_OVERLOAD_CURRENT']:
+                    self.fault_clear_output(output, OUT_FAULT_OVERLOAD)
+                else:
+                    self.fault_set_output(output, OUT_FAULT_OVERLOAD)
+
+        else:
+            self.output_control(output, True)
+            self.fault_clear_output(output, OUT_FAULT_STUCK)
+            yield from self._delay(timer, config['SENSE_INRUSH_DELAY'])
+
+            while True:
+                yield
+                if self.output_current(output) > config['SENSE_OPEN_CURRENT']:
+                    self.fault_clear_output(output, OUT_FAULT_OPEN)
+                else:
+                    self.fault_set_output(output, OUT_FAULT_OPEN)
+                if self.output_current(output) < config['SENSE_OVERLOAD_CURRENT']:
+                    self.fault_clear_output(output, OUT_FAULT_OVERLOAD)
+                else:
+                    self.fault_set_output(output, OUT_FAULT_OVERLOAD)
+                    self.output_control(output, False)
+                    yield from self._delay(timer, config['SENSE_OVERLOAD_RETRY_INTERVAL'])
+                    self.output_control(output, True)
+
+    def fault_set_output(self, output, fault):
+        self.fault_output[output] |= (0x11 << fault)
+
+    def fault_clear_output(self, output, fault):
+        self.fault_output[output] &= ~(0x01 << fault)
+
+    def fault_set_system(self, fault):
+        self.fault_system |= (0x11 << fault)
+
+    def fault_clear_system(self, fault):
+        self.fault_system &= ~(0x01 << fault)
+
+
+def simulated(passes_per_ms=1, channel='sim'):
+    """
+    A TailModule on a fresh SimBus, as the --firmware option of the tools
+    uses it. Returns (interface, module, clock): the node to talk to the
+    module through, the model, and the simulated clock that
+    interface.sleep() advances.
+    """
+    bus = SimBus(channel=channel)
+    module = TailModule(bus.interface(), passes_per_ms=passes_per_ms)
+    interface = bus.interface()
+    return interface, module, interface.clock
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    from dde import DDE
+    from console import Console
+    from status import Status
+
+    parser = argparse.ArgumentParser(description='E36 tail module firmware model')
+    parser.add_argument('--duration',
+                        type=float,
+                        default=60.0,
+                        metavar='SECONDS',
+                        help='simulated time to run for')
+    parser.add_argument('--passes-per-ms',
+                        type=int,
+                        default=1,
+                        metavar='PASSES',
+                        help='firmware main loop passes per simulated millisecond')
+    parser.add_argument('--no-periodic',
+                        action='store_true',
+                        help='disable periodic DDE message emulation')
+
+    args = parser.parse_args()
+    bus = SimBus()
+    module = TailModule(bus.interface(), passes_per_ms=args.passes_per_ms)
+    interface = bus.interface()
+    dde = DDE(interface, args)
+    status = Status(interface)
+    console = Console(interface)
+
+    started = time.time()
+    interface.set_power_on()
+    interface.sleep(args.duration)
+    elapsed = time.time() - started
+    console.stop()
+
+    print(f'{args.duration:.1f}s simulated in {elapsed:.2f}s, {bus.frame_count} frames')
+    print(f'{status}')
@@ -1,55 +1,602 @@
 #
 # PythonCAN interface shim.
 #
-# Assumes we are talking to an AnaGate CAN X-something
-# with digital output 1 wired to control power on the
-# module.
+# By default, assumes we are talking to an AnaGate CAN X-something
+# with digital output 1 wired to control power on the module.
+#
+# The 'virtual' backend uses an in-process python-can virtual bus
+# instead; every Interface opened on the same channel name sees the
+# traffic of the others, and module power is a simulated supply,
+# shared by every Interface on the channel, that just records
+# transitions (see virtual_bench.py for a module to put behind it).
+#
+# expect() waits for a frame matching an exact frame, masked bytes, a
+# MessageFormat (optionally with a predicate on its fields) or any
+# predicate; outstanding waiters are indexed by arbitration ID so that
+# each received frame is only tested against those for its own ID.
+#
+# Listeners may be given python-can filters; once every listener has
+# some, their union is applied to the bus so that the driver drops
+# traffic nobody is interested in.
+#
+# AsyncInterface offers the same backends to asyncio code.
 #
 
+import asyncio
+import threading
 import time
+from concurrent.futures import Future, InvalidStateError, TimeoutError as FutureTimeoutError
+
 import can
 
+from messages import MessageFormat
+from scheduler import Scheduler
+
 
 class ModuleError(Exception):
     pass
 
 
+class AnaGatePower(object):
+    """module power switched by AnaGate digital output 1"""
+    def __init__(self, bus):
+        self._bus = bus
+
+    def set_power_on(self):
+        self._bus.connection.set_analog_out(1, 12000)
+
+    def set_power_off(self):
+        self._bus.connection.set_analog_out(1, 0)
+
+
+class SimulatedPower(object):
+    """
+    stand-in supply for the virtual backends; records (timestamp, on) transitions
+    and calls any observers with the new state
+    """
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self.is_on = False
+        self.transitions = list()
+        self.observers = list()
+
+    def _set(self, state):
+        if state != self.is_on:
+            self.is_on = state
+            self.transitions.append((self._clock(), state))
+            for observer in self.observers:
+                observer(state)
+
+    def set_power_on(self):
+        self._set(True)
+
+    def set_power_off(self):
+        self._set(False)
+
+
+BACKENDS = ('anagate', 'virtual')
+
+# simulated supplies for the virtual backend, keyed by channel
+_virtual_power = dict()
+
+
+def virtual_power(channel):
+    """the simulated supply for a virtual channel"""
+    power = _virtual_power.get(channel)
+    if power is None:
+        power = _virtual_power[channel] = SimulatedPower()
+    return power
+
+
+def open_bus(args):
+    """open the bus and power control for the backend selected by args"""
+    backend = getattr(args, 'interface', 'anagate')
+    if backend == 'anagate':
+        bus = can.ThreadSafeBus(interface='anagate',
+                                channel=args.interface_channel,
+                                bitrate=args.bitrate * 1000)
+        return bus, AnaGatePower(bus)
+    if backend == 'virtual':
+        bus = can.ThreadSafeBus(interface='virtual',
+                                channel=args.interface_channel,
+                                bitrate=args.bitrate * 1000)
+        return bus, virtual_power(args.interface_channel)
+    raise ModuleError(f'unsupported interface backend {backend}')
+
+
+def id_filters(*msg_classes):
+    """python-can filters passing exactly the IDs of the given MessageFormat classes"""
+    return [{'can_id': msg_class._arbid,
+             'can_mask': 0x1fffffff if msg_class._extended else 0x7ff,
+             'extended': bool(msg_class._extended)}
+            for msg_class in msg_classes]
+
+
+def _normalize_filters(filters):
+    """a list of python-can filters, or None for everything; accepts anything with a can_filters() method"""
+    if filters is None:
+        return None
+    if hasattr(filters, 'can_filters'):
+        filters = filters.can_filters()
+    return list(filters)
+
+
+class FilteredListener(can.Listener):
+    """
+    Passes a listener only the frames accepted by its python-can style
+    filters. The decision is cached per ID, so each frame costs one dict
+    lookup.
+    """
+    def __init__(self, listener, filters):
+        self.listener = listener
+        self.filters = filters
+        self._accepted = dict()
+
+    def _matches(self, arbid, extended):
+        for entry in self.filters:
+            if 'extended' in entry and entry['extended'] != extended:
+                continue
+            if (arbid ^ entry['can_id']) & entry['can_mask'] == 0:
+                return True
+        return False
+
+    def on_message_received(self, message):
+        key = (message.arbitration_id, message.is_extended_id)
+        accepted = self._accepted.get(key)
+        if accepted is None:
+            accepted = self._accepted[key] = self._matches(*key)
+        if accepted:
+            self.listener.on_message_received(message)
+
+    def stop(self):
+        self.listener.stop()
+
+
 class Interface(object):
+    BACKENDS = BACKENDS
+    EXPECT_MARGIN = 0.5
+
     def __init__(self, args):
-        self._power_on = False
-        self.bus = can.ThreadSafeBus(interface='anagate',
-                                     channel=args.interface_channel,
-                                     bitrate=args.bitrate * 1000)
-        self.notifier = can.Notifier(self.bus, [])
+        self.time_scale = getattr(args, 'time_scale', 1.0)
+        self.bus, self.power = open_bus(args)
+        self._expectations = Expectations()
+        self._listeners = dict()
+        # (arbid, extended) or None for any ID -> number of expectations waiting on it
+        self._expected_keys = dict()
+        self._filter_lock = threading.Lock()
+        self._bus_filters = None
+        self.notifier = can.Notifier(self.bus, [self._expectations])
+        self._scheduler = None
+
+    def scaled(self, seconds):
+        """convert a nominal duration into wall-clock seconds"""
+        return seconds / self.time_scale
 
-    def add_listener(self, listener):
-        self.notifier.add_listener(listener)
+    def clock(self):
+        """current time in nominal seconds, for measuring intervals"""
+        return time.perf_counter() * self.time_scale
+
+    def sleep(self, seconds):
+        """sleep for a nominal duration"""
+        time.sleep(self.scaled(seconds))
+
+    def add_listener(self, listener, filters=None):
+        """
+        Add a listener, optionally with python-can filters (or anything with
+        a can_filters() method, such as mscan.AcceptanceFilter) limiting the
+        frames it is given. A listener without filters gets every frame.
+
+        Once every listener has filters, their union is pushed down to the
+        bus as can_filters so that frames nobody wants are dropped by the
+        driver; recv() then only sees frames that pass.
+        """
+        filters = _normalize_filters(filters)
+        delivered = listener if filters is None else FilteredListener(listener, filters)
+        self._listeners[listener] = (filters, delivered)
+        self.notifier.add_listener(delivered)
+        self._update_filters()
+
+    def remove_listener(self, listener):
+        _, delivered = self._listeners.pop(listener)
+        self.notifier.remove_listener(delivered)
+        self._update_filters()
+
+    @property
+    def listeners(self):
+        return list(self._listeners)
+
+    def _update_filters(self):
+        """push the union of the listeners' filters, plus any expected IDs, down to the bus"""
+        with self._filter_lock:
+            combined = list()
+            for filters, _ in self._listeners.values():
+                if filters is None:
+                    combined = None
+                    break
+                combined.extend(filters)
+            if combined is not None:
+                if None in self._expected_keys:
+                    combined = None
+                else:
+                    combined.extend({'can_id': arbid, 'can_mask': 0x1fffffff if extended else 0x7ff,
+                                     'extended': extended}
+                                    for arbid, extended in sorted(self._expected_keys))
+            if combined == self._bus_filters or not (combined or self._bus_filters):
+                return
+            self._bus_filters = combined
+            # bypass ThreadSafeBus, whose receive lock is held by the notifier while it waits for a frame
+            getattr(self.bus, '__wrapped__', self.bus).set_filters(combined)
 
     def send(self, message):
         return self.bus.send(message)
 
     def send_periodic(self, message, interval):
-        return self.bus.send_periodic(message, interval)
+        return self.bus.send_periodic(message, self.scaled(interval))
+
+    def call_later(self, delay, callback):
+        """run callback on the scheduler thread after a nominal delay"""
+        if self._scheduler is None:
+            self._scheduler = Scheduler(name=f'scheduler-{self.bus.channel_info}')
+        return self._scheduler.call_later(self.scaled(delay), callback)
 
     def recv(self, timeout):
         """
         wait for a message
         """
         now = time.time()
-        deadline = now + timeout
+        deadline = now + self.scaled(timeout)
         while time.time() < deadline:
             message = self.bus.recv(timeout=deadline - time.time())
             if message is not None:
                 return message
 
+    def expect_later(self, pattern, timeout=1.0):
+        """
+        Start waiting for a message matching pattern (see match_spec) and
+        return a concurrent.futures.Future that resolves to it, or to None
+        after timeout. Any number of expectations may be outstanding; each
+        received frame is only tested against those for its own ID. If the
+        pattern raises, the future carries the exception.
+        """
+        spec = match_spec(pattern)
+        with self._filter_lock:
+            waiting = self._expected_keys.get(spec.key, 0)
+            self._expected_keys[spec.key] = waiting + 1
+        if not waiting:
+            # widen the bus filters to let the frame through, until the last waiter for it is done
+            self._update_filters()
+        future = self._expectations.expect(spec, timeout, self.call_later)
+        future.add_done_callback(lambda _: self._expect_done(spec.key))
+        return future
+
+    def _expect_done(self, key):
+        with self._filter_lock:
+            waiting = self._expected_keys[key] - 1
+            if waiting:
+                self._expected_keys[key] = waiting
+            else:
+                del self._expected_keys[key]
+        if not waiting:
+            self._update_filters()
+
+    def expect(self, pattern, timeout=1.0):
+        """wait for a message matching pattern and return it, or None on timeout"""
+        future = self.expect_later(pattern, timeout)
+        try:
+            # the scheduler normally resolves the future at the timeout; don't depend on it to return
+            return future.result(self.scaled(timeout) + self.EXPECT_MARGIN)
+        except FutureTimeoutError:
+            _resolve(future, None)
+            return future.result()
+
     def set_power_on(self):
-        self.bus.connection.set_analog_out(1, 12000)
+        self.power.set_power_on()
 
     def set_power_off(self):
-        self.bus.connection.set_analog_out(1, 0)
+        self.power.set_power_off()
 
     def __del__(self):
         try:
             self.notifier.stop()
         except AttributeError:
             pass
+
+
+class Exact(object):
+    """expect() spec: a frame with the same ID and data as message"""
+    __slots__ = ('key', 'data')
+
+    def __init__(self, message):
+        self.key = (message.arbitration_id, message.is_extended_id)
+        self.data = bytes(message.data)
+
+    def __call__(self, message):
+        return message.data == self.data
+
+
+class Masked(object):
+    """expect() spec: a frame whose leading data bytes, ANDed with mask, equal data ANDed with mask"""
+    __slots__ = ('key', '_length', '_mask', '_value')
+
+    def __init__(self, arbitration_id, data, mask, is_extended_id=False):
+        self.key = (arbitration_id, is_extended_id)
+        self._length = len(mask)
+        self._mask = int.from_bytes(mask, 'big')
+        self._value = int.from_bytes(bytes(data)[:len(mask)].ljust(len(mask), b'\0'), 'big') & self._mask
+
+    def __call__(self, message):
+        return ((len(message.data) >= self._length) and
+                (int.from_bytes(message.data[:self._length], 'big') & self._mask) == self._value)
+
+
+class Fields(object):
+    """
+    expect() spec: a frame conforming to a MessageFormat whose view, if
+    predicate is supplied, satisfies it
+    """
+    __slots__ = ('key', '_msg_class', '_predicate')
+
+    def __init__(self, msg_class, predicate=None):
+        self.key = None if msg_class._arbid is None else (msg_class._arbid, msg_class._extended)
+        self._msg_class = msg_class
+        self._predicate = predicate
+
+    def __call__(self, message):
+        if self.key is None and message.is_extended_id != self._msg_class._extended:
+            return False
+        view = self._msg_class.view(message)
+        return view is not None and (self._predicate is None or self._predicate(view))
+
+
+class Predicate(object):
+    """expect() spec: any frame for which function returns true; tested against every frame"""
+    __slots__ = ('key', '_function')
+
+    def __init__(self, function):
+        self.key = None
+        self._function = function
+
+    def __call__(self, message):
+        return self._function(message)
+
+
+def match_spec(pattern):
+    """
+    Convert an expect() pattern to a spec: a can.Message is matched exactly,
+    a MessageFormat subclass by Fields, a spec is used as is and any other
+    callable is a Predicate.
+    """
+    if isinstance(pattern, (Exact, Masked, Fields, Predicate)):
+        return pattern
+    if isinstance(pattern, can.Message):
+        return Exact(pattern)
+    if isinstance(pattern, type) and issubclass(pattern, MessageFormat):
+        return Fields(pattern)
+    return Predicate(pattern)
+
+
+def _resolve(future, result):
+    """complete a concurrent future unless something else got there first"""
+    try:
+        future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+class Expectations(can.Listener):
+    """
+    Outstanding expect() waiters.
+
+    Waiters are indexed by (arbitration ID, extended), so a received frame
+    is only tested against the waiters for its own ID plus any that cannot
+    be keyed (predicates, formats without a fixed ID). Frames are observed,
+    not consumed.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_key = dict()
+        self._unkeyed = list()
+
+    def add(self, spec, deliver, fail=None):
+        """
+        Call deliver(message) once, for the first frame matching spec; returns
+        a handle for remove(). If spec raises, the waiter is withdrawn and
+        fail(exception) called instead; without fail the frame is treated as
+        not matching.
+        """
+        entry = (spec, deliver, fail)
+        with self._lock:
+            if spec.key is None:
+                self._unkeyed.append(entry)
+            else:
+                self._by_key.setdefault(spec.key, list()).append(entry)
+        return entry
+
+    def _discard(self, entry):
+        """withdraw a waiter with the lock held; true if it was still outstanding"""
+        key = entry[0].key
+        entries = self._unkeyed if key is None else self._by_key.get(key, ())
+        if entry not in entries:
+            return False
+        entries.remove(entry)
+        if key is not None and not entries:
+            del self._by_key[key]
+        return True
+
+    def remove(self, entry):
+        """withdraw a waiter, if it is still outstanding"""
+        with self._lock:
+            self._discard(entry)
+
+    def __len__(self):
+        return len(self._unkeyed) + sum(len(entries) for entries in self._by_key.values())
+
+    def on_message_received(self, message):
+        key = (message.arbitration_id, message.is_extended_id)
+        if key not in self._by_key and not self._unkeyed:
+            return
+        with self._lock:
+            candidates = self._by_key.get(key, []) + self._unkeyed
+        # specs may be user code: test them without the lock, and never let them raise into the notifier
+        outcomes = list()
+        for entry in candidates:
+            try:
+                if entry[0](message):
+                    outcomes.append((entry, None))
+            except Exception as error:
+                if entry[2] is not None:
+                    outcomes.append((entry, error))
+        if not outcomes:
+            return
+        with self._lock:
+            # a waiter is only completed by whoever withdraws it
+            outcomes = [outcome for outcome in outcomes if self._discard(outcome[0])]
+        for (_, deliver, fail), error in outcomes:
+            if error is None:
+                deliver(message)
+            else:
+                fail(error)
+
+    def expect(self, pattern, timeout, call_later):
+        """
+        Return a concurrent.futures.Future for the next frame matching
+        pattern (see match_spec). It resolves to None if no such frame
+        arrives within timeout, which call_later measures.
+        """
+        future = Future()
+        expiry = None
+
+        def deliver(message):
+            if expiry is not None:
+                expiry.cancel()
+            _resolve(future, message)
+
+        def fail(error):
+            if expiry is not None:
+                expiry.cancel()
+            try:
+                future.set_exception(error)
+            except InvalidStateError:
+                pass
+
+        def expire():
+            self.remove(entry)
+            _resolve(future, None)
+
+        entry = self.add(match_spec(pattern), deliver, fail)
+        expiry = call_later(timeout, expire)
+        return future
+
+
+class AsyncPeriodicTask(object):
+    """periodic send coroutine, API-compatible with python-can cyclic tasks"""
+    def __init__(self, interface, message, period):
+        self._interface = interface
+        self._message = message
+        self.period = period
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while True:
+            self._interface.send(self._message)
+            deadline += self._interface.scaled(self.period)
+            await asyncio.sleep(max(0, deadline - loop.time()))
+
+    def modify_data(self, message):
+        self._message = message
+
+    def stop(self):
+        self._task.cancel()
+
+
+class AsyncInterface(object):
+    """
+    asyncio flavour of Interface.
+
+    Must be constructed from a coroutine; listeners are called from the
+    event loop, so emulators and coroutines share one thread.
+    """
+    BACKENDS = BACKENDS
+
+    def __init__(self, args):
+        self.time_scale = getattr(args, 'time_scale', 1.0)
+        self.bus, self.power = open_bus(args)
+        self._loop = asyncio.get_running_loop()
+        self._reader = can.AsyncBufferedReader()
+        self._expectations = Expectations()
+        self._listeners = dict()
+        self.notifier = can.Notifier(self.bus, [self._reader, self._expectations], loop=self._loop)
+
+    def scaled(self, seconds):
+        """convert a nominal duration into wall-clock seconds"""
+        return seconds / self.time_scale
+
+    def clock(self):
+        """current time in nominal seconds, for measuring intervals"""
+        return time.perf_counter() * self.time_scale
+
+    async def sleep(self, seconds):
+        """sleep for a nominal duration"""
+        await asyncio.sleep(self.scaled(seconds))
+
+    def add_listener(self, listener, filters=None):
+        """see Interface.add_listener; filters are applied per listener and not pushed down"""
+        filters = _normalize_filters(filters)
+        delivered = listener if filters is None else FilteredListener(listener, filters)
+        self._listeners[listener] = delivered
+        self.notifier.add_listener(delivered)
+
+    def remove_listener(self, listener):
+        self.notifier.remove_listener(self._listeners.pop(listener))
+
+    @property
+    def listeners(self):
+        return list(self._listeners)
+
+    def send(self, message):
+        return self.bus.send(message)
+
+    def send_periodic(self, message, interval):
+        return AsyncPeriodicTask(self, message, interval)
+
+    def call_later(self, delay, callback):
+        """run callback on the event loop after a nominal delay"""
+        return self._loop.call_later(self.scaled(delay), callback)
+
+    async def recv(self, timeout):
+        """
+        wait for the next message
+        """
+        try:
+            return await asyncio.wait_for(self._reader.get_message(), self.scaled(timeout))
+        except asyncio.TimeoutError:
+            return None
+
+    async def expect(self, pattern, timeout):
+        """
+        Wait for a message matching pattern (see match_spec) and return it, or
+        None on timeout. Messages are observed rather than taken from the recv
+        queue, so concurrent expectations do not steal from each other.
+        """
+        future = self._loop.create_future()
+        entry = self._expectations.add(match_spec(pattern),
+                                       lambda message: future.done() or future.set_result(message),
+                                       lambda error: future.done() or future.set_exception(error))
+        try:
+            return await asyncio.wait_for(future, self.scaled(timeout))
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._expectations.remove(entry)
+
+    async def set_power_on(self):
+        await self._loop.run_in_executor(None, self.power.set_power_on)
+
+    async def set_power_off(self):
+        await self._loop.run_in_executor(None, self.power.set_power_off)
+
+    def shutdown(self):
+        self.notifier.stop()
+        self.bus.shutdown()
@@ -1,34 +1,293 @@
 #
-# Simple ISO-TP framer.
+# ISO-TP engine for the BMW 0x6xx extended-addressing scheme.
+#
+# Frames are sent with arbitration ID 0x600 + sender and the recipient
+# address in the first data byte. Any number of transfers may be in
+# progress at once; each is a session keyed by (sender, recipient).
+#
+# The engine is event-driven: frames are handled as the Notifier
+# delivers them, consecutive frames are released by the interface's
+# scheduler at the STmin the receiver asked for, and N_Bs / N_Cr
+# timeouts are scheduler callbacks. The first consecutive frame after a
+# flow-control frame is released by the scheduler too, so the Notifier
+# thread never sends on behalf of a transfer. How late each consecutive
+# frame went out relative to its STmin is kept in tx_lateness.
 #
 
+import threading
+
 import can
-import time
-from threading import Thread
+from messages import (MSG_ISO_TP_single, MSG_ISO_TP_initial, MSG_ISO_TP_consecutive,
+                      MSG_ISO_TP_flow_continue)
+from scheduler import Lateness
+
+TYPE_SINGLE = 0x0
+TYPE_FIRST = 0x1
+TYPE_CONSECUTIVE = 0x2
+TYPE_FLOW = 0x3
+
+FLOW_CONTINUE = 0x0
+FLOW_WAIT = 0x1
+FLOW_ABORT = 0x2
+
+MAX_LENGTH = 0xfff
+
+
+def st_min_seconds(st_min):
+    """decode an STmin byte"""
+    if st_min <= 0x7f:
+        return st_min / 1000
+    if 0xf1 <= st_min <= 0xf9:
+        return (st_min - 0xf0) / 10000
+    # reserved values are to be treated as the maximum
+    return 0.127
 
 
-class ISOTP(BufferedReader):
+class TXSession(object):
+    def __init__(self, sender, recipient, data, on_done):
+        self.sender = sender
+        self.recipient = recipient
+        self.data = bytes(data)
+        self.offset = 0
+        self.sequence = 1
+        self.block_remaining = 0
+        self.st_min = 0
+        self.waiting_flow = True
+        self.timer = None
+        self.on_done = on_done
+
+
+class RXSession(object):
+    def __init__(self, sender, recipient, length, data, timestamp):
+        self.sender = sender
+        self.recipient = recipient
+        self.length = length
+        self.data = bytearray(data)
+        self.timestamp = timestamp
+        self.sequence = 1
+        self.block_count = 0
+        self.timer = None
+
+
+class ISOTP(can.Listener):
     """
-    ISO-TP framer
+    ISO-TP engine.
+
+    interface   Interface-like object with send() and call_later()
+    node_ids    local addresses to accept transfers for
+    receiver    called as receiver(sender, recipient, data, timestamp) for each
+                completed inbound message, timestamp being that of its single or
+                first frame
+    block_size  block size advertised in our flow-control frames, 0 for no limit
+    st_min      STmin byte advertised in our flow-control frames
+    n_bs        seconds to wait for a flow-control frame
+    n_cr        seconds to wait for a consecutive frame
     """
-    def __init__(self, interface, receiver, id_filter):
-        super().__init__()
-        interface.add_listener(self)
-        self._send_queue = SimpleQueue()
+    def __init__(self, interface, node_ids, receiver,
+                 block_size=0, st_min=1, n_bs=1.0, n_cr=1.0, padding=0xff):
+        self._interface = interface
+        self._node_ids = frozenset(node_ids)
         self._receiver = receiver
-        self._id_filter = id_filter
-        self._thread = Thread(target=self._thread_main, name="iso-tp", daemon=True)
-        self._thread.start()
-        self._reassembly = dict()
-
-    def _thread_main(self):
-        while True:
-            message = self.get_message(0.1)
-            if message is not None and message.arbitration_id in self._id_filter
-                self._thread_recv(message)
-                continue
-            time.sleep(0.1)
-            pass
-
-    def _thread_recv(self, message):
-        
\ No newline at end of file
+        self._block_size = block_size
+        self._st_min = st_min
+        self._n_bs = n_bs
+        self._n_cr = n_cr
+        self._padding = padding
+        self._lock = threading.RLock()
+        self._tx_sessions = dict()
+        self._rx_sessions = dict()
+        self.stats = {
+            'rx_messages': 0,
+            'tx_messages': 0,
+            'rx_sequence_errors': 0,
+            'rx_timeouts': 0,
+            'tx_timeouts': 0,
+            'tx_aborts': 0,
+        }
+        self.tx_lateness = Lateness()
+        interface.add_listener(self, filters=[{'can_id': 0x600, 'can_mask': 0x700, 'extended': False}])
+
+    #
+    # Transmit
+    #
+
+    def send(self, sender, recipient, data, on_done=None):
+        """
+        Start sending data from sender to recipient, replacing any transfer
+        already in progress between them. on_done(ok) is called when the
+        transfer completes or fails.
+        """
+        if len(data) > MAX_LENGTH:
+            raise ValueError(f'ISO-TP payload too long ({len(data)} bytes)')
+        if len(data) <= 6:
+            self._interface.send(MSG_ISO_TP_single.message(sender=sender,
+                                                           recipient=recipient,
+                                                           data=bytes(data)))
+            self.stats['tx_messages'] += 1
+            if on_done is not None:
+                on_done(True)
+            return
+
+        session = TXSession(sender, recipient, data, on_done)
+        session.offset = 5
+        with self._lock:
+            self._tx_end(self._tx_sessions.get((sender, recipient)), False)
+            self._tx_sessions[(sender, recipient)] = session
+            session.timer = self._interface.call_later(self._n_bs, lambda: self._tx_timeout(session))
+            self._interface.send(MSG_ISO_TP_initial.message(sender=sender,
+                                                            recipient=recipient,
+                                                            data=session.data))
+
+    def _tx_end(self, session, ok):
+        if session is None:
+            return
+        if session.timer is not None:
+            session.timer.cancel()
+            session.timer = None
+        if self._tx_sessions.get((session.sender, session.recipient)) is session:
+            del self._tx_sessions[(session.sender, session.recipient)]
+        if ok:
+            self.stats['tx_messages'] += 1
+        if session.on_done is not None:
+            session.on_done(ok)
+
+    def _tx_timeout(self, session):
+        with self._lock:
+            if self._tx_sessions.get((session.sender, session.recipient)) is session:
+                self.stats['tx_timeouts'] += 1
+                session.timer = None
+                self._tx_end(session, False)
+
+    def _tx_flow(self, session, data):
+        if not session.waiting_flow:
+            return
+        flag = data[1] & 0xf
+        if session.timer is not None:
+            session.timer.cancel()
+            session.timer = None
+        if flag == FLOW_CONTINUE:
+            session.waiting_flow = False
+            session.block_remaining = data[2] if data[2] else None
+            session.st_min = st_min_seconds(data[3])
+            # consecutive frames are always released by the scheduler, never from the notifier thread
+            session.timer = self._interface.call_later(0, lambda: self._tx_next(session))
+        elif flag == FLOW_WAIT:
+            session.timer = self._interface.call_later(self._n_bs, lambda: self._tx_timeout(session))
+        else:
+            self.stats['tx_aborts'] += 1
+            self._tx_end(session, False)
+
+    def _tx_next(self, session):
+        """send one consecutive frame, then schedule the next or wait for flow control"""
+        with self._lock:
+            if self._tx_sessions.get((session.sender, session.recipient)) is not session:
+                return
+            lateness = getattr(session.timer, 'lateness', None)
+            if lateness is not None:
+                self.tx_lateness.record(lateness)
+            session.timer = None
+            chunk = session.data[session.offset:session.offset + 6]
+            session.offset += len(chunk)
+            message = MSG_ISO_TP_consecutive.message(sender=session.sender,
+                                                     recipient=session.recipient,
+                                                     sequence=session.sequence,
+                                                     data=chunk.ljust(6, bytes([self._padding])))
+            session.sequence = (session.sequence + 1) & 0xf
+            if session.block_remaining is not None:
+                session.block_remaining -= 1
+
+            # update session state before sending, as the reply may arrive before send() returns
+            done = session.offset >= len(session.data)
+            if not done and session.block_remaining == 0:
+                session.waiting_flow = True
+                session.timer = self._interface.call_later(self._n_bs, lambda: self._tx_timeout(session))
+            elif not done:
+                session.timer = self._interface.call_later(session.st_min, lambda: self._tx_next(session))
+            self._interface.send(message)
+            if done:
+                self._tx_end(session, True)
+
+    #
+    # Receive
+    #
+
+    def _rx_end(self, session):
+        if session is None:
+            return
+        if session.timer is not None:
+            session.timer.cancel()
+            session.timer = None
+        if self._rx_sessions.get((session.sender, session.recipient)) is session:
+            del self._rx_sessions[(session.sender, session.recipient)]
+
+    def _rx_timeout(self, session):
+        with self._lock:
+            if self._rx_sessions.get((session.sender, session.recipient)) is session:
+                self.stats['rx_timeouts'] += 1
+                session.timer = None
+                self._rx_end(session)
+
+    def _rx_complete(self, sender, recipient, data, timestamp):
+        self.stats['rx_messages'] += 1
+        self._receiver(sender, recipient, bytes(data), timestamp)
+
+    def _send_flow(self, session):
+        self._interface.send(MSG_ISO_TP_flow_continue.message(sender=session.recipient,
+                                                              recipient=session.sender,
+                                                              block_size=self._block_size,
+                                                              st_min=self._st_min))
+
+    def on_message_received(self, msg):
+        if (msg.is_extended_id or
+                (msg.arbitration_id & 0xf00) != 0x600 or
+                msg.dlc < 2 or
+                msg.data[0] not in self._node_ids):
+            return
+        sender = msg.arbitration_id & 0xff
+        recipient = msg.data[0]
+        data = msg.data
+        frame_type = data[1] >> 4
+
+        with self._lock:
+            if frame_type == TYPE_FLOW:
+                session = self._tx_sessions.get((recipient, sender))
+                if session is not None and msg.dlc >= 4:
+                    self._tx_flow(session, data)
+                return
+
+            key = (sender, recipient)
+            if frame_type == TYPE_SINGLE:
+                self._rx_end(self._rx_sessions.get(key))
+                length = data[1] & 0xf
+                self._rx_complete(sender, recipient, data[2:2 + length], msg.timestamp)
+
+            elif frame_type == TYPE_FIRST and msg.dlc == 8:
+                self._rx_end(self._rx_sessions.get(key))
+                length = ((data[1] & 0xf) << 8) | data[2]
+                session = RXSession(sender, recipient, length, data[3:8], msg.timestamp)
+                self._rx_sessions[key] = session
+                session.timer = self._interface.call_later(self._n_cr, lambda: self._rx_timeout(session))
+                self._send_flow(session)
+
+            elif frame_type == TYPE_CONSECUTIVE:
+                session = self._rx_sessions.get(key)
+                if session is None:
+                    return
+                if (data[1] & 0xf) != session.sequence:
+                    self.stats['rx_sequence_errors'] += 1
+                    self._rx_end(session)
+                    return
+                session.sequence = (session.sequence + 1) & 0xf
+                session.data += data[2:2 + min(6, session.length - len(session.data))]
+                if session.timer is not None:
+                    session.timer.cancel()
+                if len(session.data) >= session.length:
+                    session.timer = None
+                    self._rx_end(session)
+                    self._rx_complete(sender, recipient, session.data, session.timestamp)
+                    return
+                session.timer = self._interface.call_later(self._n_cr, lambda: self._rx_timeout(session))
+                session.block_count += 1
+                if self._block_size and session.block_count == self._block_size:
+                    session.block_count = 0
+                    self._send_flow(session)
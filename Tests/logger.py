@@ -0,0 +1,44 @@
+#
+# Log output for the monitor and test scripts.
+#
+# Lines may be logged from any thread. Without a window they are printed
+# immediately, to stdout or the given stream; with a curses window they
+# are queued and drawn by render(), which must be called from the thread
+# that owns the screen.
+#
+
+import time
+from collections import deque
+
+
+class Logger(object):
+    # lines beyond this many awaiting render() are discarded, oldest first
+    PENDING_LIMIT = 200
+
+    def __init__(self, win, args, stream=None):
+        self._win = win
+        self._stream = stream
+        self._pending = deque(maxlen=self.PENDING_LIMIT)
+        if win is not None:
+            win.scrollok(True)
+
+    def log(self, text):
+        line = f'{time.strftime("%H:%M:%S")} {text}'
+        if self._win is None:
+            print(line, file=self._stream, flush=self._stream is not None)
+        else:
+            self._pending.append(line)
+
+    def log_can(self, msg):
+        self.log(f'{msg}')
+
+    def render(self):
+        """draw queued lines; returns true if anything was drawn"""
+        if not self._pending:
+            return False
+        _, maxx = self._win.getmaxyx()
+        while self._pending:
+            line = self._pending.popleft()
+            self._win.addstr('\n' + line[:maxx - 1])
+        self._win.refresh()
+        return True
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import can
+import re
 import struct
 
 
@@ -30,20 +31,103 @@ class MessageFormat(object):
     _format = None
     _fields = None
 
-    def __init__(self, raw):
-        """parse a raw message, verify it conforms, and set attributes"""
-        raise RuntimeError('cannot instantiate')
-
-    @classmethod
-    def unpack(cls, message):
-        if cls._arbid is not None and message.arbitration_id != cls._arbid:
+    def __new__(cls, raw):
+        """
+        Return a view of a raw message, verifying that it conforms;
+        see view().
+        """
+        if cls._arbid is not None and raw.arbitration_id != cls._arbid:
             raise MessageError(f'arbitration id mismatch')
-        if cls._extended is not None and message.is_extended_id != cls._extended:
+        if cls._extended is not None and raw.is_extended_id != cls._extended:
             raise MessageError(f'arbitration id type mismatch')
-        expected_dlc = struct.calcsize(cls._format)
-        if message.dlc != expected_dlc:
-            raise MessageError(f'dlc mismatch')
+        view = cls.view(raw)
+        if view is None:
+            raise MessageError(f'dlc or required value mismatch')
+        return view
+
+    # registry of concrete formats keyed by (arbitration ID, extended), see decode()
+    _registry = dict()
+
+    def __init_subclass__(cls, **kwargs):
+        """compile the format and register the class for decode()"""
+        super().__init_subclass__(**kwargs)
+        cls._struct = struct.Struct(cls._format)
+        cls._offsets = cls._compile_offsets()
+        cls._checks = tuple((cls._offsets[key][0], cls._offsets[key][2], required_value)
+                            for key, required_value in cls._fields.items()
+                            if required_value is not None)
+        cls._view_class = type(f'{cls.__name__}_view', (MessageView,), {
+            '__slots__': (),
+            'format': cls,
+            **{key: MessageView._field(offset, field_struct)
+               for key, (offset, _, field_struct) in cls._offsets.items()
+               if not key.startswith('_')}
+        })
+        if cls._arbid is not None:
+            cls._registry.setdefault((cls._arbid, cls._extended), list()).append(cls)
+
+    @classmethod
+    def _compile_offsets(cls):
+        """map each key in _fields to (offset, size, struct for that field alone)"""
+        order = cls._format[0] if cls._format[0] in '@=<>!' else ''
+        prefix = order
+        offsets = dict()
+        keys = iter(cls._fields.keys())
+        for count, code in re.findall(r'(\d*)([a-zA-Z?])', cls._format[len(order):]):
+            if code == 'x':
+                prefix += count + code
+                continue
+            items = [count + code] if code == 's' else [code] * (int(count) if count else 1)
+            for item in items:
+                field_struct = struct.Struct(order + item)
+                offset = struct.calcsize(prefix + item) - field_struct.size
+                offsets[next(keys)] = (offset, field_struct.size, field_struct)
+                prefix += item
+        return offsets
+
+    @classmethod
+    def view(cls, message):
+        """
+        Return a MessageView of a message whose ID is already known to match,
+        or None if the DLC or a required value does not match. Fields are only
+        unpacked when they are read.
+        """
+        if message.dlc != cls._struct.size:
+            return None
+        data = memoryview(message.data)
+        for offset, field_struct, required_value in cls._checks:
+            if field_struct.unpack_from(data, offset)[0] != required_value:
+                return None
+        return cls._view_class(message, data)
 
+    @classmethod
+    def decode_view(cls, message):
+        """as decode(), but returns a MessageView (or None)"""
+        for candidate in cls._registry.get((message.arbitration_id, message.is_extended_id), ()):
+            view = candidate.view(message)
+            if view is not None:
+                return view
+        return None
+
+    @classmethod
+    def decode(cls, message):
+        """
+        Find the registered format matching a message and unpack it.
+
+        Returns a (class, values) tuple, or (None, None) if no registered
+        format matches the message.
+        """
+        for candidate in cls._registry.get((message.arbitration_id, message.is_extended_id), ()):
+            values = candidate._match(message)
+            if values is not None:
+                return candidate, values
+        return None, None
+
+    @classmethod
+    def _match(cls, message):
+        """unpack a message already known to have the right ID, or return None"""
+        if message.dlc != cls._struct.size:
+            return None
         values = {
             'arbitration_id': message.arbitration_id,
             'is_extended_id': message.is_extended_id,
@@ -51,15 +135,124 @@ class MessageFormat(object):
             'timestamp': message.timestamp,
             'data': message.data,
         }
-        for key, value in zip(cls._fields.keys(), struct.unpack(cls._format, message.data)):
-            required_value = cls._fields[key]
+        for (key, required_value), value in zip(cls._fields.items(), cls._struct.unpack(message.data)):
             if required_value is not None and required_value != value:
-                raise MessageError(f'required value {key} mismatch')
+                return None
             if not key.startswith('_'):
                 values[key] = value
 
         return values
 
+    @classmethod
+    def unpack(cls, message):
+        if cls._arbid is not None and message.arbitration_id != cls._arbid:
+            raise MessageError(f'arbitration id mismatch')
+        if cls._extended is not None and message.is_extended_id != cls._extended:
+            raise MessageError(f'arbitration id type mismatch')
+        if message.dlc != cls._struct.size:
+            raise MessageError(f'dlc mismatch')
+
+        values = cls._match(message)
+        if values is None:
+            raise MessageError(f'required value mismatch')
+        return values
+
+    # struct format codes and the corresponding numpy scalar kinds
+    _NUMPY_KINDS = {
+        'b': 'i1', 'B': 'u1', '?': 'b1',
+        'h': 'i2', 'H': 'u2',
+        'i': 'i4', 'I': 'u4', 'l': 'i4', 'L': 'u4',
+        'q': 'i8', 'Q': 'u8',
+        'e': 'f2', 'f': 'f4', 'd': 'f8',
+    }
+
+    @classmethod
+    def _numpy_dtype(cls):
+        """
+        Build a packed numpy dtype with one column per entry in _fields;
+        's' fields become arrays of bytes so that they index like the
+        unpacked bytes object.
+        """
+        import numpy as np
+
+        order = '>' if cls._format[0] in '>!' else '<'
+        columns = list()
+        keys = iter(cls._fields.keys())
+        for count, code in re.findall(r'(\d*)([a-zA-Z?])', cls._format):
+            count = int(count) if count else 1
+            if code == 's':
+                columns.append((next(keys), 'u1', (count,)))
+            else:
+                columns += [(next(keys), order + cls._NUMPY_KINDS[code], ()) for _ in range(count)]
+        return np.dtype(columns)
+
+    @classmethod
+    def unpack_many(cls, arbids, timestamps, data_matrix, dlcs=None, extended=None):
+        """
+        Decode a capture in bulk.
+
+        arbids, timestamps and (optionally) dlcs and extended are 1-D arrays with
+        one entry per frame, data_matrix is an (N, 8) uint8 array of frame payloads.
+
+        Called on a concrete format, returns a structured array with a 'timestamp'
+        column plus one column per public field, containing only the frames that
+        match the format. Called on MessageFormat itself, returns a dict of such
+        arrays keyed by every registered format.
+        """
+        import numpy as np
+
+        arbids = np.asarray(arbids)
+        timestamps = np.asarray(timestamps)
+        data_matrix = np.asarray(data_matrix, dtype=np.uint8)
+        if dlcs is not None:
+            dlcs = np.asarray(dlcs)
+        if extended is not None:
+            extended = np.asarray(extended, dtype=bool)
+
+        if cls is MessageFormat:
+            return {msg_class: msg_class._unpack_many(arbids, timestamps, data_matrix, dlcs, extended)
+                    for candidates in cls._registry.values()
+                    for msg_class in candidates}
+        return cls._unpack_many(arbids, timestamps, data_matrix, dlcs, extended)
+
+    @classmethod
+    def _unpack_many(cls, arbids, timestamps, data_matrix, dlcs, extended):
+        import numpy as np
+
+        raw_dtype = cls._numpy_dtype()
+        size = cls._struct.size
+
+        selected = np.ones(len(arbids), dtype=bool)
+        if cls._arbid is not None:
+            selected &= (arbids == cls._arbid)
+        if extended is not None and cls._extended is not None:
+            selected &= (extended == cls._extended)
+        if dlcs is not None:
+            selected &= (dlcs == size)
+
+        rows = np.ascontiguousarray(data_matrix[selected, :size])
+        raw = rows.view(raw_dtype).reshape(-1)
+
+        # apply the _fields filter column-wise
+        valid = np.ones(len(raw), dtype=bool)
+        for key, required_value in cls._fields.items():
+            if required_value is None:
+                continue
+            if isinstance(required_value, bytes):
+                required_value = np.frombuffer(required_value, dtype=np.uint8)
+                valid &= np.all(raw[key] == required_value, axis=1)
+            else:
+                valid &= (raw[key] == required_value)
+        raw = raw[valid]
+
+        public = [key for key in cls._fields.keys() if not key.startswith('_')]
+        result = np.empty(len(raw), dtype=[('timestamp', 'f8')] +
+                          [(key, raw_dtype.fields[key][0]) for key in public])
+        result['timestamp'] = timestamps[selected][valid]
+        for key in public:
+            result[key] = raw[key]
+        return result
+
     @classmethod
     def message(cls, **kwargs):
         """
@@ -81,12 +274,51 @@ class MessageFormat(object):
 
         return can.Message(arbitration_id=arbid,
                            is_extended_id=cls._extended,
-                           dlc=struct.calcsize(cls._format),
-                           data=struct.pack(cls._format, *arglist))
+                           dlc=cls._struct.size,
+                           data=cls._struct.pack(*arglist))
 
     @classmethod
-    def len(self):
-        return struct.calcsize(cls._format)
+    def len(cls):
+        return cls._struct.size
+
+
+class MessageView(object):
+    """
+    Read-only view of a received message. Each public field of the format
+    is an attribute that is unpacked from the message data when read;
+    format is the MessageFormat the message matched.
+    """
+    __slots__ = ('message', '_data')
+
+    format = None
+
+    def __init__(self, message, data):
+        self.message = message
+        self._data = data
+
+    @staticmethod
+    def _field(offset, field_struct):
+        unpack_from = field_struct.unpack_from
+        return property(lambda self: unpack_from(self._data, offset)[0])
+
+    @property
+    def timestamp(self):
+        return self.message.timestamp
+
+    @property
+    def arbitration_id(self):
+        return self.message.arbitration_id
+
+    @property
+    def data(self):
+        return self._data
+
+    def fields(self):
+        """all public fields as a dict"""
+        return {key: getattr(self, key) for key in self.format._fields if not key.startswith('_')}
+
+    def __repr__(self):
+        return f'<{self.format.__name__} {self.fields()}>'
 
 
 class MSG_DDE_torque_brake(MessageFormat):
@@ -195,8 +427,8 @@ class MSG_ack(MessageFormat):
 class MSG_status_system(MessageFormat):
     """module system status message"""
     _format = '>HHBBBB'
-    _arbid = 0x0f00000
-    _extended = True
+    _arbid = 0x720
+    _extended = False
     _fields = {
         '_0': 0,
         't15_voltage': None,
@@ -210,8 +442,8 @@ class MSG_status_system(MessageFormat):
 class MSG_status_voltage_current(MessageFormat):
     """module voltage/current report"""
     _format = '>4s4s'
-    _arbid = 0x0f00001
-    _extended = True
+    _arbid = 0x721
+    _extended = False
     _fields = {
         'output_voltage': None,
         'output_current': None,
@@ -221,8 +453,8 @@ class MSG_status_voltage_current(MessageFormat):
 class MSG_status_faults(MessageFormat):
     """module fault status report"""
     _format = '>4sBBBB'
-    _arbid = 0x0f00002
-    _extended = True
+    _arbid = 0x722
+    _extended = False
     _fields = {
         'output_faults': None,
         '_0': 0x11,
@@ -232,16 +464,41 @@ class MSG_status_faults(MessageFormat):
     }
 
 
+class MSG_module_state(MessageFormat):
+    """module state report for AiM unit"""
+    _format = '>BB6s'
+    _arbid = 0x710
+    _extended = False
+    _fields = {
+        'fuel_level': None,
+        'display_gear': None,
+        '_0': b'\0' * 6,
+    }
+
+
 class MSG_module_dde_status(MessageFormat):
-    """module-echoed DDE status for AiM unit"""
+    """module-echoed DDE status for AiM unit, first four values of dde_setup_req"""
     _format = '>HHHH'
     _arbid = 0x700
     _extended = False
     _fields = {
-        'fuel_temp': None,
-        'intake_temp': None,
+        'hfm_air_temp': None,
+        'charge_air_temp': None,
         'exhaust_temp': None,
-        'manifold_pressure': None,
+        'boost_pressure': None,
+    }
+
+
+class MSG_module_dde_gear(MessageFormat):
+    """module-echoed DDE status for AiM unit, remaining values of dde_setup_req"""
+    _format = '>BBB5s'
+    _arbid = 0x701
+    _extended = False
+    _fields = {
+        'current_gear': None,
+        'trans_oil_temp': None,
+        'oil_pressure_status': None,
+        '_0': None,         # tail of the module's receive buffer
     }
 
 
@@ -316,15 +573,11 @@ class MSG_EGS_PID_response(MessageFormat):
 
     @classmethod
     def message(cls, pid_id, pid_value):
-        if len(pid_value) == 1:
-            msglen = 5
-            value = pid_value + b'\0'
-        else:
-            msglen = 6
-            value = pid_value
-        return super().message(msglen=msglen,
-                               pid_id=pid_id,
-                               pid_value=value)
+        # EGS PIDs are all single bytes
+        if isinstance(pid_value, (bytes, bytearray)):
+            pid_value = pid_value[0]
+        return super().message(pid_id=pid_id,
+                               pid_value=pid_value)
 
 
 class MSG_ISO_TP_single(MessageFormat):
@@ -398,6 +651,8 @@ class MSG_ISO_TP_flow_continue(MessageFormat):
     }
 
     @classmethod
-    def message(cls, sender, recipient):
+    def message(cls, sender, recipient, block_size=0x00, st_min=0x01):
         return super().message(arbitration_id=0x600 + sender,
-                               recipient=recipient)
+                               recipient=recipient,
+                               _1=block_size,
+                               _2=st_min)
@@ -3,7 +3,10 @@
 import curses
 import time
 
+import can
 from messages import *
+from console import Console
+from cyclic import CyclicScheduler
 from logger import Logger
 
 # colours we use
@@ -12,9 +15,43 @@ GREEN = 2
 CYAN = 3
 
 
-class ModuleState(object):
+class Versioned(object):
+    """
+    Counts changes to each attribute, so that the renderer can tell which
+    widgets need redrawing. Attributes are written by the receive thread
+    and read by the renderer.
+    """
+    def __init__(self):
+        object.__setattr__(self, '_versions', dict())
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get(name, self) != value:
+            self._bump(name)
+        object.__setattr__(self, name, value)
+
+    def _bump(self, name):
+        self._versions[name] = self._versions.get(name, 0) + 1
+
+    def version(self, name):
+        return self._versions.get(name, 0)
+
+
+class ModuleState(Versioned, can.Listener):
+    """decodes module traffic on the notifier thread"""
+
+    # status reports and the attributes they are kept in
+    _sources = {
+        MSG_status_system: 'status_system',
+        MSG_status_voltage_current: 'status_v_i',
+        MSG_status_faults: 'status_faults',
+    }
+    _field_sources = {key: source
+                      for msg_class, source in _sources.items()
+                      for key in msg_class._fields
+                      if not key.startswith('_')}
 
     def __init__(self, win, logger):
+        super().__init__()
         self._win = win
         self._logger = logger
         self._can_in_timeout = False
@@ -25,35 +62,43 @@ class ModuleState(object):
         self._reset()
 
     def _reset(self):
+        for view in (self.__dict__.get('status_system'),
+                     self.__dict__.get('status_v_i'),
+                     self.__dict__.get('status_faults')):
+            for key in (view.format._fields if view is not None else ()):
+                self._bump(key)
         self.status_system = None
         self.status_v_i = None
         self.status_faults = None
 
+    def _update_fields(self, name, view):
+        """store a status view, bumping the version of each field whose bytes changed"""
+        previous = self.__dict__.get(name)
+        data = view.data
+        for key, (offset, size, _) in view.format._offsets.items():
+            if previous is None or previous.data[offset:offset + size] != data[offset:offset + size]:
+                self._bump(key)
+        object.__setattr__(self, name, view)
+
+    def on_message_received(self, msg):
+        self.update(msg)
+
     def update(self, msg):
         self.message_rx_count += 1
         self._can_in_timeout = False
-        try:
-            self.status_system = MSG_status_system(msg)
-            return
-        except MessageError:
-            pass
-        try:
-            self.status_v_i = MSG_status_voltage_current(msg)
-            return
-        except MessageError:
-            pass
-        try:
-            self.status_faults = MSG_status_faults(msg)
+        view = MessageFormat.decode_view(msg)
+        msg_class = view.format if view is not None else None
+        source = self._sources.get(msg_class)
+        if source is not None:
+            self._update_fields(source, view)
             return
-        except MessageError:
-            pass
-        try:
-            ack = MSG_ack(msg)
+        if msg_class is MSG_ack:
             self.module_resets += 1
             return
-        except MessageError:
-            pass
-        if msg.arbitration_id not in [0x349, 0x130, 0x6f1, 0x700]:
+        if msg.is_extended_id and msg.arbitration_id == 0x1ffffffe:
+            return
+        # diagnostic traffic (0x600 + sender) is ISO-TP, whose segments no fixed format describes
+        if view is None and (msg.is_extended_id or (msg.arbitration_id & 0xf00) != 0x600):
             self.message_errors += 1
             self._logger.log(f'CAN? {msg}')
 
@@ -66,12 +111,12 @@ class ModuleState(object):
         self.module_resets += 1
 
     def __getattr__(self, attrName):
-        for obj in [self.status_system, self.status_v_i, self.status_faults]:
-            try:
-                return getattr(obj, attrName)
-            except AttributeError:
-                pass
-        raise AttributeError
+        """status fields read from the most recent report that carries them"""
+        source = self._field_sources.get(attrName)
+        view = self.__dict__.get(source) if source is not None else None
+        if view is None:
+            raise AttributeError(attrName)
+        return getattr(view, attrName)
 
 
 class DispObj(object):
@@ -82,6 +127,7 @@ class DispObj(object):
         self._source = source
         self._propname = propname
         self._index = index
+        self._drawn_version = None
 
     @property
     def attr(self):
@@ -101,6 +147,15 @@ class DispObj(object):
     def draw(self):
         self._win.addstr(self._y, self._x, self.value, self.attr)
 
+    def refresh(self):
+        """redraw if the source field has changed since the last draw; returns true if drawn"""
+        version = self._source.version(self._propname)
+        if version == self._drawn_version:
+            return False
+        self.draw()
+        self._drawn_version = version
+        return True
+
 
 class MilliUnit(DispObj):
     def __init__(self, win, y, x, source, propname, index, suffix):
@@ -266,8 +321,9 @@ class Flag(DispObj):
         return '-' * len(self._label)
 
 
-class MonitorState(object):
+class MonitorState(Versioned):
     def __init__(self):
+        super().__init__()
         self.sw_t15 = False
         self.sw_brake = False
         self.sw_lights = False
@@ -298,11 +354,18 @@ class MonitorState(object):
 # Fault text is red if the fault is current, cyan if saved,
 # dashed out otherwise.
 #
+# The module state is decoded on the notifier thread as messages arrive;
+# this thread only handles keys and redraws widgets whose source field has
+# changed, at most args.max_fps times a second.
+#
+KEY_POLL_MS = 10
+
+
 def do_monitor(stdscr, interface, args):
 
     # monitor initialization
-    tx_phase = True
-    tx_time = time.time()
+    frame_interval = 1.0 / args.max_fps
+    next_frame = time.monotonic()
 
     monitor_state = MonitorState()
     if not args.no_CAN_at_start:
@@ -313,7 +376,7 @@ def do_monitor(stdscr, interface, args):
     # curses init
     curses.curs_set(False)
     curses.start_color()
-    stdscr.nodelay(True)
+    stdscr.timeout(KEY_POLL_MS)
     stdscr.clear()
     stdscr.refresh()
     curses.init_pair(RED, curses.COLOR_RED, curses.COLOR_BLACK)
@@ -346,8 +409,20 @@ def do_monitor(stdscr, interface, args):
     logwin = curses.newwin(maxy - 18, maxx, 19, 0)
     logger = Logger(logwin, args)
 
-    # create the module state tracker
+    # create the module state tracker and start receiving
     module_state = ModuleState(statwin, logger)
+    interface.add_listener(module_state)
+    console = Console(interface, emit=logger.log)
+
+    # brake and light messages, sent while the [C]AN switch is on
+    cyclic = CyclicScheduler(interface)
+    cyclic.add(MSG_DDE_torque_brake._arbid, 0.2,
+               lambda: MSG_DDE_torque_brake.message(monitor_state.sw_brake))
+    cyclic.add(MSG_lights._arbid, 0.2,
+               lambda: MSG_lights.message(False, monitor_state.sw_lights, monitor_state.sw_rain),
+               phase=0.1)
+    if monitor_state.sw_can:
+        cyclic.start()
 
     # create display widgets
     widgets = [
@@ -384,46 +459,89 @@ def do_monitor(stdscr, interface, args):
 
     # run the monitor loop
     while True:
-        statwin.refresh()
-        msg = interface.recv(0.1)
-        if msg is not None:
-            try:
-                logger.log_console(msg)
-            except KeyError:
-                logger.log_can(msg)
-                module_state.update(msg)
-
-        for widget in widgets:
-            widget.draw()
-
-        if monitor_state.sw_can and ((time.time() - tx_time) > 0.1):
-            if tx_phase:
-                msg = MSG_brake.with_fields(monitor_state.sw_brake)
+        now = time.monotonic()
+        if now >= next_frame:
+            drawn = False
+            for widget in widgets:
+                if widget.refresh():
+                    drawn = True
+            if drawn:
+                statwin.refresh()
+            logger.render()
+            next_frame = now + frame_interval
+
+        # waits up to KEY_POLL_MS for a key
+        ch = stdscr.getch()
+        if ch < 0:
+            continue
+        ch = chr(ch) if ch < 256 else ''
+        if ch == 't' or ch == 'T':
+            monitor_state.sw_t15 = not monitor_state.sw_t15
+            if monitor_state.sw_t15:
+                interface.set_power_on()
             else:
-                msg = MSG_lights.with_fields(False, monitor_state.sw_lights, monitor_state.sw_rain)
-                # msg = MSG_lights.with_fields(sw_brake, sw_lights, sw_rain)
-            logger.log_can(msg)
-            interface.send(msg)
-            tx_time = time.time()
-            tx_phase = not tx_phase
+                interface.set_power_off()
+        if ch == 'b' or ch == 'B':
+            monitor_state.sw_brake = not monitor_state.sw_brake
+        if ch == 'l' or ch == 'L':
+            monitor_state.sw_lights = not monitor_state.sw_lights
+        if ch == 'r' or ch == 'R':
+            monitor_state.sw_rain = not monitor_state.sw_rain
+        if ch == 'c' or ch == 'C':
+            monitor_state.sw_can = not monitor_state.sw_can
+            if monitor_state.sw_can:
+                cyclic.start()
+            else:
+                cyclic.stop()
+        if ch == 'q' or ch == 'Q':
+            cyclic.stop()
+            console.stop()
+            return
 
-        try:
-            ch = stdscr.getkey()
-            if ch == 't' or ch == 'T':
-                monitor_state.sw_t15 = not monitor_state.sw_t15
-                if monitor_state.sw_t15:
-                    interface.set_power_t30_t15()
-                else:
-                    interface.set_power_t30()
-            if ch == 'b' or ch == 'B':
-                monitor_state.sw_brake = not monitor_state.sw_brake
-            if ch == 'l' or ch == 'L':
-                monitor_state.sw_lights = not monitor_state.sw_lights
-            if ch == 'r' or ch == 'R':
-                monitor_state.sw_rain = not monitor_state.sw_rain
-            if ch == 'c' or ch == 'C':
-                monitor_state.sw_can = not monitor_state.sw_can
-            if ch == 'q' or ch == 'Q':
-                return
-        except Exception:
-            pass
+
+if __name__ == '__main__':
+    import argparse
+    from interface import Interface
+
+    parser = argparse.ArgumentParser(description='E36 tail module monitor')
+    parser.add_argument('--interface-channel',
+                        type=str,
+                        metavar='CHANNEL',
+                        required=True,
+                        help='interface channel name (e.g. for Anagate units, hostname:portname')
+    parser.add_argument('--bitrate',
+                        type=int,
+                        default=500,
+                        metavar='BITRATE_KBPS',
+                        help='CAN bitrate (kBps')
+    parser.add_argument('--interface',
+                        type=str,
+                        choices=Interface.BACKENDS,
+                        default='anagate',
+                        help='CAN interface backend')
+    parser.add_argument('--time-scale',
+                        type=float,
+                        default=1.0,
+                        metavar='FACTOR',
+                        help='run periodic traffic and delays FACTOR times faster than real time')
+    parser.add_argument('--no-CAN-at-start',
+                        action='store_true',
+                        help='start with brake / light messages off')
+    parser.add_argument('--T15-at-start',
+                        action='store_true',
+                        help='start with module power on')
+    parser.add_argument('--max-fps',
+                        type=float,
+                        default=20.0,
+                        metavar='FPS',
+                        help='maximum screen update rate')
+
+    args = parser.parse_args()
+    interface = Interface(args)
+    if args.T15_at_start:
+        interface.set_power_on()
+    try:
+        curses.wrapper(do_monitor, interface, args)
+    except KeyboardInterrupt:
+        pass
+    interface.set_power_off()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+#
+# Model of the MSCAN receive acceptance filter.
+#
+# can_reinit() in Sources/can.c programs CANIDAC and the eight
+# CANIDAR / CANIDMR identifier acceptance and mask registers; this reads
+# the values from the source and applies them the way the hardware does,
+# so the simulator and traffic generators can tell which frames the
+# module really receives.
+#
+# A received identifier is laid out in the IDR0..IDR3 registers as
+#
+#   standard    IDR0 = ID[10:3]
+#               IDR1 = ID[2:0] RTR IDE=0 - - -
+#   extended    IDR0 = ID[28:21]
+#               IDR1 = ID[20:18] SRR=1 IDE=1 ID[17:15]
+#               IDR2 = ID[14:7]
+#               IDR3 = ID[6:0] RTR
+#
+# and compared with the acceptance registers in 2x32, 4x16 or 8x8 bit
+# filters as selected by CANIDAC. A set mask bit means "don't care". A
+# frame is accepted if any filter hits.
+#
+# Note that the filters as programmed mask out every bit of IDR0 for
+# 0x0a8, 0x21a and the unused filter, so in practice the module receives
+# every standard data frame; the 0x6xx filter only matches IDs ending in
+# 0xf1. report() shows this.
+#
+
+import os
+import re
+
+CAN_C = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Sources', 'can.c')
+
+# CANIDAC IDAM
+IDAM_32 = 0x00
+IDAM_16 = 0x10
+IDAM_8 = 0x20
+IDAM_CLOSED = 0x30
+IDAM_MASK = 0x30
+
+STANDARD_ID_COUNT = 0x800
+
+
+def id_registers(arbid, extended=False, remote=False):
+    """the IDR0..IDR3 register values for a received identifier"""
+    if extended:
+        return bytes([(arbid >> 21) & 0xff,
+                      (((arbid >> 18) & 0x07) << 5) | 0x18 | ((arbid >> 15) & 0x07),
+                      (arbid >> 7) & 0xff,
+                      ((arbid & 0x7f) << 1) | (1 if remote else 0)])
+    return bytes([(arbid >> 3) & 0xff,
+                  ((arbid & 0x07) << 5) | (0x10 if remote else 0),
+                  0,
+                  0])
+
+
+class AcceptanceFilter(object):
+    """
+    CANIDAC / CANIDAR0-7 / CANIDMR0-7 as programmed.
+
+    Instances are callable with a can.Message, returning whether the module
+    would receive it, so one can be assigned to TailModule.accept_filter.
+    Decisions are cached per identifier.
+    """
+    def __init__(self, idac, idar, idmr):
+        self.idac = idac
+        self.idar = bytes(idar)
+        self.idmr = bytes(idmr)
+        self._cache = dict()
+
+    @classmethod
+    def load(cls, path=CAN_C):
+        """read the register values assigned in can_reinit()"""
+        with open(path) as f:
+            source = f.read()
+        body = source[source.index('can_reinit(void)'):]
+        body = body[:body.index('\n}')]
+        registers = dict()
+        for name, value in re.findall(r'^\s*(CANIDAC|CANIDAR\d|CANIDMR\d)\s*=\s*(0x[0-9a-fA-F]+|\d+)\s*;',
+                                      body, re.MULTILINE):
+            registers[name] = int(value, 0)
+        return cls(registers.get('CANIDAC', 0),
+                   [registers.get(f'CANIDAR{index}', 0) for index in range(8)],
+                   [registers.get(f'CANIDMR{index}', 0) for index in range(8)])
+
+    @property
+    def mode(self):
+        return self.idac & IDAM_MASK
+
+    def filters(self):
+        """(acceptance bytes, mask bytes) for each filter, compared with IDR0 onwards"""
+        width = {IDAM_32: 4, IDAM_16: 2, IDAM_8: 1}.get(self.mode)
+        if width is None:
+            return list()
+        return [(self.idar[base:base + width], self.idmr[base:base + width]) for base in range(0, 8, width)]
+
+    def hit(self, arbid, extended=False, remote=False):
+        """index of the first filter that accepts the identifier (as CANIDAC IDHIT), or None"""
+        registers = id_registers(arbid, extended, remote)
+        for index, (acceptance, mask) in enumerate(self.filters()):
+            for register, code, dont_care in zip(registers, acceptance, mask):
+                if (register ^ code) & ~dont_care & 0xff:
+                    break
+            else:
+                return index
+        return None
+
+    def accepts(self, arbid, extended=False, remote=False):
+        key = (arbid, extended, remote)
+        accepted = self._cache.get(key)
+        if accepted is None:
+            accepted = self._cache[key] = self.hit(arbid, extended, remote) is not None
+        return accepted
+
+    def __call__(self, message):
+        return self.accepts(message.arbitration_id, message.is_extended_id, message.is_remote_frame)
+
+    def accepted_ids(self):
+        """every standard ID whose data frames are accepted"""
+        return [arbid for arbid in range(STANDARD_ID_COUNT) if self.accepts(arbid)]
+
+    def can_filters(self):
+        """
+        Equivalent python-can filters for standard data frames. The RTR bit
+        cannot be expressed, and extended frames are not passed as no
+        python-can filter can express the MSCAN's extended ID layout.
+        """
+        result = list()
+        for acceptance, mask in self.filters():
+            # pad to IDR0..IDR1 plus the zero IDR2..IDR3 of a standard frame
+            code = (acceptance + b'\0' * 4)[:4]
+            dont_care = (mask + b'\xff' * 4)[:4]
+            if ((code[1] & ~dont_care[1] & 0x18) or
+                    (code[2] & ~dont_care[2] & 0xff) or
+                    (code[3] & ~dont_care[3] & 0xff)):
+                # can never match a standard data frame
+                continue
+            id_code = (code[0] << 3) | (code[1] >> 5)
+            id_compared = ((~dont_care[0] & 0xff) << 3) | ((~dont_care[1] & 0xe0) >> 5)
+            result.append({'can_id': id_code & id_compared, 'can_mask': id_compared, 'extended': False})
+        if not result:
+            # python-can treats no filters as pass-all; this passes only extended ID 0
+            result.append({'can_id': 0, 'can_mask': 0x1fffffff, 'extended': True})
+        return result
+
+    def report(self):
+        lines = [f'CANIDAC {self.idac:#04x}, {len(self.filters())} filters']
+        for index, (acceptance, mask) in enumerate(self.filters()):
+            ids = [arbid for arbid in range(STANDARD_ID_COUNT) if self.hit(arbid) == index]
+            lines.append(f'  filter {index}: IDAR {acceptance.hex()} IDMR {mask.hex()}, '
+                         f'first hit for {len(ids)} standard IDs')
+        accepted = self.accepted_ids()
+        lines.append(f'{len(accepted)}/{STANDARD_ID_COUNT} standard IDs accepted')
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='E36 tail module MSCAN acceptance filter')
+    parser.add_argument('--source',
+                        type=str,
+                        default=CAN_C,
+                        metavar='PATH',
+                        help='can.c to read the filter configuration from')
+    parser.add_argument('--id',
+                        type=lambda x: int(x, 0),
+                        action='append',
+                        metavar='ARBID',
+                        help='report whether this standard ID is accepted (may be repeated)')
+
+    args = parser.parse_args()
+    acceptance_filter = AcceptanceFilter.load(args.source)
+    print(acceptance_filter.report())
+    for arbid in args.id or ():
+        hit = acceptance_filter.hit(arbid)
+        print(f'{arbid:#05x}: ' + ('rejected' if hit is None else f'accepted by filter {hit}'))
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+#
+# Replay recorded bus traffic.
+#
+# Frames are sent through Interface.send at their recorded spacing divided
+# by a speed multiplier, or back-to-back at maximum speed. Sends are
+# released by the interface's scheduler rather than by sleeping. Every
+# frame has an absolute deadline, taken from one clock reading when the
+# replay starts, so neither timer lateness nor the time spent sending
+# accumulates over a long session. How late each frame went out relative
+# to its deadline is kept per arbitration ID.
+#
+# The speed multiplier is relative to the interface's time scale.
+#
+
+import struct
+import threading
+import time
+
+import can
+from capture import Capture, CaptureError
+from scheduler import Lateness
+
+
+def load_messages(path):
+    """read frames from a capture file, or any log format python-can understands"""
+    try:
+        capture = Capture(path)
+    except (CaptureError, ValueError, struct.error):
+        return list(can.LogReader(path))
+    messages = list(capture.messages())
+    capture.close()
+    return messages
+
+
+class Replay(object):
+    """
+    Replay a sequence of can.Message objects on an interface.
+
+    speed       playback rate relative to the recording; None or 0 sends
+                every frame as fast as possible
+    arbids      if supplied, only frames with these arbitration IDs are sent
+    clock       time source that interface.sleep() advances, in seconds
+    """
+    def __init__(self, interface, messages, speed=1.0, arbids=None, clock=time.perf_counter):
+        self._interface = interface
+        self._speed = speed
+        self._clock = clock
+        self._anchor = None
+        if arbids is not None:
+            arbids = frozenset(arbids)
+        self._messages = [msg for msg in messages
+                          if (arbids is None or msg.arbitration_id in arbids) and not msg.is_error_frame]
+        self._next = 0
+        self._timer = None
+        self._lock = threading.Lock()
+        self.done = threading.Event()
+        self.lateness = Lateness()
+        self.lateness_by_id = dict()
+
+    @property
+    def sent(self):
+        return self._next
+
+    def __len__(self):
+        return len(self._messages)
+
+    def _target(self, index):
+        """send time of a frame relative to the first, in nominal seconds"""
+        return (self._messages[index].timestamp - self._messages[0].timestamp) / self._speed
+
+    def _deadline(self, index):
+        """send time of a frame on the clock"""
+        return self._anchor + self._interface.scaled(self._target(index))
+
+    def _send(self, index, lateness):
+        msg = self._messages[index]
+        self._interface.send(can.Message(arbitration_id=msg.arbitration_id,
+                                         is_extended_id=msg.is_extended_id,
+                                         is_remote_frame=msg.is_remote_frame,
+                                         dlc=msg.dlc,
+                                         data=msg.data))
+        self.lateness.record(lateness)
+        by_id = self.lateness_by_id.get(msg.arbitration_id)
+        if by_id is None:
+            by_id = self.lateness_by_id[msg.arbitration_id] = Lateness()
+        by_id.record(lateness)
+
+    def start(self):
+        """begin sending; returns immediately unless replaying at maximum speed"""
+        if not self._messages:
+            self.done.set()
+            return
+        if not self._speed:
+            for index in range(len(self._messages)):
+                self._next = index
+                self._send(index, 0.0)
+            self._next = len(self._messages)
+            self.done.set()
+            return
+        with self._lock:
+            self._anchor = self._clock()
+            self._timer = self._interface.call_later(0, self._release)
+
+    def _release(self):
+        """scheduler callback: send every frame now due, then wait for the next"""
+        with self._lock:
+            if self._timer is None:
+                return
+            due = self._next
+            while self._next < len(self._messages):
+                # read the clock for every frame, so that time spent sending counts as lateness
+                lateness = self._clock() - self._deadline(self._next)
+                if lateness < 0:
+                    # the frame the timer was armed for is due, even if the clock rounds the other way
+                    if self._next > due:
+                        break
+                    lateness = 0.0
+                self._send(self._next, lateness)
+                self._next += 1
+            if self._next < len(self._messages):
+                delay = (self._deadline(self._next) - self._clock()) * self._interface.time_scale
+                self._timer = self._interface.call_later(max(0.0, delay), self._release)
+            else:
+                self._timer = None
+                self.done.set()
+
+    def stop(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        self.done.set()
+
+    def run(self, poll=0.1):
+        """
+        Replay to completion. Uses interface.sleep to wait, so this also
+        drives a simulated bus.
+        """
+        self.start()
+        while not self.done.is_set():
+            self._interface.sleep(poll)
+
+    def report(self):
+        lines = [f'{self.sent}/{len(self)} frames, {self.lateness}']
+        for arbid, lateness in sorted(self.lateness_by_id.items()):
+            lines.append(f'  {arbid:#05x}: {lateness}')
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+    from interface import Interface
+
+    parser = argparse.ArgumentParser(description='E36 tail module bus replay')
+    parser.add_argument('--interface-channel',
+                        type=str,
+                        metavar='CHANNEL',
+                        help='interface channel name (e.g. for Anagate units, hostname:portname')
+    parser.add_argument('--bitrate',
+                        type=int,
+                        default=500,
+                        metavar='BITRATE_KBPS',
+                        help='CAN bitrate (kBps')
+    parser.add_argument('--interface',
+                        type=str,
+                        choices=Interface.BACKENDS,
+                        default='anagate',
+                        help='CAN interface backend')
+    parser.add_argument('--time-scale',
+                        type=float,
+                        default=1.0,
+                        metavar='SCALE',
+                        help='run the emulated bus this many times faster than real time')
+    parser.add_argument('--firmware',
+                        action='store_true',
+                        help='replay into the firmware model on a simulated bus instead of an interface')
+    parser.add_argument('--speed',
+                        type=float,
+                        default=1.0,
+                        metavar='MULTIPLIER',
+                        help='playback speed, 0 for as fast as possible')
+    parser.add_argument('--id',
+                        type=lambda x: int(x, 0),
+                        action='append',
+                        metavar='ARBID',
+                        help='only replay frames with this ID (may be repeated)')
+    parser.add_argument('path',
+                        type=str,
+                        metavar='RECORDING',
+                        help='capture file or python-can log')
+
+    args = parser.parse_args()
+    if args.firmware:
+        from firmware import simulated
+        from console import Console
+        from status import Status
+
+        interface, _, clock = simulated()
+        status = Status(interface)
+        console = Console(interface)
+        interface.set_power_on()
+    else:
+        if args.interface_channel is None:
+            parser.error('--interface-channel is required unless --firmware is given')
+        interface = Interface(args)
+        clock = time.perf_counter
+
+    replay = Replay(interface, load_messages(args.path), speed=args.speed, arbids=args.id, clock=clock)
+    print(f'Replaying {len(replay)} frames from {args.path}')
+    started = time.time()
+    try:
+        replay.run()
+    except KeyboardInterrupt:
+        replay.stop()
+    print(f'{time.time() - started:.2f}s')
+    print(replay.report())
+    if args.firmware:
+        console.stop()
+        print(f'{status}')
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+#
+# Receive ring overflow stress test.
+#
+# can_rx_message() drops frames when the CAN_BUF_COUNT entry receive
+# ring is full, and the CAN listener prints "CAN OVERFLOW" on the
+# console when it next takes a frame from the ring. This floods the
+# module with frames it accepts and watches the console to find
+#
+#   sustained   the lowest bus load, in whole percent, of evenly spaced
+#               frames that overflows the ring within a trial
+#   burst       the shortest run of back-to-back frames at wire speed
+#               that overflows the ring from empty
+#
+# by binary search, and writes a capacity report that can be kept with
+# the firmware build it was measured on.
+#
+# Frames cycle through 0x0a8 (brake released), 0x21a (lights off) and
+# the DDE's ISO-TP ID 0x612 addressed to another node, so the flood
+# passes the acceptance filter and runs the listener's dispatch without
+# changing the module's outputs. Bus load counts each frame's worst-case
+# stuffed length including the interframe space. On hardware the
+# adapter serialises frames sent together, so a late send loop degrades
+# into short bursts rather than exceeding the requested load.
+#
+
+import json
+import time
+from collections import namedtuple
+from itertools import cycle
+
+import can
+from console import Console
+from mscan import AcceptanceFilter
+
+STRESS_FRAMES = (
+    (0x0a8, bytes(8)),
+    (0x21a, bytes(3)),
+    (0x612, bytes(8)),
+)
+
+OVERFLOW_LINE = 'CAN OVERFLOW'
+
+
+def frame_bits(dlc, extended=False):
+    """wire length of a data frame with worst-case bit stuffing, plus interframe space"""
+    stuffed = (54 if extended else 34) + 8 * dlc
+    return stuffed + (stuffed - 1) // 4 + 13
+
+
+Trial = namedtuple('Trial', ('kind', 'value', 'frames', 'overflows', 'dropped'))
+Trial.__doc__ = """
+one stress run; overflows counts console reports and dropped the frames
+the firmware model discarded (None on hardware)
+"""
+Trial.overflowed = property(lambda self: self.overflows > 0 or bool(self.dropped))
+
+
+def find_threshold(overflows, low, high):
+    """
+    Smallest value in (low, high] for which overflows(value) is true,
+    assuming it is monotonic and false at low; None if it is false at high.
+    """
+    if not overflows(high):
+        return None
+    while high - low > 1:
+        middle = (low + high) // 2
+        if overflows(middle):
+            high = middle
+        else:
+            low = middle
+    return high
+
+
+class RxStress(object):
+    """
+    Stress generator and threshold search.
+
+    interface   Interface or SimInterface to the module
+    clock       time source that interface.sleep() advances
+    module      optional firmware model, whose dropped frames are counted too
+    """
+    def __init__(self, interface, clock, bitrate=500, frames=STRESS_FRAMES, module=None, log=None):
+        self._interface = interface
+        self._clock = clock
+        self._module = module
+        self._log = log
+        self.bitrate = bitrate * 1000
+        self.frames = [can.Message(arbitration_id=arbid, is_extended_id=False, dlc=len(data), data=data)
+                       for arbid, data in frames]
+        self._bits = [frame_bits(message.dlc) for message in self.frames]
+        # unbounded, so that every report in a heavily overflowing trial is counted
+        self.console = Console(interface, emit=None, queue_depth=0)
+        self.trials = list()
+
+    @property
+    def mean_bits(self):
+        return sum(self._bits) / len(self._bits)
+
+    @property
+    def wire_rate(self):
+        """frames per second at 100% bus load"""
+        return self.bitrate / self.mean_bits
+
+    def send_trains(self, load, length, count=1, gap=0.0):
+        """
+        Send count trains of length frames, spaced to occupy load (0..1] of
+        the bus, with gap seconds of silence after each; returns the number
+        of frames sent.
+        """
+        frames = cycle(zip(self.frames, self._bits))
+        due = self._clock()
+        sent = 0
+        for _ in range(count):
+            for _ in range(length):
+                message, bits = next(frames)
+                delay = due - self._clock()
+                if delay > 0:
+                    self._interface.sleep(delay)
+                self._interface.send(message)
+                sent += 1
+                due += bits / (self.bitrate * load)
+            due += gap
+        return sent
+
+    def _overflow_lines(self):
+        lines = 0
+        while True:
+            batch = self.console.get(timeout=0)
+            if batch is None:
+                return lines
+            lines += len([line for line in batch if line.text == OVERFLOW_LINE])
+
+    def _trial(self, kind, value, send, settle):
+        self._overflow_lines()
+        dropped = None if self._module is None else self._module.can_overflows
+        frames = send()
+        # let the ring drain, and the console report arrive
+        self._interface.sleep(settle)
+        if dropped is not None:
+            dropped = self._module.can_overflows - dropped
+        trial = Trial(kind, value, frames, self._overflow_lines(), dropped)
+        self.trials.append(trial)
+        if self._log is not None:
+            self._log(f'{kind} {value}: {frames} frames, '
+                      + (f'{trial.overflows} overflow reports' if trial.overflowed else 'no overflow')
+                      + ('' if dropped is None else f', {dropped} dropped'))
+        return trial
+
+    def sustained(self, percent, duration=2.0, settle=0.2):
+        """run percent bus load for duration seconds"""
+        load = percent / 100
+        length = max(1, int(duration * self.wire_rate * load))
+        return self._trial('sustained', percent, lambda: self.send_trains(load, length), settle)
+
+    def burst(self, length, count=10, gap=0.1, settle=0.2):
+        """send count bursts of length back-to-back frames, gap seconds apart"""
+        return self._trial('burst', length, lambda: self.send_trains(1.0, length, count, gap), settle)
+
+    def search(self, duration=2.0, count=10, gap=0.1, max_burst=256, settle=0.2):
+        """find both thresholds; returns (sustained percent, burst length), either None if never reached"""
+        sustained = find_threshold(lambda percent: self.sustained(percent, duration, settle).overflowed, 0, 100)
+        burst = find_threshold(lambda length: self.burst(length, count, gap, settle).overflowed, 0, max_burst)
+        return sustained, burst
+
+    def capacity(self, sustained, burst, label=None, channel=None, settings=None):
+        """the capacity report as a dict, for JSON"""
+        return dict(label=label,
+                    channel=channel,
+                    date=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    bitrate=self.bitrate,
+                    frames=[dict(arbitration_id=message.arbitration_id, dlc=message.dlc) for message in self.frames],
+                    wire_rate=round(self.wire_rate),
+                    settings=settings or dict(),
+                    sustained_percent=sustained,
+                    sustained_rate=None if sustained is None else round(self.wire_rate * sustained / 100),
+                    burst_frames=burst,
+                    trials=[dict(trial._asdict(), overflowed=trial.overflowed) for trial in self.trials])
+
+
+def report(capacity):
+    """the capacity report as text"""
+    frames = ' '.join(f'{frame["arbitration_id"]:#05x}/{frame["dlc"]}' for frame in capacity['frames'])
+    lines = ['RX overflow capacity' + (f' of {capacity["label"]}' if capacity['label'] else '')
+             + (f' on {capacity["channel"]}' if capacity['channel'] else '')
+             + f' at {capacity["bitrate"] // 1000} kbps, {capacity["date"]}',
+             f'  frames {frames}, {capacity["wire_rate"]} frames/s at 100% load']
+    sustained = capacity['sustained_percent']
+    if sustained is None:
+        lines.append('  sustained: no overflow at 100% load')
+    else:
+        lines.append(f'  sustained: overflows at {sustained}% load ({capacity["sustained_rate"]} frames/s)')
+    burst = capacity['burst_frames']
+    if burst is None:
+        lines.append(f'  burst: no overflow at {capacity["settings"].get("max_burst")} back-to-back frames')
+    else:
+        lines.append(f'  burst: overflows at {burst} back-to-back frames')
+    lines.append(f'  {len(capacity["trials"])} trials')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    from interface import Interface
+
+    parser = argparse.ArgumentParser(description='E36 tail module receive overflow stress test')
+    parser.add_argument('--interface-channel',
+                        type=str,
+                        metavar='CHANNEL',
+                        help='interface channel name (e.g. for Anagate units, hostname:portname')
+    parser.add_argument('--bitrate',
+                        type=int,
+                        default=500,
+                        metavar='BITRATE_KBPS',
+                        help='CAN bitrate (kBps')
+    parser.add_argument('--interface',
+                        type=str,
+                        choices=Interface.BACKENDS,
+                        default='anagate',
+                        help='CAN interface backend')
+    parser.add_argument('--firmware',
+                        action='store_true',
+                        help='stress the firmware model on a simulated bus instead of an interface')
+    parser.add_argument('--passes-per-ms',
+                        type=int,
+                        default=1,
+                        metavar='PASSES',
+                        help='firmware model main loop passes per millisecond')
+    parser.add_argument('--duration',
+                        type=float,
+                        default=2.0,
+                        metavar='SECONDS',
+                        help='length of each sustained load trial')
+    parser.add_argument('--bursts',
+                        type=int,
+                        default=10,
+                        metavar='COUNT',
+                        help='bursts per burst trial')
+    parser.add_argument('--gap',
+                        type=float,
+                        default=0.1,
+                        metavar='SECONDS',
+                        help='silence after each burst, long enough for the ring to drain')
+    parser.add_argument('--max-burst',
+                        type=int,
+                        default=256,
+                        metavar='FRAMES',
+                        help='longest burst to try')
+    parser.add_argument('--label',
+                        type=str,
+                        metavar='TEXT',
+                        help='firmware build identification for the report')
+    parser.add_argument('--report',
+                        type=str,
+                        metavar='PATH',
+                        help='also write the capacity report as JSON')
+
+    args = parser.parse_args()
+    unaccepted = [arbid for arbid, _ in STRESS_FRAMES if not AcceptanceFilter.load().accepts(arbid)]
+    if unaccepted:
+        sys.exit(f'{unaccepted[0]:#05x} does not pass the acceptance filter in can.c')
+    module = None
+    if args.firmware:
+        from firmware import simulated
+
+        interface, module, clock = simulated(passes_per_ms=args.passes_per_ms)
+        channel = 'firmware model'
+    else:
+        if args.interface_channel is None:
+            parser.error('--interface-channel is required unless --firmware is given')
+        interface = Interface(args)
+        clock = time.time
+        channel = args.interface_channel
+
+    stress = RxStress(interface, clock, bitrate=args.bitrate, module=module, log=print)
+    interface.set_power_on()
+    interface.sleep(0.5)
+    try:
+        sustained, burst = stress.search(duration=args.duration, count=args.bursts, gap=args.gap,
+                                         max_burst=args.max_burst)
+    finally:
+        interface.set_power_off()
+    settings = dict(duration=args.duration, bursts=args.bursts, gap=args.gap, max_burst=args.max_burst)
+    if args.firmware:
+        settings['passes_per_ms'] = args.passes_per_ms
+    capacity = stress.capacity(sustained, burst, label=args.label, channel=channel, settings=settings)
+    print(report(capacity))
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump(capacity, f, indent=1)
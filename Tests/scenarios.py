@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+#
+# Scenario tests, run in parallel against the firmware model.
+#
+# A scenario is a function taking a Bench - an interface to a powered
+# module plus the usual listeners - that raises ModuleError, MessageError
+# or AssertionError on failure. Scenarios only drive the bus through the
+# Interface API, so the same functions can run against a module on real
+# hardware; those marked requires_model also poke the simulated loads and
+# can only run against the firmware model.
+#
+# The runner gives every scenario a fresh SimBus and TailModule in a
+# worker process from a pool sized to the host's cores, so the suite
+# takes about as long as its slowest scenario rather than the sum of
+# them. Simulated time does not depend on host load, so results and
+# bench times are the same however many scenarios run at once.
+#
+
+import argparse
+import os
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import can
+from console import Console
+from cyclic import CyclicScheduler
+from dde import DDE
+from drive_cycle import Constant, DriveCycle, EchoChecker
+from egs import EGS
+from firmware import CONFIG, OUTPUT_BRAKE_L, OUTPUT_TAILS, OUT_FAULT_OPEN, OUT_FAULT_OVERLOAD, \
+    SYS_FAULT_CAN_TIMEOUT, simulated
+from interface import ModuleError
+from messages import MSG_DDE_PID_request, MSG_lights, MSG_module_state, MessageError, MessageFormat
+from status import Status
+
+REPORT_INTERVAL = CONFIG['CAN_REPORT_INTERVAL_DIAGS'] / 1000
+
+
+class Latest(can.Listener):
+    """the most recent fields of every known message format"""
+    def __init__(self, interface):
+        self._fields = dict()
+        interface.add_listener(self)
+
+    def on_message_received(self, message):
+        msg_class, fields = MessageFormat.decode(message)
+        if msg_class is not None:
+            self._fields[msg_class] = fields
+
+    def get(self, msg_class, key):
+        fields = self._fields.get(msg_class)
+        return None if fields is None else fields[key]
+
+
+class Bench(object):
+    """
+    What a scenario runs against.
+
+    interface   Interface or SimInterface to the module
+    clock       time source comparable with received message timestamps
+    module      TailModule when running against the firmware model, else None
+    """
+    def __init__(self, interface, clock=time.time, module=None, name=None):
+        self.name = name
+        self.interface = interface
+        # everything attached from here on is detached again by close()
+        self._listeners = interface.listeners
+        self.clock = clock
+        self.module = module
+        self.args = argparse.Namespace(no_periodic=False)
+        self.status = Status(interface, clock=clock)
+        self.latest = Latest(interface)
+        self.console = Console(interface, emit=None)
+        self.cyclic = CyclicScheduler(interface)
+        self.cyclic.start()
+
+    @classmethod
+    def simulated(cls, name=None):
+        """a fresh simulated bus with the firmware model on it"""
+        interface, module, clock = simulated(channel=name or 'sim')
+        return cls(interface, clock=clock, module=module, name=name)
+
+    def console_lines(self):
+        """every console line received so far"""
+        lines = list()
+        while True:
+            batch = self.console.get(timeout=0)
+            if batch is None:
+                return lines
+            lines.extend(line.text for line in batch)
+
+    def status_value(self, key, index=None):
+        value = self.status.last(key, index)
+        return None if value is None else int(value)
+
+    def wait_for(self, condition, timeout, what, poll=0.05):
+        """run until condition() is true, or raise ModuleError after timeout nominal seconds"""
+        deadline = self.clock() + self.interface.scaled(timeout)
+        while not condition():
+            if self.clock() >= deadline:
+                raise ModuleError(f'timed out waiting for {what}')
+            self.interface.sleep(poll)
+
+    def close(self):
+        """power the module off and detach this bench's listeners, leaving the interface reusable"""
+        self.cyclic.stop()
+        self.interface.set_power_off()
+        for listener in self.interface.listeners:
+            if listener not in self._listeners:
+                self.interface.remove_listener(listener)
+
+
+Scenario = namedtuple('Scenario', ('name', 'function', 'requires_model'))
+
+# registered scenarios in definition order
+SCENARIOS = dict()
+
+
+def scenario(requires_model=False):
+    def register(function):
+        SCENARIOS[function.__name__] = Scenario(function.__name__, function, requires_model)
+        return function
+    return register
+
+
+@scenario()
+def boot(bench):
+    """the module announces itself and starts reporting after power-on"""
+    bench.interface.set_power_on()
+    bench.wait_for(lambda: bench.status.last('t15_voltage') is not None, REPORT_INTERVAL * 2, 'status report')
+    lines = bench.console_lines()
+    assert 'E36 tail module' in lines, f'no banner on the console: {lines}'
+
+
+@scenario()
+def brake_light(bench):
+    """both brake outputs follow the DDE brake state"""
+    dde = DDE(bench.interface, bench.args, cyclic=bench.cyclic)
+    bench.interface.set_power_on()
+    bench.interface.sleep(1.0)
+    dde.brake_on()
+    bench.wait_for(lambda: (bench.status_value('output_request') or 0) & 0x03 == 0x03,
+                   REPORT_INTERVAL * 3, 'brake outputs on')
+    assert bench.status_value('function_request') & 0x01, 'brake function not requested'
+    dde.brake_off()
+    bench.wait_for(lambda: bench.status_value('output_request') & 0x03 == 0,
+                   REPORT_INTERVAL * 3, 'brake outputs off')
+
+
+@scenario()
+def tail_rain_lights(bench):
+    """the tail output follows the light control message, and the rain light flashes"""
+    DDE(bench.interface, bench.args, cyclic=bench.cyclic)
+    lights = MSG_lights.message(brake_light=False, tail_light=True, rain_light=True)
+    bench.cyclic.add(lights.arbitration_id, 0.1, lights)
+    bench.interface.set_power_on()
+    bench.wait_for(lambda: (bench.status_value('function_request') or 0) & 0x06 == 0x06,
+                   REPORT_INTERVAL * 3, 'tail and rain lights requested')
+    bench.wait_for(lambda: bench.status_value('output_request') & 0x04,
+                   REPORT_INTERVAL * 3, 'tail output on')
+    bench.cyclic.set_payload(lights.arbitration_id,
+                             MSG_lights.message(brake_light=False, tail_light=False, rain_light=False))
+    bench.wait_for(lambda: bench.status_value('output_request') & 0x0c == 0,
+                   REPORT_INTERVAL * 3, 'tail and rain outputs off')
+
+
+@scenario()
+def dde_echo(bench):
+    """the module re-broadcasts the DDE's current values on 0x700 / 0x701"""
+    drive_cycle = DriveCycle(duration=60.0, seed=0, clock=bench.clock)
+    checker = EchoChecker(bench.interface, drive_cycle)
+    DDE(bench.interface, bench.args, cyclic=bench.cyclic, drive_cycle=drive_cycle)
+    drive_cycle.start()
+    bench.interface.set_power_on()
+    bench.interface.sleep(5.0)
+    assert checker.echoes >= 10, f'only {checker.echoes} echoes'
+    for name, stats in checker.stats.items():
+        assert stats.mismatched == 0 and stats.unexplained == 0, f'{name}: {stats}'
+
+
+@scenario()
+def dde_echo_step_boundary(bench):
+    """the echo holds the values current at the request, when they change while the request is in flight"""
+    # 1 ms steps are shorter than a multi-frame request, so every request straddles a step boundary
+    drive_cycle = DriveCycle(duration=10.0, step=0.001, seed=0, clock=bench.clock)
+    checker = EchoChecker(bench.interface, drive_cycle)
+    DDE(bench.interface, bench.args, cyclic=bench.cyclic, drive_cycle=drive_cycle)
+    drive_cycle.start()
+    bench.interface.set_power_on()
+    bench.interface.sleep(5.0)
+    assert checker.echoes >= 10, f'only {checker.echoes} echoes'
+    for name, stats in checker.stats.items():
+        assert stats.mismatched == 0 and stats.unexplained == 0, f'{name}: {stats}'
+
+
+@scenario()
+def dde_scantool_silence(bench):
+    """the module stops polling the DDE once a scan tool talks to it"""
+    requests = list()
+
+    class RequestCounter(can.Listener):
+        def on_message_received(self, message):
+            if message.arbitration_id == EchoChecker.REQUEST_ID and message.data[0] == EchoChecker.DDE_ID:
+                requests.append(message.timestamp)
+
+    bench.interface.add_listener(RequestCounter())
+    DDE(bench.interface, bench.args, cyclic=bench.cyclic)
+    bench.interface.set_power_on()
+    bench.wait_for(lambda: len(requests) >= 2, 1.0, 'DDE requests')
+    bench.interface.send(MSG_DDE_PID_request.message(pid_id=b'\x1a\x80'))
+    bench.interface.sleep(0.2)
+    silenced = len(requests)
+    bench.interface.sleep(2.0)
+    assert len(requests) == silenced, f'{len(requests) - silenced} requests after scan tool sign-on'
+
+
+@scenario()
+def egs_gear(bench):
+    """the display gear is the DDE's current gear in D, otherwise the selected gear"""
+    drive_cycle = DriveCycle({'current_gear': Constant(3)}, duration=60.0, seed=0, clock=bench.clock)
+    DDE(bench.interface, bench.args, cyclic=bench.cyclic, drive_cycle=drive_cycle)
+    egs = EGS(bench.interface, cyclic=bench.cyclic, selected_gear=EGS.GEAR_D)
+    drive_cycle.start()
+    bench.interface.set_power_on()
+    bench.wait_for(lambda: bench.latest.get(MSG_module_state, 'display_gear') == 3, 2.0, 'display gear 3 in D')
+    egs.select_gear(EGS.GEAR_P)
+    bench.wait_for(lambda: bench.latest.get(MSG_module_state, 'display_gear') == EGS.GEAR_P, 2.0,
+                   'display gear P')
+
+
+@scenario()
+def can_timeout_fault(bench):
+    """a silent bus raises the CAN timeout fault, which stays latched once traffic resumes"""
+    current = 0x01 << SYS_FAULT_CAN_TIMEOUT
+    latched = 0x10 << SYS_FAULT_CAN_TIMEOUT
+    bench.interface.set_power_on()
+    bench.wait_for(lambda: (bench.status_value('system_faults') or 0) & current,
+                   CONFIG['CAN_IDLE_TIMEOUT'] / 1000 + REPORT_INTERVAL * 2, 'CAN timeout fault')
+    DDE(bench.interface, bench.args, cyclic=bench.cyclic)
+    bench.wait_for(lambda: not bench.status_value('system_faults') & current,
+                   REPORT_INTERVAL * 2, 'CAN timeout fault to clear')
+    assert bench.status_value('system_faults') & latched, 'CAN timeout fault not latched'
+
+
+@scenario(requires_model=True)
+def output_open_fault(bench):
+    """a lit brake light with no load reports an open circuit"""
+    fault = 0x01 << OUT_FAULT_OPEN
+    bench.module.loads[OUTPUT_BRAKE_L].open = True
+    dde = DDE(bench.interface, bench.args, cyclic=bench.cyclic)
+    bench.interface.set_power_on()
+    bench.interface.sleep(0.5)
+    dde.brake_on()
+    bench.wait_for(lambda: (bench.status_value('output_faults', OUTPUT_BRAKE_L) or 0) & fault,
+                   REPORT_INTERVAL * 3, 'open fault on the left brake output')
+    assert not bench.status_value('output_faults', OUTPUT_BRAKE_L + 1) & fault, 'open fault on the right brake output'
+
+
+@scenario(requires_model=True)
+def output_overload_fault(bench):
+    """an overloaded tail light output reports the overload"""
+    fault = 0x01 << OUT_FAULT_OVERLOAD
+    bench.module.loads[OUTPUT_TAILS].overload = True
+    DDE(bench.interface, bench.args, cyclic=bench.cyclic)
+    lights = MSG_lights.message(brake_light=False, tail_light=True, rain_light=False)
+    bench.cyclic.add(lights.arbitration_id, 0.1, lights)
+    bench.interface.set_power_on()
+    bench.wait_for(lambda: (bench.status_value('output_faults', OUTPUT_TAILS) or 0) & fault,
+                   REPORT_INTERVAL * 3, 'overload fault on the tail output')
+
+
+class ScenarioResult(namedtuple('ScenarioResult', ('name', 'bench', 'error', 'wall_time', 'bench_time'))):
+    """
+    outcome of one scenario; error is None if it passed, bench_time is the
+    scenario's duration on the bench clock
+    """
+    @property
+    def passed(self):
+        return self.error is None
+
+    def __str__(self):
+        text = (f'{"PASS" if self.passed else "FAIL"} {self.name:<24} '
+                f'{self.wall_time:7.2f}s wall {self.bench_time:7.2f}s bench')
+        if not self.passed:
+            text += f'\n    {self.error}'
+        return text
+
+
+def run_scenario(name, bench):
+    """run one scenario on bench and close it"""
+    function = SCENARIOS[name].function
+    started = time.perf_counter()
+    bench_started = bench.clock()
+    error = None
+    try:
+        function(bench)
+    except (ModuleError, MessageError, AssertionError) as err:
+        error = f'{type(err).__name__}: {err}'
+    except Exception:
+        error = traceback.format_exc().strip()
+    finally:
+        bench.close()
+    return ScenarioResult(name, bench.name, error, time.perf_counter() - started, bench.clock() - bench_started)
+
+
+def _run_simulated(name):
+    """worker process entry point"""
+    return run_scenario(name, Bench.simulated(name))
+
+
+def run_all(names=None, workers=None):
+    """
+    Run scenarios, each on its own simulated bench, across a pool of
+    worker processes (one per core by default; 1 runs them in this
+    process). Returns results in registration order.
+    """
+    names = list(SCENARIOS) if names is None else names
+    if workers == 1:
+        return [_run_simulated(name) for name in names]
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        return list(pool.map(_run_simulated, names))
+
+
+def report(results, wall_time=None):
+    lines = [f'{result}' for result in results]
+    failed = [result.name for result in results if not result.passed]
+    summary = f'{len(results) - len(failed)}/{len(results)} passed'
+    if wall_time is not None:
+        summary += (f' in {wall_time:.2f}s '
+                    f'({sum(result.wall_time for result in results):.2f}s of scenarios)')
+    lines.append(summary)
+    if failed:
+        lines.append(f'failed: {" ".join(failed)}')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import sys
+
+    parser = argparse.ArgumentParser(description='E36 tail module scenario tests against the firmware model')
+    parser.add_argument('--workers',
+                        type=int,
+                        metavar='COUNT',
+                        help='worker processes (default one per core, 1 runs in this process)')
+    parser.add_argument('--list',
+                        action='store_true',
+                        help='list the scenarios and exit')
+    parser.add_argument('scenarios',
+                        type=str,
+                        nargs='*',
+                        metavar='SCENARIO',
+                        help='scenarios to run (default all)')
+
+    args = parser.parse_args()
+    if args.list:
+        for entry in SCENARIOS.values():
+            print(f'{entry.name:<24} {entry.function.__doc__}')
+        sys.exit(0)
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f'unknown scenario {unknown[0]}')
+
+    started = time.perf_counter()
+    results = run_all(args.scenarios or None, args.workers)
+    print(report(results, time.perf_counter() - started))
+    sys.exit(0 if all(result.passed for result in results) else 1)
@@ -0,0 +1,116 @@
+#
+# Timer queue for host-side protocol engines.
+#
+# Callbacks run on a single dedicated thread at their due time, so
+# listeners called from the python-can Notifier thread can schedule
+# work (e.g. paced ISO-TP frames) instead of sleeping.
+#
+
+import heapq
+import itertools
+import sys
+import threading
+import time
+import traceback
+
+
+class Lateness(object):
+    """
+    Running record of how late scheduled events ran: count, mean, maximum
+    and a coarse histogram, in seconds.
+    """
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.002, 0.005, 0.010)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * (len(self.BUCKETS) + 1)
+
+    def record(self, lateness):
+        self.count += 1
+        self.total += lateness
+        if lateness > self.max:
+            self.max = lateness
+        for index, limit in enumerate(self.BUCKETS):
+            if lateness < limit:
+                self.histogram[index] += 1
+                return
+        self.histogram[-1] += 1
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def __str__(self):
+        buckets = ' '.join(f'<{limit * 1000:g}ms:{count}' for limit, count in zip(self.BUCKETS, self.histogram))
+        return (f'{self.count} events, mean {self.mean * 1000:.3f}ms, max {self.max * 1000:.3f}ms, '
+                f'{buckets} >={self.BUCKETS[-1] * 1000:g}ms:{self.histogram[-1]}')
+
+
+class ScheduledCall(object):
+    """handle for a scheduled callback; lateness is set just before the callback runs"""
+    __slots__ = ('when', 'callback', 'cancelled', 'lateness')
+
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+        self.lateness = None
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler(object):
+    """
+    Run callbacks at (time.perf_counter) deadlines on a daemon thread.
+
+    The thread sleeps on a condition until shortly before the next
+    deadline and spins for the remainder, so sub-millisecond intervals
+    are honoured. An exception raised by a callback is reported on
+    stderr and counted in errors; later callbacks still run.
+    """
+    SPIN_MARGIN = 0.0002
+
+    def __init__(self, name='scheduler'):
+        self.errors = 0
+        self._queue = list()
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._thread_main, name=name, daemon=True)
+        self._thread.start()
+
+    def call_at(self, when, callback):
+        call = ScheduledCall(when, callback)
+        with self._cond:
+            heapq.heappush(self._queue, (when, next(self._sequence), call))
+            if self._queue[0][2] is call:
+                self._cond.notify()
+        return call
+
+    def call_later(self, delay, callback):
+        return self.call_at(time.perf_counter() + delay, callback)
+
+    def _thread_main(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                when, _, call = self._queue[0]
+                remaining = when - time.perf_counter()
+                if remaining > self.SPIN_MARGIN:
+                    self._cond.wait(remaining - self.SPIN_MARGIN)
+                    continue
+                if remaining > 0:
+                    continue
+                heapq.heappop(self._queue)
+            if not call.cancelled:
+                call.lateness = time.perf_counter() - when
+                try:
+                    call.callback()
+                except Exception:
+                    # this thread serves every user of the scheduler, so one failing callback must not stop it
+                    self.errors += 1
+                    print(f'{self._thread.name}: exception in {call.callback!r}', file=sys.stderr)
+                    traceback.print_exc()
@@ -0,0 +1,243 @@
+#
+# Simulated CAN bus on a virtual clock.
+#
+# Unlike the 'virtual' Interface backend, which runs in real (optionally
+# scaled) time, a SimBus only advances when something runs it, and it
+# runs as fast as Python can process the scheduled events. Each node on
+# the bus is a SimInterface offering the same send / send_periodic /
+# recv / add_listener / power surface as Interface, so the existing
+# emulators and listeners can be attached unchanged.
+#
+# Time is kept internally in integer microseconds so that periodic
+# events stay aligned however long the simulation runs.
+#
+
+import can
+import heapq
+import itertools
+from collections import deque
+
+from interface import Expectations, FilteredListener, SimulatedPower, _normalize_filters
+
+
+def _to_us(seconds):
+    return int(round(seconds * 1000000))
+
+
+class SimEvent(object):
+    """a scheduled callback on the simulated clock; simulated events are never late"""
+    __slots__ = ('when', 'period', 'callback', 'cancelled')
+
+    lateness = 0.0
+
+    def __init__(self, when, period, callback):
+        self.when = when
+        self.period = period
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class SimPeriodicTask(object):
+    """stand-in for python-can's cyclic send task"""
+    def __init__(self, interface, message, period):
+        self._interface = interface
+        self._message = message
+        self.period = period
+        self._event = None
+        self.start()
+
+    def _send(self):
+        self._interface.send(self._message)
+
+    def modify_data(self, message):
+        self._message = message
+
+    def start(self):
+        if self._event is None:
+            self._event = self._interface.bus.call_every(self.period, self._send)
+
+    def stop(self):
+        if self._event is not None:
+            self._event.cancel()
+            self._event = None
+
+
+class SimInterface(object):
+    """a node on a SimBus, offering the Interface API"""
+    RX_QUEUE_DEPTH = 10000
+
+    time_scale = 1.0
+
+    def __init__(self, bus):
+        self.bus = bus
+        self._expectations = Expectations()
+        self._listeners = [self._expectations]
+        self._delivered = dict()
+        self._rx_queue = deque(maxlen=self.RX_QUEUE_DEPTH)
+
+    @property
+    def power(self):
+        return self.bus.power
+
+    def scaled(self, seconds):
+        return seconds
+
+    def clock(self):
+        """simulated time, which only advances as the simulation runs"""
+        return self.bus.now
+
+    def sleep(self, seconds):
+        """advance the simulation"""
+        self.bus.run(seconds)
+
+    def add_listener(self, listener, filters=None):
+        """see Interface.add_listener; filters are applied per listener"""
+        filters = _normalize_filters(filters)
+        self._delivered[listener] = listener if filters is None else FilteredListener(listener, filters)
+        self._listeners.append(self._delivered[listener])
+
+    def remove_listener(self, listener):
+        self._listeners.remove(self._delivered.pop(listener))
+
+    @property
+    def listeners(self):
+        return list(self._delivered)
+
+    def send(self, message):
+        self.bus.transmit(self, message)
+
+    def send_periodic(self, message, interval):
+        return SimPeriodicTask(self, message, interval)
+
+    def call_later(self, delay, callback):
+        return self.bus.call_later(delay, callback)
+
+    def recv(self, timeout):
+        """
+        Run the simulation until a message arrives for this node or the
+        timeout expires.
+
+        Must not be called from a listener or scheduled callback.
+        """
+        if not self._rx_queue:
+            self.bus.run(timeout, until=lambda: self._rx_queue)
+        if self._rx_queue:
+            return self._rx_queue.popleft()
+        return None
+
+    def expect_later(self, pattern, timeout=1.0):
+        """see Interface.expect_later; the future only resolves as the simulation runs"""
+        return self._expectations.expect(pattern, timeout, self.call_later)
+
+    def expect(self, pattern, timeout=1.0):
+        """
+        Run the simulation until a message matching pattern arrives or the
+        timeout expires; returns the message or None.
+
+        Must not be called from a listener or scheduled callback.
+        """
+        future = self.expect_later(pattern, timeout)
+        if not future.done():
+            self.bus.run(timeout, until=future.done)
+        return future.result()
+
+    def set_power_on(self):
+        self.bus.power.set_power_on()
+
+    def set_power_off(self):
+        self.bus.power.set_power_off()
+
+    def _deliver(self, message):
+        self._rx_queue.append(message)
+        for listener in self._listeners:
+            listener.on_message_received(message)
+
+
+class SimBus(object):
+    """
+    Simulated bus and clock.
+
+    Frames are delivered to every node except the sender, in transmit order,
+    at the instant they are sent; arbitration and wire time are not modelled.
+    """
+    def __init__(self, channel='sim'):
+        self.channel = channel
+        self._now_us = 0
+        self._events = list()
+        self._sequence = itertools.count()
+        self._nodes = list()
+        self._pending = deque()
+        self._dispatching = False
+        self.frame_count = 0
+        self.power = SimulatedPower(clock=lambda: self.now)
+
+    @property
+    def now(self):
+        """current simulated time in seconds"""
+        return self._now_us / 1000000
+
+    def interface(self):
+        """attach and return a new node"""
+        node = SimInterface(self)
+        self._nodes.append(node)
+        return node
+
+    def _schedule(self, event):
+        heapq.heappush(self._events, (event.when, next(self._sequence), event))
+        return event
+
+    def call_later(self, delay, callback):
+        """run callback once, delay seconds from now"""
+        return self._schedule(SimEvent(self._now_us + _to_us(delay), None, callback))
+
+    def call_every(self, period, callback, delay=None):
+        """run callback every period seconds, first after delay (default one period)"""
+        period_us = max(1, _to_us(period))
+        delay_us = period_us if delay is None else _to_us(delay)
+        return self._schedule(SimEvent(self._now_us + delay_us, period_us, callback))
+
+    def transmit(self, sender, message):
+        """send a copy of message, stamped with the current time, to every other node"""
+        self._pending.append((sender, can.Message(timestamp=self.now,
+                                                  arbitration_id=message.arbitration_id,
+                                                  is_extended_id=message.is_extended_id,
+                                                  is_remote_frame=message.is_remote_frame,
+                                                  dlc=message.dlc,
+                                                  data=bytes(message.data),
+                                                  channel=self.channel)))
+        if self._dispatching:
+            return
+        self._dispatching = True
+        try:
+            while self._pending:
+                sender, message = self._pending.popleft()
+                self.frame_count += 1
+                for node in self._nodes:
+                    if node is not sender:
+                        node._deliver(message)
+        finally:
+            self._dispatching = False
+
+    def run(self, duration, until=None):
+        """
+        Advance the clock by duration seconds, running every event that falls
+        due. If until is supplied, stop early as soon as it returns true.
+        """
+        deadline = self._now_us + _to_us(duration)
+        events = self._events
+        while events and events[0][0] <= deadline:
+            if until is not None and until():
+                return
+            when, _, event = heapq.heappop(events)
+            if event.cancelled:
+                continue
+            self._now_us = when
+            if event.period is not None:
+                event.when = when + event.period
+                self._schedule(event)
+            event.callback()
+        if until is None or not until():
+            self._now_us = deadline
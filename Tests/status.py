@@ -3,47 +3,174 @@
 # Module status monitor
 #
 
+import time
+from array import array
+from bisect import bisect_left
+
 import can
-from messages import MessageError, MSG_ack, MSG_status_system, MSG_status_voltage_current, MSG_status_faults
+from interface import id_filters
+from messages import MessageFormat, MSG_ack, MSG_status_system, MSG_status_voltage_current, MSG_status_faults
+
+
+class FieldHistory(object):
+    """
+    Fixed-capacity ring of (timestamp, value) samples for one field.
+
+    Each sample is written twice, at slot and slot + capacity, so the most
+    recent samples are always contiguous and numpy() can return them
+    without copying.
+    """
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._timestamps = array('d', bytes(16 * capacity))
+        self._values = array('d', bytes(16 * capacity))
+        self._written = 0
+
+    def __len__(self):
+        return min(self._written, self._capacity)
+
+    def append(self, timestamp, value):
+        slot = self._written % self._capacity
+        self._timestamps[slot] = self._timestamps[slot + self._capacity] = timestamp
+        self._values[slot] = self._values[slot + self._capacity] = value
+        self._written += 1
+
+    def _start(self):
+        return (self._written - len(self)) % self._capacity
+
+    @property
+    def last(self):
+        """most recent value, or None if there is none"""
+        if not self._written:
+            return None
+        return self._values[(self._written - 1) % self._capacity]
+
+    @property
+    def last_timestamp(self):
+        if not self._written:
+            return None
+        return self._timestamps[(self._written - 1) % self._capacity]
+
+    def age(self, now):
+        """seconds since the last sample, or None if there is none"""
+        if not self._written:
+            return None
+        return now - self.last_timestamp
+
+    def window(self, seconds=None, now=None):
+        """
+        values of samples no older than seconds before now (by default the
+        newest sample's timestamp), oldest first
+        """
+        start = self._start()
+        end = start + len(self)
+        if seconds is not None and end > start:
+            if now is None:
+                now = self.last_timestamp
+            start = bisect_left(self._timestamps, now - seconds, start, end)
+        return self._values[start:end]
+
+    def min(self, seconds=None, now=None):
+        values = self.window(seconds, now)
+        return min(values) if values else None
+
+    def max(self, seconds=None, now=None):
+        values = self.window(seconds, now)
+        return max(values) if values else None
+
+    def mean(self, seconds=None, now=None):
+        values = self.window(seconds, now)
+        return sum(values) / len(values) if values else None
+
+    def numpy(self):
+        """
+        (timestamps, values) as numpy arrays, oldest first. These are views
+        of the ring and are overwritten as samples arrive.
+        """
+        import numpy as np
+
+        start = self._start()
+        end = start + len(self)
+        return (np.frombuffer(self._timestamps, dtype=np.float64)[start:end],
+                np.frombuffer(self._values, dtype=np.float64)[start:end])
 
 
 class Status(can.Listener):
-    def __init__(self, interface):
-        self._line = ''
-        interface.add_listener(self)
+    """
+    Module status tracker.
+
+    Every public field of the status reports is kept in a FieldHistory;
+    byte-string fields (per-output voltages, currents and faults) are split
+    into one history per output. The arrival time of each report is
+    tracked as well so that a silent module can be detected.
+
+    clock supplies 'now' for age and staleness queries, and must be
+    comparable with message timestamps.
+    """
+    _formats = (MSG_ack, MSG_status_system, MSG_status_voltage_current, MSG_status_faults)
+    _metadata = ('arbitration_id', 'is_extended_id', 'dlc', 'timestamp', 'data')
+
+    CAPACITY = 4096
+
+    def __init__(self, interface, capacity=CAPACITY, clock=time.time):
+        self._capacity = capacity
+        self._clock = clock
         self._status = dict()
+        self._history = dict()
+        self._received = dict()
+        interface.add_listener(self, filters=id_filters(*self._formats))
 
     def on_message_received(self, message):
-        try:
-            fields = MSG_ack.unpack(message)
-            self.update(fields)
-        except MessageError:
-            pass
-        try:
-            fields = MSG_status_system.unpack(message)
-            self.update(fields)
-        except MessageError:
-            pass
-        try:
-            fields = MSG_status_voltage_current.unpack(message)
-            self.update(fields)
-        except MessageError:
-            pass
-        try:
-            fields = MSG_status_faults.unpack(message)
+        msg_class, fields = MessageFormat.decode(message)
+        if msg_class in self._formats:
+            self._received[message.arbitration_id] = message.timestamp
             self.update(fields)
-        except MessageError:
-            pass
+
+    def _field(self, key, index):
+        history = self._history.get((key, index))
+        if history is None:
+            history = self._history[(key, index)] = FieldHistory(self._capacity)
+        return history
 
     def update(self, fields):
+        timestamp = fields['timestamp']
         for key, value in fields.items():
-            if key not in ['arbitration_id',
-                           'is_extended_id',
-                           'dlc',
-                           'timestamp',
-                           'data']:
-                self._status[key] = value
+            if key in self._metadata:
+                continue
+            self._status[key] = value
+            if isinstance(value, (bytes, bytearray)):
+                for index, element in enumerate(value):
+                    self._field(key, index).append(timestamp, element)
+            else:
+                self._field(key, None).append(timestamp, value)
+
+    def history(self, key, index=None):
+        """the FieldHistory for a field, or for one output of a per-output field"""
+        return self._history.get((key, index))
+
+    def fields(self):
+        """(key, index) for every field seen so far"""
+        return list(self._history.keys())
+
+    def last(self, key, index=None):
+        history = self.history(key, index)
+        return None if history is None else history.last
 
+    def age(self, key, index=None, now=None):
+        history = self.history(key, index)
+        return None if history is None else history.age(self._clock() if now is None else now)
+
+    def message_age(self, arbitration_id, now=None):
+        """seconds since a status report with this ID arrived, or None if none has"""
+        timestamp = self._received.get(arbitration_id)
+        if timestamp is None:
+            return None
+        return (self._clock() if now is None else now) - timestamp
+
+    def is_stale(self, arbitration_id, max_age, now=None):
+        """true if no status report with this ID has arrived in the last max_age seconds"""
+        age = self.message_age(arbitration_id, now)
+        return age is None or age > max_age
 
     def __str__(self):
         return f'{self._status}'
@@ -65,6 +192,16 @@ if __name__ == '__main__':
                         default=500,
                         metavar='BITRATE_KBPS',
                         help='CAN bitrate (kBps')
+    parser.add_argument('--interface',
+                        type=str,
+                        choices=Interface.BACKENDS,
+                        default='anagate',
+                        help='CAN interface backend')
+    parser.add_argument('--time-scale',
+                        type=float,
+                        default=1.0,
+                        metavar='FACTOR',
+                        help='run periodic traffic and delays FACTOR times faster than real time')
 
     args = parser.parse_args()
     try:
@@ -3,7 +3,6 @@
 # Test console for the E36 tail module
 #
 
-import time
 import argparse
 from interface import Interface, ModuleError
 from messages import MessageError
@@ -23,6 +22,16 @@ parser.add_argument('--bitrate',
                     default=500,
                     metavar='BITRATE_KBPS',
                     help='CAN bitrate (kBps)')
+parser.add_argument('--interface',
+                    type=str,
+                    choices=Interface.BACKENDS,
+                    default='anagate',
+                    help='CAN interface backend')
+parser.add_argument('--time-scale',
+                    type=float,
+                    default=1.0,
+                    metavar='FACTOR',
+                    help='run periodic traffic and delays FACTOR times faster than real time')
 
 
 args = parser.parse_args()
@@ -30,15 +39,15 @@ interface = None
 try:
     interface = Interface(args)
     interface.set_power_on()
-    dde = DDE(interface)
+    dde = DDE(interface, args)
     status = Status(interface)
     console = Console(interface)
 
-    time.sleep(3)
+    interface.sleep(3)
     dde.brake_on()
-    time.sleep(2)
+    interface.sleep(2)
     dde.brake_off()
-    time.sleep(2)
+    interface.sleep(2)
 except KeyboardInterrupt:
     pass
 except ModuleError as err:
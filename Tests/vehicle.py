@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+#
+# Full-vehicle bus traffic model.
+#
+# Generates the periodic and event traffic of the rest of the car - the
+# M57 DDE, ZF 6HP EGS, EKPM fuel pump controller, MK60 ABS and AiM
+# PDM08 - so that bench tests see a loaded bus with the arbitration
+# contention and acceptance filter load of the real network rather than
+# a handful of DDE frames.
+#
+# The DDE and EGS emulators provide their own frames and protocol
+# handling; the model runs them at the car's periods from one shared
+# CyclicScheduler and adds the frames they do not send. Every ECU's
+# frames are given a random phase, as ECUs on the car are not
+# synchronised. IDs the module or emulators already use are the car's;
+# the rest are representative of each ECU's frame count, period and
+# length.
+#
+# Payloads follow a drive (VEHICLE_PROFILES, with the gear profile from
+# drive_cycle so that the DDE PID values agree) that is pre-generated
+# and pre-encoded at every step of the cycle, as in drive_cycle, so that
+# sending a frame only indexes an array. Alive counters advance once per
+# period. Brake, light and selector changes are also sent at once as
+# events, as they are on the car.
+#
+# The cycle repeats if the session outlasts it.
+#
+
+import random
+import time
+from collections import namedtuple
+
+import numpy as np
+
+import can
+from cyclic import CyclicScheduler
+from dde import DDE
+from drive_cycle import DEFAULT_PROFILES, Constant, Ramp, Steps, Trace
+from egs import EGS
+from messages import MSG_DDE_torque_brake, MSG_EGS_gear, MSG_lights
+from rx_overflow import frame_bits
+
+ECUS = ('DDE', 'EGS', 'EKPM', 'MK60', 'PDM08')
+
+# engine rpm per km/h in each gear, for 6HP ratios, final drive and tyres
+RPM_PER_KMH = np.array([0.0, 94.0, 57.0, 38.0, 29.0, 23.0, 19.0])
+IDLE_RPM = 800
+MAX_RPM = 4600
+
+# deceleration at which the driver is on the brakes, km/h/s
+BRAKE_DECEL = -4.0
+
+# a lap of warm-up, pulls through the gears and cruising, over the drive_cycle gear profile
+VEHICLE_PROFILES = {
+    'speed': Trace((0, 60, 90, 120, 135, 150, 290, 298, 395, 401, 415, 430, 495, 503, 535, 543, 570, 600),
+                   (0, 0, 35, 80, 110, 140, 140, 100, 100, 70, 110, 150, 150, 100, 60, 20, 0, 0)),
+    'gear': DEFAULT_PROFILES['current_gear'],
+    'coolant': Ramp(25, 90, 480.0),
+    'fuel_level': Ramp(80, 65, 600.0),
+    'lights': Steps(((0, 0),
+                     (30, MSG_lights.TAIL_LIGHT),
+                     (200, MSG_lights.TAIL_LIGHT | MSG_lights.RAIN_LIGHT),
+                     (260, MSG_lights.TAIL_LIGHT),
+                     (590, 0))),
+    'battery': Constant(13.9),
+}
+
+
+class Signals(object):
+    """
+    The vehicle state at every step of the cycle, as arrays.
+
+    profiles    dict of signal name to Profile, overriding VEHICLE_PROFILES
+    """
+    def __init__(self, profiles=None, duration=600.0, step=0.01, seed=None):
+        profiles = dict(VEHICLE_PROFILES, **(profiles or {}))
+        self.rng = np.random.default_rng(seed)
+        self.step = step
+        self.times = np.arange(0.0, duration, step)
+        values = {name: profile.values(self.times, self.rng) for name, profile in profiles.items()}
+
+        self.speed = np.clip(values['speed'], 0.0, None)
+        self.gear = np.clip(np.rint(values['gear']), 0, len(RPM_PER_KMH) - 1).astype(int)
+        self.accel = np.gradient(self.speed, step)
+        self.rpm = np.where(self.gear == 0, IDLE_RPM,
+                            np.clip(self.speed * RPM_PER_KMH[self.gear], IDLE_RPM + 200, MAX_RPM))
+        self.rpm += self.rng.normal(0.0, 8.0, len(self.times))
+        self.throttle = np.where(self.accel > 0, np.clip(20 + self.accel * 6, 0, 100), 0.0)
+        self.torque = self.throttle * 4.0
+        self.brake = self.accel < BRAKE_DECEL
+        self.selector = np.where((self.speed > 0) | (self.gear > 0), EGS.GEAR_D, EGS.GEAR_P)
+        self.wheels = [self.speed + self.rng.normal(0.0, 0.15, len(self.times)) for _ in range(4)]
+        self.distance = np.cumsum(self.speed / 3.6 * step)
+        self.coolant = values['coolant']
+        self.fuel_level = values['fuel_level']
+        self.lights = np.rint(values['lights']).astype(int)
+        self.battery = values['battery'] + self.rng.normal(0.0, 0.02, len(self.times))
+
+    def __len__(self):
+        return len(self.times)
+
+    def counter(self, period):
+        """an alive counter advancing once per period"""
+        return (self.times / period).astype(int) & 0x0f
+
+
+def _pack(count, *fields):
+    """
+    Encode count frames from fields, each (numpy dtype, values), laid out
+    in order; returns a (count, length) array of bytes.
+    """
+    dtype = [(f'f{index}', field_type) for index, (field_type, _) in enumerate(fields)]
+    frames = np.zeros(count, dtype=dtype)
+    for index, (field_type, values) in enumerate(fields):
+        frames[f'f{index}'] = np.clip(values, *_limits(field_type)) if np.ndim(values) else values
+    return frames.view(np.uint8).reshape(count, frames.dtype.itemsize)
+
+
+def _limits(field_type):
+    info = np.iinfo(np.dtype(field_type))
+    return info.min, info.max
+
+
+# encoders, returning the payloads of one frame at every step
+
+def _dde_torque_2(s, period):
+    return _pack(len(s), ('u1', s.counter(period)), ('<u2', s.torque * 16), ('<u2', s.torque * 16),
+                 ('<u2', s.throttle * 10), ('u1', 0xff))
+
+
+def _dde_rpm_tps(s, period):
+    # as MSG_DDE_rpm_tps
+    return _pack(len(s), ('<u2', 0), ('<u2', s.throttle * 2.55), ('<u2', s.rpm * 4), ('<u2', 0))
+
+
+def _dde_temperatures(s, period):
+    # as MSG_DDE_coolant
+    return _pack(len(s), ('u1', s.coolant + 48), ('u1', s.coolant + 40), ('u1', 0), ('u1', s.counter(period)),
+                 ('u1', 0), ('u1', 0), ('u1', 0), ('u1', 0))
+
+
+def _egs_gear_torque(s, period):
+    return _pack(len(s), ('u1', s.counter(period)), ('u1', s.gear), ('<u2', s.torque * 16),
+                 ('u1', np.where(s.gear > 1, 1, 0)), ('u1', 0), ('u1', 0), ('u1', 0xff))
+
+
+def _egs_torque_request(s, period):
+    return _pack(len(s), ('u1', s.counter(period)), ('<u2', 0xffff), ('<u2', s.rpm * 4), ('u1', 0),
+                 ('u1', 0), ('u1', 0))
+
+
+def _abs_wheel_speeds(s, period):
+    return _pack(len(s), *[('<u2', wheel * 16) for wheel in s.wheels])
+
+
+def _abs_dynamics(s, period):
+    return _pack(len(s), ('<i2', s.accel * 100), ('<i2', s.rng.normal(0.0, 20.0, len(s))),
+                 ('<i2', s.rng.normal(0.0, 40.0, len(s))), ('u1', s.counter(period)), ('u1', 0))
+
+
+def _abs_speed(s, period):
+    return _pack(len(s), ('<u2', s.speed * 16), ('<u2', s.speed * 16), ('u1', s.counter(period)),
+                 ('u1', s.brake), ('<u2', 0))
+
+
+def _abs_status(s, period):
+    return _pack(len(s), ('u1', 0), ('u1', 0), ('u1', 0), ('u1', 0), ('u1', s.counter(period)), ('u1', 0),
+                 ('u1', 0), ('u1', 0))
+
+
+def _abs_distance(s, period):
+    return _pack(len(s), ('<u2', s.distance.astype(int) & 0xffff), ('<u2', 0), ('u1', s.counter(period)),
+                 ('u1', 0), ('<u2', 0))
+
+
+def _ekpm_status(s, period):
+    return _pack(len(s), ('u1', np.clip(s.throttle * 0.8 + 20, 0, 100)), ('<u2', 5000 + s.throttle * 5),
+                 ('u1', s.battery * 10), ('u1', s.counter(period)), ('u1', 0), ('u1', 0), ('u1', 0))
+
+
+def _pdm_lights(s, period):
+    # as MSG_lights
+    return _pack(len(s), ('u1', s.lights), ('u1', 0), ('u1', 0xf7))
+
+
+def _pdm_stream(index):
+    def encode(s, period):
+        return _pack(len(s), ('u1', index), ('u1', s.counter(period)), ('<u2', s.battery * 1000),
+                     ('<u2', s.fuel_level * 10), ('<u2', s.rng.normal(2000.0, 50.0, len(s))))
+    return encode
+
+
+TrafficFrame = namedtuple('TrafficFrame', ('ecu', 'arbid', 'period', 'dlc', 'encode', 'description'))
+
+# encode None means the frame is sent by the emulator for that ECU
+TRAFFIC = (
+    TrafficFrame('DDE', 0x0a8, 0.01, 8, None, 'torque / brake'),
+    TrafficFrame('DDE', 0x0a9, 0.01, 8, _dde_torque_2, 'torque 2'),
+    TrafficFrame('DDE', 0x0aa, 0.01, 8, _dde_rpm_tps, 'engine speed / throttle'),
+    TrafficFrame('DDE', 0x1d0, 0.2, 8, _dde_temperatures, 'temperatures'),
+    TrafficFrame('EGS', 0x0ba, 0.01, 8, _egs_gear_torque, 'gear / torque'),
+    TrafficFrame('EGS', 0x0b5, 0.02, 8, _egs_torque_request, 'torque request'),
+    TrafficFrame('EGS', 0x1d2, 0.1, 8, None, 'selected gear'),
+    TrafficFrame('MK60', 0x0ce, 0.01, 8, _abs_wheel_speeds, 'wheel speeds'),
+    TrafficFrame('MK60', 0x0c8, 0.01, 8, _abs_dynamics, 'acceleration / yaw rate'),
+    TrafficFrame('MK60', 0x1a0, 0.02, 8, _abs_speed, 'vehicle speed'),
+    TrafficFrame('MK60', 0x1a6, 0.1, 8, _abs_distance, 'distance'),
+    TrafficFrame('MK60', 0x19e, 0.2, 8, _abs_status, 'DSC status'),
+    TrafficFrame('EKPM', 0x335, 0.1, 8, _ekpm_status, 'fuel pump status'),
+    TrafficFrame('PDM08', 0x21a, 0.1, 3, _pdm_lights, 'lights'),
+) + tuple(TrafficFrame('PDM08', 0x5f0 + index, 0.05, 8, _pdm_stream(index), f'dash stream {index}')
+          for index in range(4))
+
+
+def nominal_load(frames, bitrate=500, period_scale=1.0):
+    """fraction of the bus the periodic frames occupy"""
+    return sum(frame_bits(frame.dlc) / (frame.period * period_scale) for frame in frames) / (bitrate * 1000)
+
+
+class VehicleTraffic(object):
+    """
+    Traffic from the rest of the car.
+
+    interface       Interface or SimInterface to send on
+    args            passed to the DDE emulator
+    ecus            names of the ECUs to emulate
+    period_scale    multiplies every period, so 0.5 doubles the load
+    events          send brake, light and selector changes as they happen
+    drive_cycle     DriveCycle for the DDE emulator's PID replies
+    clock           time source that advances with the interface
+    """
+    def __init__(self, interface, args, ecus=ECUS, profiles=None, duration=600.0, step=0.01, seed=None,
+                 period_scale=1.0, events=True, drive_cycle=None, clock=time.time, tick=0.001):
+        self._interface = interface
+        self._clock = clock
+        self._origin = None
+        self._events_enabled = events
+        self._event_timer = None
+        self._next_event = 0
+        self.signals = Signals(profiles, duration, step, seed)
+        self.cyclic = CyclicScheduler(interface, tick=tick)
+        self.dde = DDE(interface, args, cyclic=self.cyclic, drive_cycle=drive_cycle) if 'DDE' in ecus else None
+        self.egs = EGS(interface, cyclic=self.cyclic, selected_gear=int(self.signals.selector[0])) \
+            if 'EGS' in ecus else None
+        self.event_count = 0
+
+        phases = random.Random(seed)
+        self.frames = list()
+        for frame in TRAFFIC:
+            if frame.ecu not in ecus:
+                continue
+            period = frame.period * period_scale
+            phase = phases.uniform(0.0, period)
+            if frame.encode is None:
+                if frame.ecu == 'DDE' and self.dde.cyclic is None:
+                    # DDE periodic traffic disabled
+                    continue
+                self.cyclic.set_period(frame.arbid, period, phase)
+            else:
+                self.cyclic.add(frame.arbid, period, self._payload(frame.arbid, frame.encode(self.signals, period)),
+                                phase)
+            self.frames.append(frame._replace(period=period))
+        self._events = self._find_events(ecus)
+
+    def _sample(self):
+        elapsed = (self._clock() - self._origin) * self._interface.time_scale
+        return int(elapsed / self.signals.step) % len(self.signals)
+
+    def _payload(self, arbid, payloads):
+        def payload():
+            return can.Message(arbitration_id=arbid, is_extended_id=False,
+                               data=payloads[self._sample()].tobytes())
+        return payload
+
+    def _find_events(self, ecus):
+        """(time in cycle, action) for every change of an evented signal"""
+        signals = self.signals
+        evented = list()
+        if 'DDE' in ecus and self.dde.cyclic is not None:
+            evented.append((signals.brake, self._brake))
+        if 'EGS' in ecus:
+            evented.append((signals.selector, self._selector))
+        if 'PDM08' in ecus:
+            evented.append((signals.lights, self._lights))
+        events = list()
+        for values, action in evented:
+            for index in np.flatnonzero(values[1:] != values[:-1]) + 1:
+                events.append((signals.times[index], action, values[index].item()))
+        return sorted(events, key=lambda event: event[0])
+
+    def _brake(self, state):
+        if state:
+            self.dde.brake_on()
+        else:
+            self.dde.brake_off()
+        self._interface.send(MSG_DDE_torque_brake.message(state))
+
+    def _selector(self, selected_gear):
+        self.egs.select_gear(selected_gear)
+        self._interface.send(MSG_EGS_gear.message(selected_gear=selected_gear))
+
+    def _lights(self, status):
+        self._interface.send(MSG_lights.message(brake_light=False,
+                                                tail_light=status & MSG_lights.TAIL_LIGHT,
+                                                rain_light=status & MSG_lights.RAIN_LIGHT))
+
+    def _schedule_event(self):
+        if not self._events:
+            return
+        cycle, index = divmod(self._next_event, len(self._events))
+        when = cycle * len(self.signals) * self.signals.step + self._events[index][0]
+        elapsed = (self._clock() - self._origin) * self._interface.time_scale
+        self._event_timer = self._interface.call_later(max(0.0, when - elapsed), self._fire_event)
+
+    def _fire_event(self):
+        if self._event_timer is None:
+            return
+        _, action, value = self._events[self._next_event % len(self._events)]
+        self._next_event += 1
+        self.event_count += 1
+        action(value)
+        self._schedule_event()
+
+    def start(self):
+        self._origin = self._clock()
+        self.cyclic.start()
+        if self._events_enabled:
+            self._next_event = 0
+            self._schedule_event()
+
+    def stop(self):
+        self.cyclic.stop()
+        if self._event_timer is not None:
+            self._event_timer.cancel()
+            self._event_timer = None
+
+    def nominal_load(self, bitrate=500):
+        return nominal_load(self.frames, bitrate)
+
+    def report(self, elapsed, bitrate=500):
+        """frames and bus load sent by each ECU over elapsed nominal seconds"""
+        lines = list()
+        total_bits = 0
+        for ecu in ECUS:
+            frames = [frame for frame in self.frames if frame.ecu == ecu]
+            if not frames:
+                continue
+            sent = [(frame, self.cyclic.stats(frame.arbid).count) for frame in frames]
+            bits = sum(count * frame_bits(frame.dlc) for frame, count in sent)
+            total_bits += bits
+            lines.append(f'{ecu:<6} {len(frames)} IDs, {sum(count for _, count in sent) / elapsed:.0f} frames/s, '
+                         f'{bits / elapsed / 1000:.1f} kbps')
+        lines.append(f'total  {total_bits / elapsed / (bitrate * 1000) * 100:.1f}% of {bitrate} kbps '
+                     f'(nominal {self.nominal_load(bitrate) * 100:.1f}%), {self.event_count} events')
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+    from interface import Interface
+
+    parser = argparse.ArgumentParser(description='E36 tail module full-vehicle traffic')
+    parser.add_argument('--interface-channel',
+                        type=str,
+                        metavar='CHANNEL',
+                        help='interface channel name (e.g. for Anagate units, hostname:portname')
+    parser.add_argument('--bitrate',
+                        type=int,
+                        default=500,
+                        metavar='BITRATE_KBPS',
+                        help='CAN bitrate (kBps')
+    parser.add_argument('--interface',
+                        type=str,
+                        choices=Interface.BACKENDS,
+                        default='anagate',
+                        help='CAN interface backend')
+    parser.add_argument('--time-scale',
+                        type=float,
+                        default=1.0,
+                        metavar='FACTOR',
+                        help='run periodic traffic and delays FACTOR times faster than real time')
+    parser.add_argument('--firmware',
+                        action='store_true',
+                        help='drive the firmware model on a simulated bus instead of an interface')
+    parser.add_argument('--ecu',
+                        type=str,
+                        choices=ECUS,
+                        action='append',
+                        metavar='ECU',
+                        help=f'emulate only this ECU (may be repeated; default all of {", ".join(ECUS)})')
+    parser.add_argument('--period-scale',
+                        type=float,
+                        default=1.0,
+                        metavar='FACTOR',
+                        help='multiply every period by FACTOR; 0.5 doubles the bus load')
+    parser.add_argument('--no-events',
+                        action='store_true',
+                        help='only send periodic traffic')
+    parser.add_argument('--duration',
+                        type=float,
+                        default=600.0,
+                        metavar='SECONDS',
+                        help='length of the session')
+    parser.add_argument('--seed',
+                        type=int,
+                        metavar='SEED',
+                        help='random seed for noise and phases')
+
+    args = parser.parse_args()
+    args.no_periodic = False
+    module = None
+    if args.firmware:
+        from firmware import simulated
+
+        interface, module, clock = simulated()
+    else:
+        if args.interface_channel is None:
+            parser.error('--interface-channel is required unless --firmware is given')
+        interface = Interface(args)
+        clock = time.time
+
+    traffic = VehicleTraffic(interface, args, ecus=args.ecu or ECUS, seed=args.seed,
+                             period_scale=args.period_scale, events=not args.no_events, clock=clock)
+    print(f'nominal load {traffic.nominal_load(args.bitrate) * 100:.1f}% of {args.bitrate} kbps')
+    interface.set_power_on()
+    started = clock()
+    traffic.start()
+    try:
+        interface.sleep(args.duration)
+    except KeyboardInterrupt:
+        pass
+    traffic.stop()
+    interface.set_power_off()
+    print(traffic.report((clock() - started) * interface.time_scale, args.bitrate))
+    if module is not None:
+        print(f'module: {module.can_overflows} frames dropped, '
+              f'{module.console.count("CAN OVERFLOW")} overflow reports on the console')
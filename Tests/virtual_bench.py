@@ -0,0 +1,85 @@
+#
+# The firmware model behind a 'virtual' Interface channel.
+#
+# A VirtualModule runs a TailModule on a private SimBus whose clock is
+# kept in step with the wall clock (times the time scale), and bridges
+# that bus to a python-can virtual channel: frames from the channel are
+# injected into the simulation as they arrive and the module's frames
+# are sent back out. The simulation catches up with the wall clock in
+# chunks, so forwarded frames are stamped with the wall-clock time their
+# simulated time corresponds to rather than the time they were
+# forwarded. Power follows the channel's simulated supply, so an
+# Interface opened on the channel with the virtual backend behaves like
+# a bench with a module wired to it.
+#
+# All simulation runs on the bridge thread.
+#
+
+import copy
+import threading
+import time
+from collections import deque
+
+import can
+from firmware import TailModule
+from interface import virtual_power
+from simbus import SimBus
+
+
+class VirtualModule(can.Listener):
+    """
+    A simulated module on a virtual channel.
+
+    Time scale should match that of the Interfaces talking to it.
+    """
+    POLL = 0.001
+
+    def __init__(self, channel, bitrate=500, time_scale=1.0):
+        self.channel = channel
+        self.time_scale = time_scale
+        self._bus = can.ThreadSafeBus(interface='virtual', channel=channel, bitrate=bitrate * 1000,
+                                      preserve_timestamps=True)
+        self._origin = None
+        self._sim = SimBus(channel=channel)
+        self._node = self._sim.interface()
+        self._node.add_listener(self)
+        self.module = TailModule(self._sim.interface())
+        self._power = virtual_power(channel)
+        self._power_changes = deque([True] if self._power.is_on else [])
+        self._power.observers.append(self._power_changed)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._bridge, name=f'virtual-module-{channel}', daemon=True)
+        self._thread.start()
+
+    def _power_changed(self, on):
+        # applied in order by the bridge thread, so that a quick off / on still resets the module
+        self._power_changes.append(on)
+
+    def on_message_received(self, message):
+        """a frame from the module"""
+        forwarded = copy.copy(message)
+        forwarded.timestamp = self._origin + message.timestamp / self.time_scale
+        self._bus.send(forwarded)
+
+    def _bridge(self):
+        started = time.monotonic()
+        # wall-clock time at simulated time zero, for stamping forwarded frames
+        self._origin = time.time()
+        while not self._stopped.is_set():
+            message = self._bus.recv(timeout=self.POLL)
+            while self._power_changes:
+                if self._power_changes.popleft():
+                    self._sim.power.set_power_on()
+                else:
+                    self._sim.power.set_power_off()
+            behind = (time.monotonic() - started) * self.time_scale - self._sim.now
+            if behind > 0:
+                self._sim.run(behind)
+            if message is not None:
+                self._node.send(message)
+
+    def stop(self):
+        self._power.observers.remove(self._power_changed)
+        self._stopped.set()
+        self._thread.join()
+        self._bus.shutdown()